@@ -0,0 +1,100 @@
+####################################################################################################
+"""
+benchmark.py
+
+This module implements benchmarks for performance-critical processing steps, which compare the
+current implementation with the previous (reference) implementation on synthetic data. The results
+of both implementations are checked to be equal.
+
+Run all benchmarks using: python benchmark.py
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+#############
+## Imports ##
+#############
+
+import pandas as pd
+import numpy as np
+import time
+
+# Import own modules.
+from datasets import ZakenDataset
+
+
+####################
+## Synthetic data ##
+####################
+
+def synthetic_zaken_stadia(n_zaken=100000, stadia_per_zaak=5, seed=0):
+    """Create synthetic zaken and stadia dataframes, with the columns used to select finished cases."""
+    rng = np.random.RandomState(seed)
+    zaak_ids = np.array([f'{i}_1' for i in range(n_zaken)])
+    zaken = pd.DataFrame({'zaak_id': zaak_ids,
+                          'afs_oms': rng.choice(['zl woning is beschikbaar gekomen', 'zl geen woonfraude',
+                                                 'geen zoeklicht', None], n_zaken, p=[0.05, 0.05, 0.6, 0.3])})
+    n_stadia = n_zaken * stadia_per_zaak
+    stadia = pd.DataFrame({'zaak_id': zaak_ids[rng.randint(0, n_zaken, n_stadia)],
+                           'sta_oms': rng.choice(['rapport naar han', 'bd naar han', 'huisbezoek', 'avondronde'],
+                                                 n_stadia, p=[0.05, 0.05, 0.5, 0.4]),
+                           'begindatum': pd.Timestamp('2010-01-01') + pd.to_timedelta(rng.randint(0, 3650, n_stadia), unit='D')})
+    return zaken, stadia
+
+
+##########################
+## Reference algorithms ##
+##########################
+
+def keep_finished_cases_loop(zaken, stadia):
+    """Previous implementation of ZakenDataset.keep_finished_cases, which loops over the stadia of each case."""
+    zaken = zaken.copy()
+    stadia = stadia.copy()
+    zaken['mask'] = zaken.afs_oms == 'zl woning is beschikbaar gekomen'
+    zaken['mask'] += zaken.afs_oms == 'zl geen woonfraude'
+    zl_zaken = zaken[zaken['mask']]
+    stadia['mask'] = stadia.sta_oms.isin(['rapport naar han', 'bd naar han'])
+    timestamp_2013 =  pd.Timestamp('2013-01-01')
+    stadia['before_2013'] = stadia.begindatum < timestamp_2013
+    zaak_groups = stadia.groupby('zaak_id').groups
+    keep_ids = []
+    for zaak_id, stadia_ids in zaak_groups.items():
+        zaak_stadia = stadia.loc[stadia_ids]
+        if sum(zaak_stadia['mask']) >= 1 and sum(zaak_stadia['before_2013']) == 0:
+            keep_ids.append(zaak_id)
+    rap_zaken = zaken[zaken.zaak_id.isin(keep_ids)]
+    finished_cases = pd.concat([zl_zaken, rap_zaken], sort=True)
+    finished_cases.drop_duplicates(inplace=True)
+    finished_cases.drop(columns=['mask'], inplace=True)
+    return finished_cases
+
+
+################
+## Benchmarks ##
+################
+
+def benchmark_keep_finished_cases(n_zaken=100000):
+    """Compare the vectorized selection of finished cases with the previous loop over all cases."""
+    zaken, stadia = synthetic_zaken_stadia(n_zaken)
+
+    start = time.time()
+    expected = keep_finished_cases_loop(zaken, stadia)
+    loop_seconds = time.time() - start
+
+    # Run the step itself, without storing its result in the version store.
+    dataset = ZakenDataset()
+    dataset.data = zaken.copy()
+    start = time.time()
+    ZakenDataset.keep_finished_cases.__wrapped__(dataset, stadia)
+    vectorized_seconds = time.time() - start
+
+    result = dataset.data[zaken.columns].sort_values('zaak_id').reset_index(drop=True)
+    expected = expected[zaken.columns].sort_values('zaak_id').reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected)
+    print("keep_finished_cases (%d zaken, %d stadia): loop %.2f s, vectorized %.2f s (%.0fx faster)."
+          % (len(zaken), len(stadia), loop_seconds, vectorized_seconds, loop_seconds / vectorized_seconds))
+
+
+if __name__ == '__main__':
+    benchmark_keep_finished_cases()
@@ -17,6 +17,7 @@ Written by Swaan Dekkers & Thomas Jongstra
 import os, sys
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from collections import Counter
 
 # Import ML Methods
@@ -39,6 +40,9 @@ from imblearn.under_sampling import ClusterCentroids, RandomUnderSampler, AllKNN
 from sklearn.metrics import f1_score, fbeta_score, precision_score, recall_score, precision_recall_curve, confusion_matrix
 from imblearn.metrics import classification_report_imbalanced
 
+# Import own modules.
+from extract_features import SparseFeatures
+
 
 def split_data_train_dev_test(df):
     """
@@ -49,13 +53,13 @@ def split_data_train_dev_test(df):
     """
 
     # Split data into features (X) and labels (y).
-    X = df.drop('woonfraude', axis=1)
-    y = df.woonfraude
-    print('Original dataset shape %s' % Counter(df.woonfraude))
+    X = df.drop(columns=['woonfraude'])
+    y = df['woonfraude']
+    print('Original dataset shape %s' % Counter(y))
 
     # Split the dataset.
-    X_train, X_rest, y_train, y_rest = train_test_split(X, y, train_size=0.7, stratify=y)
-    X_dev, X_test, y_dev, y_test = train_test_split(X_rest, y_rest, train_size=0.5, stratify=y_rest)
+    X_train, X_rest, y_train, y_rest = split_rows(X, y, train_size=0.7)
+    X_dev, X_test, y_dev, y_test = split_rows(X_rest, y_rest, train_size=0.5)
 
     # Print some information about the train/dev/test set sizes.
     print('Training set shape %s' % Counter(y_train))
@@ -73,12 +77,12 @@ def split_data_train_test(df):
     """
 
     # Split data into features (X) and labels (y).
-    X = df.drop('woonfraude', axis=1)
-    y = df.woonfraude
-    print('Original dataset shape %s' % Counter(df.woonfraude))
+    X = df.drop(columns=['woonfraude'])
+    y = df['woonfraude']
+    print('Original dataset shape %s' % Counter(y))
 
     # Split the dataset.
-    X_train, X_test, y_train, y_test = train_test_split(X, y, train_size=0.85, stratify=y)
+    X_train, X_test, y_train, y_test = split_rows(X, y, train_size=0.85)
 
     # Print some information about the train/dev/test set sizes.
     print('Training set shape %s' % Counter(y_train))
@@ -87,6 +91,19 @@ def split_data_train_test(df):
     return X_train, X_test, y_train, y_test
 
 
+def split_rows(X, y, train_size):
+    """Split features (a dataframe or SparseFeatures) and labels into a stratified train set and rest set."""
+    if isinstance(X, SparseFeatures):
+        train, rest = train_test_split(np.arange(len(X)), train_size=train_size, stratify=y)
+        return X.take(train), X.take(rest), y.iloc[train], y.iloc[rest]
+    return train_test_split(X, y, train_size=train_size, stratify=y)
+
+
+def to_model_input(X):
+    """Convert features to model input. SparseFeatures are combined into a single sparse matrix."""
+    return X.to_matrix() if isinstance(X, SparseFeatures) else X
+
+
 def undersample(X_train_org, y_train_org, sampler='AllKNN', size=1000):
     """Undersample the training set data using one of various techniques."""
 
@@ -97,7 +114,7 @@ def undersample(X_train_org, y_train_org, sampler='AllKNN', size=1000):
         samp = AllKNN()
 
     # Resample the data using the selected sampler.
-    X_train, y_train = samp.fit_resample(X_train_org, y_train_org)
+    X_train, y_train = samp.fit_resample(to_model_input(X_train_org), y_train_org)
     print(sorted(Counter(y_train).items()))
 
     return X_train, y_train
@@ -126,10 +143,11 @@ def augment_data(X_train_org, y_train_org, sampler='ADASYN_TEST'):
         samp = RandomOverSampler(random_state=random_seed, n_jobs=8)
 
     # The resulting X_train and y_train are numpy arrays.
-    X_train, y_train = samp.fit_resample(X_train_org, y_train_org)
+    X_train, y_train = samp.fit_resample(to_model_input(X_train_org), y_train_org)
 
-    # Turn X_train and y_train into Pandas dataframes again.
-    X_train = pd.DataFrame(X_train, columns = X_train_org.columns)
+    # Turn X_train and y_train into Pandas dataframes again (sparse matrices are kept sparse).
+    if not sp.issparse(X_train):
+        X_train = pd.DataFrame(X_train, columns = X_train_org.columns)
     y_train = pd.Series(y_train)
 
     # Show counts
@@ -154,6 +172,9 @@ def evaluate_performance(y_pred, y_label):
 def run_knn(X_train, y_train, X_dev, y_dev, n_neighbors=11):
     """Run a KNN model. Return results"""
 
+    # Convert features to model input.
+    X_train, X_dev = to_model_input(X_train), to_model_input(X_dev)
+
     # Build KNN model using several neighbors.
     knn = KNeighborsClassifier(n_neighbors=n_neighbors)
 
@@ -172,6 +193,9 @@ def run_knn(X_train, y_train, X_dev, y_dev, n_neighbors=11):
 def run_lasso(X_train, y_train, X_dev, y_dev):
     """Run a lasso model. Return results"""
 
+    # Convert features to model input.
+    X_train, X_dev = to_model_input(X_train), to_model_input(X_dev)
+
     # Fit lasso model on training data.
     reg = LassoCV(cv=5, random_state=0).fit(X_train, y_train)
 
@@ -187,6 +211,9 @@ def run_lasso(X_train, y_train, X_dev, y_dev):
 def run_linear_svc(X_train, y_train, X_dev, y_dev):
     """Run linear support vector classification. Return results."""
 
+    # Convert features to model input.
+    X_train, X_dev = to_model_input(X_train), to_model_input(X_dev)
+
     # Fit model to training data.
     clf = LinearSVC(random_state=0, tol=1e-5, max_iter=1000)
     clf.fit(X_train, y_train)
@@ -203,7 +230,12 @@ def run_linear_svc(X_train, y_train, X_dev, y_dev):
 def run_gaussian_naive_bayes(X_train, y_train, X_dev, y_dev):
     """Run gaussian naive bayes. Return results."""
 
-    # Fit model to training data.
+    # Convert features to model input.
+    X_train, X_dev = to_model_input(X_train), to_model_input(X_dev)
+
+    # Fit model to training data. Gaussian naive bayes does not accept sparse input.
+    if sp.issparse(X_train):
+        X_train, X_dev = X_train.toarray(), X_dev.toarray()
     gnb = GaussianNB()
     gnb.fit(X_train, y_train)
 
@@ -219,6 +251,9 @@ def run_gaussian_naive_bayes(X_train, y_train, X_dev, y_dev):
 def run_decision_tree(X_train, y_train, X_dev, y_dev):
     """Run decision tree model. Return results."""
 
+    # Convert features to model input.
+    X_train, X_dev = to_model_input(X_train), to_model_input(X_dev)
+
     # Fit model to training data.
     clf = DecisionTreeClassifier(random_state=0)
     clf.fit(X_train, y_train)
@@ -236,6 +271,9 @@ def run_random_forest(X_train, y_train, X_dev, y_dev, n_estimators, max_features
     min_samples_split, bootstrap, criterion):
     """Run decision tree model. Return results."""
 
+    # Convert features to model input.
+    X_train, X_dev = to_model_input(X_train), to_model_input(X_dev)
+
     # Fit model to training data.
     clf = RandomForestClassifier(n_estimators=n_estimators, max_features=max_features,
         min_samples_leaf=min_samples_leaf, min_samples_split=min_samples_split, bootstrap=bootstrap,
@@ -255,6 +293,9 @@ def run_extra_trees(X_train, y_train, X_dev, y_dev, n_estimators, max_features,
     min_samples_split, bootstrap, criterion):
     """Run decision tree model. Return results."""
 
+    # Convert features to model input.
+    X_train, X_dev = to_model_input(X_train), to_model_input(X_dev)
+
     # Fit model to training data.
     clf = ExtraTreesClassifier(n_estimators=n_estimators, max_features=max_features,
         min_samples_leaf=min_samples_leaf, min_samples_split=min_samples_split, bootstrap=bootstrap,
@@ -13,12 +13,102 @@ Written by Swaan Dekkers & Thomas Jongstra
 #############
 
 from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import pandas as pd
+import numpy as np
+import threading
 import time
+import json
 import re
 
 
+####################
+## Validity rules ##
+####################
+
+class ValidityRule():
+    """A rule which each row of a dataframe should satisfy. The reject function gives a mask of the rows which break it."""
+
+    def __init__(self, name, reject):
+        self.name = name
+        self.reject = reject
+
+
+    def evaluate(self, df):
+        """Compute a boolean array of the rows which break the rule (missing values do not break it)."""
+        rejected = self.reject(df)
+        if isinstance(rejected, pd.Series):
+            rejected = rejected.fillna(False).values
+        return np.asarray(rejected, dtype=bool)
+
+
+class ValidityRules():
+    """
+    Evaluate a list of validity rules on a dataframe. Keeps the number of rows rejected by each rule, and
+    compact bitmaps (one bit per row) of the rejected rows, which can be used to audit the rejections. The
+    time spent per rule is kept in timings_.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+
+    def evaluate(self, df):
+        """Compute a mask of the rows which satisfy all rules (rows to keep)."""
+        self.n_rows_ = len(df)
+        self.index_ = df.index
+        self.counts_ = {}
+        self.bitmaps_ = {}
+        self.timings_ = {}
+        rejected = np.zeros(len(df), dtype=bool)
+        for rule in self.rules:
+            start = time.time()
+            rule_rejected = rule.evaluate(df)
+            self.timings_[rule.name] = time.time() - start
+            rejected |= rule_rejected
+            self.counts_[rule.name] = int(rule_rejected.sum())
+            self.bitmaps_[rule.name] = np.packbits(rule_rejected)
+        self.counts_['total'] = int(rejected.sum())
+        self.bitmaps_['total'] = np.packbits(rejected)
+        return pd.Series(~rejected, index=df.index)
+
+
+    def rejected(self, rule='total'):
+        """Get the index of the rows rejected by a rule (by default: by any rule) in the last evaluated dataframe."""
+        mask = np.unpackbits(self.bitmaps_[rule])[:self.n_rows_].astype(bool)
+        return self.index_[mask]
+
+
+    def report(self):
+        """Report the number of rows rejected by each rule."""
+        return pd.Series(self.counts_, name='rejected_rows').to_string()
+
+
+def year_at_most(col, year):
+    """Rule rejecting rows with a date in column col in or before the given year."""
+    return ValidityRule(f'{col}_year_at_most_{year}', lambda df: df[col].dt.year <= year)
+
+
+def after_today(col):
+    """Rule rejecting rows with a date in column col after today."""
+    return ValidityRule(f'{col}_after_today', lambda df: df[col] > pd.to_datetime('today'))
+
+
+def greater_than(col, other_col):
+    """Rule rejecting rows with a value in column col greater than the value in column other_col."""
+    return ValidityRule(f'{col}_greater_than_{other_col}', lambda df: df[col] > df[other_col])
+
+
+# Rules for correct begin and end dates (used by clean_dates, and as the validity rules of the zaken and stadia datasets).
+DATE_RULES = [year_at_most('begindatum', 2010),
+              after_today('begindatum'),
+              year_at_most('einddatum', 2010),
+              after_today('einddatum'),
+              greater_than('begindatum', 'einddatum')]  # begin > eind, 363 in stadia en 13 in zaken
+
+
 #######################
 ## Clean Transformer ##
 #######################
@@ -31,8 +121,11 @@ class CleanTransformer(BaseEstimator, TransformerMixin):
                  drop_duplicates: bool = True,
                  drop_columns: list = [],  # Contains list of columns to drop.
                  fix_date_columns: list = [],  # Contains list of date columns to fix.
-                 clean_dates: bool = False,
+                 dayfirst: bool = False,  # Parse ambiguous dates in fix_date_columns (e.g. 05/03/2019) with the day first.
+                 clean_dates: bool = False,  # Remove rows with incorrect dates (using DATE_RULES).
+                 validity_rules: list = [],  # Contains list of ValidityRule objects (e.g. dataset.validity_rules). Rows that break a rule are removed.
                  lower_string_columns = True,  # Contains list of columns to lower strings in. If True, all string columns are lowered.
+                 normalize_strings: bool = False,  # Lower strings using their unique values only, and make the columns categorical.
                  impute_missing_values: bool = True,  # Impute missing values in all numeric and timestamp columns using averages.
                  impute_missing_values_mode: list = [],  # Impute missing values for a list of specific columns using the mode.
                  impute_missing_values_custom: dict = {},  # impute missing values of each column defined in the key, with the value corresponding to the key.
@@ -42,8 +135,11 @@ class CleanTransformer(BaseEstimator, TransformerMixin):
         self.drop_duplicates = drop_duplicates
         self.drop_columns = drop_columns
         self.fix_date_columns = fix_date_columns
+        self.dayfirst = dayfirst
         self.clean_dates = clean_dates
+        self.validity_rules = validity_rules
         self.lower_string_columns = lower_string_columns
+        self.normalize_strings = normalize_strings
         self.impute_missing_values = impute_missing_values
         self.impute_missing_values_mode = impute_missing_values_mode
         self.impute_missing_values_custom = impute_missing_values_custom
@@ -51,58 +147,300 @@ class CleanTransformer(BaseEstimator, TransformerMixin):
 
 
     def fit(self, X, y=None):
+        """
+        Compute the imputation statistics (self.statistics_): the average of each numeric and datetime column,
+        and the mode of each column in impute_missing_values_mode. The statistics are computed on the cleaned
+        data, in a single pass. X can also be an iterable of dataframe chunks (e.g. pd.read_csv with a
+        chunksize), for data that does not fit in memory. Duplicates are then only removed within each chunk.
+        """
+        statistics = ImputationStatistics(self.impute_missing_values_mode)
+        for chunk in ([X] if isinstance(X, pd.DataFrame) else X):
+            name = getattr(chunk, 'name', None)
+            chunk = chunk.copy()
+            chunk.name = name
+            statistics.update(self._clean(chunk))
+        self.statistics_ = statistics.result()
         return self
 
 
+    def fit_transform(self, X, y=None, **fit_params):
+        """Clean X, compute the imputation statistics on the cleaned data, and impute X using them."""
+        X = self._clean(X)
+        statistics = ImputationStatistics(self.impute_missing_values_mode)
+        statistics.update(X)
+        self.statistics_ = statistics.result()
+        return self._impute(X)
+
+
     def transform(self, X):
-        if self.drop_duplicates and self.id_column:
-            drop_duplicates(X, self.id_column)
+        """
+        Perform the configured cleaning steps, and impute missing values using the statistics computed by fit.
+        The steps are combined into as few passes over the data as possible: column changes are made in place,
+        all rows to remove (duplicates and incorrect dates) are removed at once, and all missing values are
+        imputed once. The result is the same as performing the steps one by one. The time spent per configured
+        step is stored in self.timings_.
+        """
+        check_is_fitted(self, 'statistics_')
+        return self._impute(self._clean(X))
+
+
+    def save_statistics(self, path):
+        """Save the fitted imputation statistics to a json file, e.g. next to a pickled model."""
+        check_is_fitted(self, 'statistics_')
+        with open(path, 'w') as f:
+            json.dump({kind: {col: encode_statistic(value) for col, value in values.items()}
+                       for kind, values in self.statistics_.items()}, f)
+
+
+    def load_statistics(self, path):
+        """Load imputation statistics saved by save_statistics, so transform can be used without fitting."""
+        with open(path) as f:
+            self.statistics_ = {kind: {col: decode_statistic(value) for col, value in values.items()}
+                                for kind, values in json.load(f).items()}
+        return self
+
+
+    def _clean(self, X):
+        """
+        Perform the cleaning steps which precede the imputation. The time spent per configured step is stored in
+        self.timings_. The rows removed by the drop_duplicates, clean_dates and validity_rules steps are removed
+        at once, which is timed as 'remove_rows'.
+        """
+        self.timings_ = {}
+        name = getattr(X, 'name', None)
+
+        # Column pass: drop columns and convert date columns, in place.
         if len(self.drop_columns) > 0:
+            start = time.time()
             X.drop(columns=self.drop_columns, inplace=True)
+            self.timings_['drop_columns'] = time.time() - start
         if len(self.fix_date_columns) > 0:
-            fix_dates(X, self.fix_date_columns)
-        if self.clean_dates:
-            clean_dates(X)
+            start = time.time()
+            fix_dates(X, self.fix_date_columns, dayfirst=self.dayfirst)
+            self.timings_['fix_dates'] = time.time() - start
+
+        # Row pass: remove duplicates and rows which break a validity rule using one combined mask.
+        keep = pd.Series(True, index=X.index)
+        if self.drop_duplicates and self.id_column:
+            start = time.time()
+            keep &= duplicates_mask(X, self.id_column)
+            self.timings_['drop_duplicates'] = time.time() - start
+        steps = {'clean_dates': DATE_RULES if self.clean_dates else [], 'validity_rules': list(self.validity_rules)}
+        rules = list(dict.fromkeys(rule for step_rules in steps.values() for rule in step_rules))
+        if len(rules) > 0:
+            self.validity_ = ValidityRules(rules)
+            keep &= self.validity_.evaluate(X)
+            print(self.validity_.report())
+            for step, step_rules in steps.items():
+                if len(step_rules) > 0:
+                    self.timings_[step] = sum(self.validity_.timings_[rule.name] for rule in step_rules)
+        start = time.time()
+        if not keep.all():
+            if X.index.is_unique:
+                X.drop(X.index[~keep.values], inplace=True)
+            else:
+                X = X[keep.values].copy()
+                X.name = name
+        print(f"Dataframe \"%s\": Removed %s duplicate rows and rows with incorrect dates!" % (name, (~keep).sum()))
+        self.timings_['remove_rows'] = time.time() - start
+
         if self.lower_string_columns:
-            lower_strings(X)
+            start = time.time()
+            lower_strings(X, self.lower_string_columns, normalize=self.normalize_strings)
+            self.timings_['lower_strings'] = time.time() - start
+        return X
+
+
+    def _impute(self, X):
+        """
+        Collect the fill values of each imputation step, then fill the missing values of each column once. A column
+        gets the value of the first imputation step that applies to it, like when the steps are performed one by
+        one. Averages of columns without any values (NaN/NaT) do not apply, so a later step can fill those columns.
+        """
+        steps = {}
         if self.impute_missing_values:
-            impute_missing_values(X)
+            steps['impute_missing_values'] = {col: value for col, value in self.statistics_['averages'].items()
+                                              if col in X.columns and not pd.isnull(value)}
         if len(self.impute_missing_values_mode) > 0:
-            impute_missing_values_mode(X, self.impute_missing_values_mode)
+            steps['impute_missing_values_mode'] = {col: self.statistics_['modes'][col] for col in self.impute_missing_values_mode
+                                                   if col in self.statistics_['modes']}
         if len(self.impute_missing_values_custom) > 0:
-            impute_missing_values_custom(X, self.impute_missing_values_custom)
+            steps['impute_missing_values_custom'] = self.impute_missing_values_custom
         if len(self.fillna_columns) > 0:
-            X.fillna(value=self.fillna_columns)
+            steps['fillna_columns'] = self.fillna_columns
+
+        # Each column is filled by one step only, so the steps together make a single pass over the columns.
+        filled = set()
+        for step, values in steps.items():
+            start = time.time()
+            values = {col: value for col, value in values.items() if col not in filled}
+            filled.update(values)
+            if len(values) > 0:
+                fillna(X, values)
+            self.timings_[step] = time.time() - start
+        if len(filled) > 0:
+            print("Missing values in df %s have been imputed!" % getattr(X, 'name', None))
         return X
 
 
+class ImputationStatistics():
+    """
+    Accumulate the imputation statistics of a dataframe over one or more chunks: the sum and count of each
+    numeric and datetime column (for their averages), and the value counts of the mode columns.
+    """
+
+    def __init__(self, mode_columns=[]):
+        self.mode_columns = mode_columns
+        self.sums = pd.Series(dtype='float64')
+        self.counts = pd.Series(dtype='float64')
+        self.datetime_columns = set()
+        self.value_counts = {}
+
+
+    def update(self, df):
+        """Add the statistics of a chunk."""
+        numeric = df._get_numeric_data()
+        self.sums = self.sums.add(numeric.sum().astype('float64'), fill_value=0)
+        self.counts = self.counts.add(numeric.count().astype('float64'), fill_value=0)
+        for col in df.select_dtypes(include=['datetime64[ns]']):
+            # Sum the underlying Unix timestamps (as floats, like the mean of the timestamps) of non-null values.
+            unix = df[col][df[col].notnull()].values.astype('datetime64[ns]').astype('int64').astype('float64')
+            self.sums[col] = self.sums.get(col, 0) + unix.sum()
+            self.counts[col] = self.counts.get(col, 0) + len(unix)
+            self.datetime_columns.add(col)
+        for col in self.mode_columns:
+            counts = df[col].value_counts()
+            self.value_counts[col] = counts if col not in self.value_counts else \
+                                     self.value_counts[col].add(counts, fill_value=0)
+
+
+    def result(self):
+        """Compute the averages and modes from the accumulated statistics."""
+        averages = {}
+        for col in self.sums.index:
+            average = self.sums[col] / self.counts[col] if self.counts[col] > 0 else np.nan
+            averages[col] = pd.to_datetime(average) if col in self.datetime_columns else average
+        modes = {}
+        for col, counts in self.value_counts.items():
+            counts = counts[counts > 0]
+            if len(counts) > 0:
+                # Like Series.mode, the lowest of several most frequent values is used.
+                modes[col] = counts[counts == counts.max()].index.sort_values()[0]
+        return {'averages': averages, 'modes': modes}
+
+
+def encode_statistic(value):
+    """Convert a statistic to a json value. Timestamps are stored as {'datetime': isoformat}."""
+    if value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def decode_statistic(value):
+    """Convert a json value created by encode_statistic back to a statistic."""
+    if isinstance(value, dict) and 'datetime' in value:
+        return pd.Timestamp(value['datetime'])
+    return value
+
+
 def drop_duplicates(df, cols):
     """Drop duplicates in dataframe based on given column values. Print results in terminal."""
     before = df.shape[0]
-    df.drop_duplicates(subset = cols)
+    df.drop_duplicates(subset = cols, inplace=True)
     after = df.shape[0]
     duplicates = before - after
     print(f"Dataframe \"%s\": Dropped %s duplicates!" % (df.name, duplicates))
 
 
-def fix_dates(df, cols):
-    """Convert columns containing dates to datetime objects)."""
-    df[cols] = df[cols].apply(pd.to_datetime, errors='coerce')
-    print(f"Dataframe \"%s\": Fixed dates!" % df.name)
+def duplicates_mask(df, cols):
+    """Compute a mask of the rows to keep when dropping duplicates based on given column values (first ones are kept)."""
+    return ~df.duplicated(subset=cols)
 
 
-def clean_dates(df):
-    """Filter out incorrect dates."""
+def fix_dates(df, cols, dayfirst=False):
+    """
+    Convert columns containing dates to datetime objects. Only the unique values of each column are parsed, using
+    a date format inferred from a sample. Ambiguous dates like '05/03/2019' are parsed month first (May 3), like
+    pd.to_datetime does, unless dayfirst is True (March 5). Returns the number of values per column which could not
+    be parsed (NaT).
+    """
+    nat_counts = {}
+    for col in cols:
+        df[col], nat_counts[col] = parse_dates(df[col], dayfirst=dayfirst)
+    print(f"Dataframe \"%s\": Fixed dates! Values that could not be parsed: %s" % (df.name, nat_counts))
+    return nat_counts
+
+
+# Unambiguous date formats which are tried (in order) when inferring the format of a date column.
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y%m%d']
+
+# Date formats which are tried next, with the day first (dayfirst=True) or with the month first.
+DAYFIRST_DATE_FORMATS = ['%d-%m-%Y', '%d-%m-%Y %H:%M:%S', '%d/%m/%Y', '%d/%m/%Y %H:%M:%S']
+MONTHFIRST_DATE_FORMATS = ['%m-%d-%Y', '%m-%d-%Y %H:%M:%S', '%m/%d/%Y', '%m/%d/%Y %H:%M:%S']
+
+
+# Values parsed with an inferred date format, per (date format, dayfirst), shared by all columns and datasets. Only
+# values which match the format are kept: these parse the same whatever other values are in a column. Values parsed
+# without a format (the fallback) are not kept.
+_parsed_dates = {}
+_parsed_dates_lock = threading.Lock()
+MAX_PARSED_DATES = 1000000
+
+
+def parse_dates(col, sample_size=1000, dayfirst=False):
+    """
+    Convert a column to datetimes, by parsing its unique values once and broadcasting the results to all rows.
+    Values matching the inferred format are looked up in (and added to) a cache shared by all columns. Values that
+    do not match the format are parsed without a format, using the same dayfirst setting.
+    Returns the converted column and the number of values which could not be parsed (became NaT).
+    """
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col, 0
+    codes, uniques = pd.factorize(col)
+    uniques = pd.Series(np.asarray(uniques, dtype=object), dtype=object)
+    date_format = infer_date_format(uniques[:sample_size], dayfirst)
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+    if date_format is not None:
+        with _parsed_dates_lock:
+            known = _parsed_dates.setdefault((date_format, dayfirst), {})
+            cached = pd.Series([known.get(value) for value in uniques], index=uniques.index, dtype=object)
+        hit = cached.notnull()
+        parsed[hit] = pd.to_datetime(cached[hit])
+        parsed[~hit] = pd.to_datetime(uniques[~hit], format=date_format, errors='coerce')
+        matched = ~hit & parsed.notnull()
+        with _parsed_dates_lock:
+            if len(known) + matched.sum() > MAX_PARSED_DATES:
+                known.clear()
+            known.update(zip(uniques[matched], parsed[matched]))
+    failed = parsed.isnull()
+    if failed.any():
+        parsed[failed] = pd.to_datetime(uniques[failed], dayfirst=dayfirst, errors='coerce')
+
+    # Broadcast the parsed unique values to all rows. Missing values (code -1) get the appended NaT.
+    values = np.append(parsed.values, np.datetime64('NaT'))[codes]
+    dates = pd.Series(values, index=col.index, name=col.name)
+    return dates, int(parsed.isnull().values[codes[codes >= 0]].sum())
+
+
+def infer_date_format(sample, dayfirst=False):
+    """
+    Find the date format which can parse most values of a sample: one of DATE_FORMATS, or of DAYFIRST_DATE_FORMATS
+    (with dayfirst) or MONTHFIRST_DATE_FORMATS (without). Returns None if none can parse any.
+    """
+    sample = pd.Series(sample, dtype=object)
+    date_formats = DATE_FORMATS + (DAYFIRST_DATE_FORMATS if dayfirst else MONTHFIRST_DATE_FORMATS)
+    counts = [pd.to_datetime(sample, format=date_format, errors='coerce').notnull().sum() for date_format in date_formats]
+    return date_formats[int(np.argmax(counts))] if max(counts) > 0 else None
+
+
+def clean_dates(df, rules=DATE_RULES):
+    """Filter out incorrect dates. Optionally use another list of ValidityRule objects, e.g. dataset.validity_rules."""
     before = df.shape[0]
-    today = pd.to_datetime('today')
-    year = 2010
-    l1 = df[df['begindatum'].dt.year <= year].index.tolist()
-    l2 = df[df['begindatum'] > today].index.tolist()
-    l3 = df[df['einddatum'].dt.year <= year].index.tolist()
-    l4 = df[df['einddatum'] > today].index.tolist()
-    l5 = df[df['begindatum'] > df['einddatum']].index.tolist() # begin > eind, 363 in stadia en 13 in zaken
-    ltot = list(set().union(l1,l2,l3,l4,l5))
-    df.drop(ltot, inplace=True)
+    df.drop(df.index[~clean_dates_mask(df, rules).values], inplace=True)
 
     # Print info about number of removed rows.
     after = df.shape[0]
@@ -110,19 +448,65 @@ def clean_dates(df):
     print(f"Dataframe \"%s\": Cleaned out %s dates!" % (df.name, removed))
 
 
-def lower_strings(df, cols=True):
-    """Convert all strings in given columns to lowercase. Type remains Object (Pandas standard)."""
+def clean_dates_mask(df, rules=DATE_RULES):
+    """Compute a mask of the rows with correct dates (rows to keep), using a list of ValidityRule objects."""
+    return ValidityRules(rules).evaluate(df)
+
+
+def lower_strings(df, cols=True, normalize=False, strip=False, fold_accents=False, n_jobs=4):
+    """
+    Convert all strings in given columns to lowercase. Type remains Object (or Categorical for categorical columns).
+    With normalize set to True, only the unique values of each column are lowered (and optionally stripped and/or
+    accent-folded), and all columns become categorical. The columns are then processed in parallel by n_jobs threads.
+    """
     if cols == True:  # By default, select all eligible columns perform string-lowering on.
         cols = df.columns
-        cols = [col for col in cols if df[col].dtype == object]
-    for col in cols:
-        df[col] = df[col].str.lower()
+        cols = [col for col in cols if df[col].dtype == object or is_string_categorical(df[col])]
+    if normalize:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            normalized = executor.map(lambda col: normalize_strings(df[col], strip, fold_accents), cols)
+            for col, values in zip(cols, list(normalized)):
+                df[col] = values
+    else:
+        for col in cols:
+            if is_string_categorical(df[col]):
+                df[col] = normalize_strings(df[col])
+            else:
+                df[col] = df[col].str.lower()
     print("Lowered strings of cols %s in df %s!" % (cols, df.name))
 
 
+def normalize_strings(col, strip=False, fold_accents=False):
+    """
+    Convert the strings in a column to lowercase (and optionally strip whitespace and remove accents), by only
+    converting its unique values. Returns a categorical column. Values that become equal share a category.
+    """
+    if col.dtype.name == 'category':
+        codes, uniques = col.cat.codes.values, col.cat.categories
+    else:
+        codes, uniques = pd.factorize(col)
+    normalized = pd.Series(uniques, dtype=object).str.lower()
+    if strip:
+        normalized = normalized.str.strip()
+    if fold_accents:
+        normalized = normalized.str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('ascii')
+    categories = pd.Index(normalized.dropna().unique())
+    # Map the codes of the unique values to the new categories. Missing values (code -1) stay missing.
+    unique_codes = np.append(categories.get_indexer(normalized), -1)
+    return pd.Series(pd.Categorical.from_codes(unique_codes[codes], categories), index=col.index, name=col.name)
+
+
 def impute_missing_values(df):
     """Impute missing values in each column (using column averages)."""
 
+    # Impute missing values by using the column averages.
+    df.fillna(value=compute_averages(df), inplace=True)
+    print("Missing values in df %s have been imputed!" % (df.name))
+
+
+def compute_averages(df):
+    """Compute the average of each numeric and datetime column."""
+
     # Compute averages per column (only for numeric columns, so not for dates or strings)
     averages = dict(df._get_numeric_data().mean())
 
@@ -137,9 +521,23 @@ def impute_missing_values(df):
         # Put value in averages column
         averages[col] = mean_datetime
 
-    # Impute missing values by using the column averages.
-    df.fillna(value=averages, inplace=True)
-    print("Missing values in df %s have been imputed!" % (df.name))
+    return averages
+
+
+def is_string_categorical(col):
+    """Check whether a column is categorical, with string categories."""
+    return col.dtype.name == 'category' and pd.api.types.is_string_dtype(col.cat.categories)
+
+
+def fillna(df, values):
+    """
+    Fill missing values in place, with a value per column (like DataFrame.fillna). Fill values that are not
+    yet a category of a categorical column are added as a category first.
+    """
+    for col, value in values.items():
+        if col in df.columns and df[col].dtype.name == 'category' and value not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories([value])
+    df.fillna(value=values, inplace=True)
 
 
 def impute_missing_values_mode(df, cols):
@@ -154,11 +552,11 @@ def impute_missing_values_mode(df, cols):
         modes[col] = mode  # Add to dictionary.
 
     # Impute missing values by using the columns modes.
-    df.fillna(value=modes, inplace=True)
+    fillna(df, modes)
     print("Missing values (using mode) of cols %s in df %s have been imputed!" % (cols, df.name))
 
 
 def impute_missing_values_custom(df, col_dict):
     """Impute the missing values of each column defined in the dict keys, with the corresponding dict value."""
-    df.fillna(value=col_dict, inplace=True)
+    fillna(df, col_dict)
     print("Missing values (using custom strategy) of cols %s in df %s have been imputed!" % (str(list(col_dict.keys())), df.name))
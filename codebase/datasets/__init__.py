@@ -1,4 +1,9 @@
-from .datasets import MyDataset, download_dataset, apply_bag_colname_fix, add_column, save_dataset, load_dataset
+from .datasets import MyDataset, step, write_checkpoint, wait_for_checkpoints, download_dataset, download_datasets, stream_dataset, apply_bag_colname_fix, add_column, add_columns, save_dataset, load_dataset, get_version_store, get_reference_cache, get_reference_table, get_feature_store
+from .version_store import VersionStore
+from .lazy_frame import LazyFrame
+from .reference_cache import ReferenceCache
+from .feature_store import FeatureStore
+from .address_matcher import AddressMatcher
 from .stadia_dataset import StadiaDataset
 from .zaken_dataset import ZakenDataset
 from .bag_dataset import BagDataset
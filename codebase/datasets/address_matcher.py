@@ -0,0 +1,144 @@
+####################################################################################################
+"""
+address_matcher.py
+
+This module implements matching of addresses (e.g. from BWV) to BAG objects, using hash indices
+over the BAG address keys. An address is matched in the following way:
+
+- 'direct': the street and house number match exactly one BAG object.
+- 'multiple': the street and house number match several BAG objects, of which one (or more) also
+  matches the house letter and house number addition. When there are several, the BAG object with
+  the lowest status_coordinaat_code is used (the oldest object with a definitive point).
+- 'unresolved': the street and house number match several BAG objects, but none also match the
+  house letter and house number addition.
+- 'none': the street and house number match no BAG object.
+
+Addresses with a missing key value are never matched. Optionally, the street, house letter and house
+number addition are normalized before matching (lowercased, stripped and accent-folded, see
+clean.normalize_strings), so differences in case, spacing and accents do not prevent a match.
+
+All addresses of a dataframe are matched in a few vectorized lookups. Single addresses can be matched as well (e.g. for matching incoming
+addresses in real time), using the same indices.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+#############
+## Imports ##
+#############
+
+import pandas as pd
+import numpy as np
+
+# Import own modules.
+import clean
+
+
+#####################
+## Matcher classes ##
+#####################
+
+class AddressMatcher():
+    """Match addresses to BAG objects, using hash indices over (street, number) and (street, number, letter, addition)."""
+
+    # Key columns in the BAG data: street, house number, house letter and house number addition.
+    bag_keys = ['_openbare_ruimte_naam_nummeraanduiding', 'huisnummer_nummeraanduiding',
+                'huisletter_nummeraanduiding', 'huisnummer_toevoeging_nummeraanduiding']
+    # Column used to choose between several matching BAG objects (lowest first).
+    order_column = 'status_coordinaat_code'
+
+
+    def __init__(self, bag, normalize=False):
+        self.normalize = normalize
+        # Sort on preference, so the first BAG object of each key is the preferred match.
+        if self.order_column in bag.columns:
+            bag = bag.sort_values(self.order_column, kind='mergesort')
+        self.bag = bag.reset_index(drop=True)
+        keys = pd.DataFrame({col: self._normalize(self.bag[col]) for col in self.bag_keys})
+        complete = keys[self.bag_keys[:2]].notnull().all(axis=1).values
+        positions = np.flatnonzero(complete)
+
+        # Index over (street, number): number of BAG objects, and the preferred object for each key.
+        short_keys = pd.MultiIndex.from_arrays([keys[col].values[positions] for col in self.bag_keys[:2]])
+        self.counts = pd.Series(1, index=short_keys).groupby(level=[0, 1]).size()
+        first = ~short_keys.duplicated()
+        self.short_index = pd.Series(positions[first], index=short_keys[first])
+
+        # Index over (street, number, letter, addition): the preferred object for each key.
+        complete = complete & keys[self.bag_keys[2:]].notnull().all(axis=1).values
+        positions = np.flatnonzero(complete)
+        full_keys = pd.MultiIndex.from_arrays([keys[col].values[positions] for col in self.bag_keys])
+        first = ~full_keys.duplicated()
+        self.full_index = pd.Series(positions[first], index=full_keys[first])
+
+        self.match_counts = {}
+
+
+    def match(self, adres, keys=['sttnaam', 'hsnr', 'hsltr', 'toev']):
+        """
+        Find the matching BAG object for each address in a dataframe, using the given key columns (street,
+        number, letter, addition). Returns the position of the matching object in self.bag for each
+        address (-1 if there is none), and the match type of each address. Counts per match type are
+        stored in self.match_counts.
+        """
+        values = [self._normalize(adres[col]).values for col in keys]
+        complete_short = adres[keys[:2]].notnull().all(axis=1).values
+        complete_full = complete_short & adres[keys[2:]].notnull().all(axis=1).values
+
+        # Look up all addresses in the (street, number) index.
+        short_keys = pd.MultiIndex.from_arrays(values[:2])
+        counts = np.where(complete_short, self.counts.reindex(short_keys).fillna(0).values, 0)
+        direct = self.short_index.reindex(short_keys).values
+
+        # Look up the addresses with multiple candidates in the (street, number, letter, addition) index.
+        full_keys = pd.MultiIndex.from_arrays(values)
+        exact = self.full_index.reindex(full_keys).values
+
+        positions = np.full(len(adres), -1)
+        match_types = np.full(len(adres), 'none', dtype=object)
+        is_direct = counts == 1
+        is_multiple = (counts > 1) & complete_full & ~np.isnan(exact)
+        positions[is_direct] = direct[is_direct]
+        positions[is_multiple] = exact[is_multiple]
+        match_types[is_direct] = 'direct'
+        match_types[is_multiple] = 'multiple'
+        match_types[(counts > 1) & ~is_multiple] = 'unresolved'
+
+        self.match_counts = pd.Series(match_types).value_counts().reindex(
+            ['direct', 'multiple', 'unresolved', 'none'], fill_value=0).to_dict()
+        return positions, match_types
+
+
+    def match_one(self, street, number, letter=None, addition=None):
+        """Find the matching BAG object (as a Series) for a single address. Returns None if there is no match."""
+        if pd.isnull(street) or pd.isnull(number):
+            return None
+        street, letter, addition = [self._normalize(pd.Series([value], dtype=object))[0] for value in [street, letter, addition]]
+        count = self.counts.get((street, number), 0)
+        if count == 1:
+            return self.bag.iloc[self.short_index[(street, number)]]
+        if count > 1 and not pd.isnull(letter) and not pd.isnull(addition):
+            position = self.full_index.get((street, number, letter, addition))
+            if position is not None:
+                return self.bag.iloc[position]
+        return None
+
+
+    def _normalize(self, col):
+        """Normalize a key column, if normalization is enabled. Numeric columns (e.g. the house number) are not changed."""
+        if not self.normalize or pd.api.types.is_numeric_dtype(col):
+            return col
+        return clean.normalize_strings(col, strip=True, fold_accents=True)
+
+
+    def merge(self, adres, keys=['sttnaam', 'hsnr', 'hsltr', 'toev']):
+        """
+        Add the columns of the matching BAG object to each address. Columns that are already in the
+        adres dataframe are kept as they are. Addresses without a match get missing values.
+        """
+        positions, _ = self.match(adres, keys)
+        bag_columns = [col for col in self.bag.columns if col not in adres.columns]
+        matched = self.bag[bag_columns].reindex(positions)  # Position -1 is not in the bag index, giving missing values.
+        matched.index = adres.index
+        return pd.concat([adres, matched], axis=1)
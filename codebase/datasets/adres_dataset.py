@@ -25,6 +25,7 @@ import re
 
 # Import own modules.
 import datasets, clean
+from .address_matcher import AddressMatcher
 
 # Define HOME and DATA_PATH on a global level.
 HOME = Path.home()  # Home path for old VAO.
@@ -46,19 +47,17 @@ class AdresDataset(datasets.MyDataset):
     id_column = 'adres_id'
 
 
+    @datasets.step('_leegstand')
     def extract_leegstand(self):
         """Create a column indicating leegstand (no inhabitants on the address)."""
-        self.data['leegstand'] = ~self.data.inwnrs.notnull()
-        self.version += '_leegstand'
-        self.save()
+        self['leegstand'] = ~self['inwnrs'].notnull()
 
 
+    @datasets.step('_woningId', reference_tables=['bwv_adres_periodes'])
     def enrich_with_woning_id(self):
         """Add woning ids to the adres dataframe."""
-        adres_periodes = datasets.download_dataset('bwv_adres_periodes', 'bwv_adres_periodes')
-        self.data = self.data.merge(adres_periodes[['ads_id', 'wng_id']], how='left', left_on='adres_id', right_on='ads_id')
-        self.version += '_woningId'
-        self.save()
+        adres_periodes = datasets.get_reference_table('bwv_adres_periodes', columns=['ads_id', 'wng_id'])
+        self.data = self.data.merge(adres_periodes, how='left', left_on='adres_id', right_on='ads_id')
 
 
     def prepare_bag(self, bag):
@@ -98,27 +97,13 @@ class AdresDataset(datasets.MyDataset):
 
 
     def match_bwv_bag(self, adres, bag):
-        # Merge dataframes on adres dataframe.
-        new_df = pd.merge(adres, bag,  how='left', left_on=['sttnaam','hsnr'], right_on = ['_openbare_ruimte_naam_nummeraanduiding', 'huisnummer_nummeraanduiding'])
-
-        # Find id's that have a direct match and that have multiple matches.
-        g = new_df.groupby('adres_id')
-        df_direct = g.filter(lambda x: len(x) == 1)
-        df_multiple = g.filter(lambda x: len(x) > 1)
-
-        # Make multiplematch more specific to construct perfect match.
-        df_multiple = df_multiple[(df_multiple['hsltr'] == df_multiple['huisletter_nummeraanduiding']) & (df_multiple['toev'] == df_multiple['huisnummer_toevoeging_nummeraanduiding'])]
-
-        # Concat df_direct and df_multiple.
-        df_result = pd.concat([df_direct, df_multiple])
-
-        # Because of the seperation of an object, there are two matching objects. Keep the oldest object with definif point.
-        df_result = df_result.sort_values(['adres_id', 'status_coordinaat_code'])
-        df_result = df_result.drop_duplicates(subset='adres_id', keep='first')
-
-        # Add adresses without match.
-        final_df = pd.merge(adres, df_result,  how='left', on='adres_id', suffixes=('', '_y'))
-        final_df.drop(list(final_df.filter(regex='_y$')), axis=1, inplace=True)
+        """
+        Add the matching BAG object to each address. Matches on street and house number, and on house letter
+        and house number addition when several BAG objects share the same street and house number.
+        """
+        matcher = AddressMatcher(bag)
+        final_df = matcher.merge(adres, keys=['sttnaam', 'hsnr', 'hsltr', 'toev'])
+        print(f"Matched addresses to BAG objects: {matcher.match_counts}")
 
         # Set the name of the final adres dataframe again.
         final_df.name = 'adres'
@@ -130,20 +115,21 @@ class AdresDataset(datasets.MyDataset):
         """Impute values for adresses where no BAG-match could be found."""
         clean.impute_missing_values(adres)
         # clean.impute_missing_values_mode(adres, ['status_coordinaat_code@bag'])
-        adres.fillna(value={'huisnummer_nummeraanduiding': 0,
-                            'huisletter_nummeraanduiding': 'None',
-                            '_openbare_ruimte_naam_nummeraanduiding': 'None',
-                            'huisnummer_toevoeging_nummeraanduiding': 'None',
-                            'type_woonobject_omschrijving': 'None',
-                            'eigendomsverhouding_id': 'None',
-                            'financieringswijze_id': -1,
-                            'gebruik_id': -1,
-                            'reden_opvoer_id': -1,
-                            'status_id_verblijfsobject': -1,
-                            'toegang_id': 'None'}, inplace=True)
+        clean.fillna(adres, {'huisnummer_nummeraanduiding': 0,
+                             'huisletter_nummeraanduiding': 'None',
+                             '_openbare_ruimte_naam_nummeraanduiding': 'None',
+                             'huisnummer_toevoeging_nummeraanduiding': 'None',
+                             'type_woonobject_omschrijving': 'None',
+                             'eigendomsverhouding_id': 'None',
+                             'financieringswijze_id': -1,
+                             'gebruik_id': -1,
+                             'reden_opvoer_id': -1,
+                             'status_id_verblijfsobject': -1,
+                             'toegang_id': 'None'})
         return adres
 
 
+    @datasets.step('_bag')
     def enrich_with_bag(self, bag):
         """Enrich the adres data with information from the BAG data. Uses the bag dataframe as input."""
         bag = self.prepare_bag(bag)
@@ -151,138 +137,41 @@ class AdresDataset(datasets.MyDataset):
         self.data = self.match_bwv_bag(self.data, bag)
         self.data = self.replace_string_nan_adres(self.data)
         self.data = self.impute_values_for_bagless_addresses(self.data)
-        self.version += '_bag'
-        self.save()
         print("The adres dataset is now enriched with BAG data.")
 
 
+    @datasets.step('_personen')
     def enrich_with_personen_features(self, personen):
         """Add aggregated features relating to persons to the address dataframe. Uses the personen dataframe as input."""
 
-        # Create simple handle to the adres data.
-        adres = self.data
-
-        # Compute age of people in years (float)
-        today = pd.to_datetime('today')
-        # Set all dates within range allowed by Pandas (584 years?)
-        personen['geboortedatum'] = pd.to_datetime(personen['geboortedatum'], errors='coerce')
-
-
-        # Get the most frequent birthdate (mode).
-        geboortedatum_mode = personen['geboortedatum'].mode()[0]
-        # Compute the age (result is a TimeDelta).
-        personen['leeftijd'] = today - personen['geboortedatum']
-        # Convert the age to an approximation in years ("smearin out" the leap years).
-        personen['leeftijd'] = personen['leeftijd'].apply(lambda x: x.days / 365.25)
-
-        # Find the matching address ids between the adres df and the personen df.
-        adres_ids = adres.adres_id
-        personen_adres_ids = personen.ads_id_wa
-        intersect = set(adres_ids).intersection(set(personen_adres_ids))
-
-        # Iterate over all matching address ids and find all people at each address.
-        inhabitant_locs = {}
-        print("Now looping over all address ids that have a link with one or more inhabitants...")
-        for i, adres_id in enumerate(intersect):
-            if i % 1000 == 0:
-                print(i)
-            inhabitant_locs[adres_id] = personen_adres_ids[personen_adres_ids == adres_id]
-
-        # Create a new column in the dataframe showing the amount of people at each address.
-        # TODO: this step currently takes a few minutes to complete, should still be optimized.
-        adres['aantal_personen'] = 0
-        adres['aantal_vertrokken_personen'] = -1
-        adres['aantal_overleden_personen'] = -1
-        adres['aantal_niet_uitgeschrevenen'] = -1
-        adres['leegstand'] = True
-        adres['leeftijd_jongste_persoon'] = -1.
-        adres['leeftijd_oudste_persoon'] = -1.
-        adres['aantal_kinderen'] = 0
-        adres['percentage_kinderen'] = -1.
-        adres['aantal_mannen'] = 0
-        adres['percentage_mannen'] = -1.
-        adres['gemiddelde_leeftijd'] = -1.
-        adres['stdev_leeftijd'] = -1.
-        adres['aantal_achternamen'] = 0
-        adres['percentage_achternamen'] = -1.
-        for i in range(1,8):
-            adres[f'gezinsverhouding_{i}'] = 0
-            adres[f'percentage_gezinsverhouding_{i}'] = 0.
-        print("Now looping over all rows in the adres dataframe in order to add person information...")
-        for i in adres.index:
-            if i % 1000 == 0:
-                print(i)
-            row = adres.iloc[i]
-            adres_id = row['adres_id']
-            try:
-                # Get the inhabitants for the current address.
-                inhab_locs = inhabitant_locs[adres_id].keys()
-                inhab = personen.loc[inhab_locs]
-
-                # Check whether any registered inhabitants have left Amsterdam or have passed away.
-                aantal_vertrokken_personen = sum(inhab["vertrekdatum_adam"].notnull())
-                aantal_overleden_personen = sum(inhab["overlijdensdatum"].notnull())
-                aantal_niet_uitgeschrevenen = len(inhab[inhab["vertrekdatum_adam"].notnull() | inhab["overlijdensdatum"].notnull()])
-                adres['aantal_vertrokken_personen'] = aantal_vertrokken_personen
-                adres['aantal_overleden_personen'] = aantal_overleden_personen
-                adres['aantal_niet_uitgeschrevenen'] = aantal_niet_uitgeschrevenen
-                # If there are more inhabitants than people that are incorrectly still registered, then there is no 'leegstand'.
-                if len(inhab) > aantal_niet_uitgeschrevenen:
-                    adres['leegstand'] = False
-
-                # Totaal aantal personen (int).
-                aantal_personen = len(inhab)
-                adres.at[i, 'aantal_personen'] = aantal_personen
-
-                # Leeftijd jongste persoon (float).
-                leeftijd_jongste_persoon = min(inhab['leeftijd'])
-                adres.at[i, 'leeftijd_jongste_persoon'] = leeftijd_jongste_persoon
-
-                # Leeftijd oudste persoon (float).
-                leeftijd_oudste_persoon = max(inhab['leeftijd'])
-                adres.at[i, 'leeftijd_oudste_persoon'] = leeftijd_oudste_persoon
-
-                # Aantal kinderen ingeschreven op adres (int/float).
-                aantal_kinderen = sum(inhab['leeftijd'] < 18)
-                adres.at[i, 'aantal_kinderen'] = aantal_kinderen
-                adres.at[i, 'percentage_kinderen'] = aantal_kinderen / aantal_personen
-
-                # Aantal mannen (int/float).
-                aantal_mannen = sum(inhab.geslacht == 'M')
-                adres.at[i, 'aantal_mannen'] = aantal_mannen
-                adres.at[i, 'percentage_mannen'] = aantal_mannen / aantal_personen
-
-                # Gemiddelde leeftijd (float).
-                gemiddelde_leeftijd = inhab.leeftijd.mean()
-                adres.at[i, 'gemiddelde_leeftijd'] = gemiddelde_leeftijd
-
-                # Standardeviatie van leeftijd (float). Set to 0 when the sample size is 1.
-                stdev_leeftijd = inhab.leeftijd.std()
-                adres.at[i, 'stdev_leeftijd'] = stdev_leeftijd if aantal_personen > 1 else 0
-
-                # Aantal verschillende achternamen (int/float).
-                aantal_achternamen = inhab.naam.nunique()
-                adres.at[i, 'aantal_achternamen'] = aantal_achternamen
-                adres.at[i, 'percentage_achternamen'] = aantal_achternamen / aantal_personen
-
-                # Gezinsverhouding (frequency count per klasse) (int/float).
-                gezinsverhouding = inhab.gezinsverhouding.value_counts()
-                for key in gezinsverhouding.keys():
-                    val = gezinsverhouding[key]
-                    adres.at[i, f'gezinsverhouding_{key}'] = val
-                    adres.at[i, f'percentage_gezinsverhouding_{key}'] = val / aantal_personen
-
-            except (KeyError, ValueError) as e:
-                pass
+        # Compute all person features per address in one grouped aggregation over the personen data.
+        print("Now aggregating person information per address...")
+        features = aggregate_personen_features(personen)
+
+        # Remove columns that will be recomputed (e.g. 'leegstand', which is created by extract_leegstand).
+        adres = self.data.drop(columns=[col for col in features.columns if col in self.data.columns])
+
+        # Merge the aggregated features back onto the adres dataframe in a single join.
+        adres = adres.merge(features, how='left', left_on='adres_id', right_index=True)
+
+        # Set default values for addresses without any registered inhabitants.
+        no_inhabitants = ~adres['adres_id'].isin(features.index)
+        for col in features.columns:
+            adres.loc[no_inhabitants, col] = PERSONEN_FEATURE_DEFAULTS.get(col, 0)
 
+        # Restore the integer and boolean column types (the left join introduces NaN values).
+        for col in features.columns:
+            if col == 'leegstand':
+                adres[col] = adres[col].astype(bool)
+            elif not col.startswith(('percentage_', 'leeftijd_', 'gemiddelde_', 'stdev_')):
+                adres[col] = adres[col].astype(int)
         print("...done!")
 
         self.data = adres
-        self.version += '_personen'
-        self.save()
         print("The adres dataset is now enriched with personen data.")
 
 
+    @datasets.step('_hotline')
     def add_hotline_features(self, hotline):
         """Add the hotline features to the adres dataframe."""
         # Create a temporary merged df using the adres and hotline dataframes.
@@ -296,6 +185,117 @@ class AdresDataset(datasets.MyDataset):
         hotline_counts.columns = ['aantal_hotline_meldingen']
         # Enrich the 'adres' dataframe with the computed hotline counts.
         self.data = self.data.merge(hotline_counts, on='adres_id', how='left')
-        self.version += '_hotline'
-        self.save()
-        print("The adres dataset is now enriched with hotline data.")
\ No newline at end of file
+        print("The adres dataset is now enriched with hotline data.")
+
+
+    def after_step(self, step_name, columns_before):
+        """
+        Store the features added by an enrichment step in the feature store. This is done outside of the step
+        itself, so the store is also filled when the result of the step is loaded from the version store.
+        """
+        if step_name not in FEATURE_SETS:
+            return
+        columns = [col for col in self.columns if col not in columns_before]
+        if step_name == 'enrich_with_personen_features':
+            # Features which already existed (e.g. 'leegstand') are recomputed by the step.
+            columns = [col for col in self.columns if col in columns or col in PERSONEN_FEATURE_DEFAULTS]
+        self.store_features(FEATURE_SETS[step_name], columns)
+
+
+    def store_features(self, name, columns):
+        """
+        Store enriched features in the feature store (see feature_store.py), for fast lookups per address.
+        The feature set is not written again when it was already stored from the current version.
+        """
+        store = datasets.get_feature_store()
+        if self.key is not None and store.version(name) == self.key:
+            return
+        store.write(name, self[[self.id_column] + columns], key_column=self.id_column, version=self.key)
+
+
+######################
+## Helper functions ##
+######################
+
+# Feature sets in the feature store, by the name of the enrichment step which adds them.
+FEATURE_SETS = {'enrich_with_bag': 'bag', 'enrich_with_personen_features': 'personen', 'add_hotline_features': 'hotline'}
+
+# Feature values for addresses that have no registered inhabitants. Missing keys default to 0.
+PERSONEN_FEATURE_DEFAULTS = {'aantal_personen': 0,
+                             'aantal_vertrokken_personen': -1,
+                             'aantal_overleden_personen': -1,
+                             'aantal_niet_uitgeschrevenen': -1,
+                             'leegstand': True,
+                             'leeftijd_jongste_persoon': -1.,
+                             'leeftijd_oudste_persoon': -1.,
+                             'aantal_kinderen': 0,
+                             'percentage_kinderen': -1.,
+                             'aantal_mannen': 0,
+                             'percentage_mannen': -1.,
+                             'gemiddelde_leeftijd': -1.,
+                             'stdev_leeftijd': -1.,
+                             'aantal_achternamen': 0,
+                             'percentage_achternamen': -1.}
+
+
+def aggregate_personen_features(personen):
+    """
+    Compute aggregated person features for each address id in the personen dataframe.
+    Returns a dataframe indexed by address id (personen.ads_id_wa), with one column per feature.
+    """
+
+    # Compute age of people in years (float). Convert to an approximation in years ("smearing out" the leap years).
+    today = pd.to_datetime('today')
+    geboortedatum = pd.to_datetime(personen['geboortedatum'], errors='coerce')
+    leeftijd = (today - geboortedatum).dt.days / 365.25
+
+    # Create indicator columns, so that all counts can be computed as sums within a single groupby.
+    vertrokken = personen['vertrekdatum_adam'].notnull()
+    overleden = personen['overlijdensdatum'].notnull()
+    personen_features = pd.DataFrame({'ads_id_wa': personen['ads_id_wa'],
+                                      'leeftijd': leeftijd,
+                                      'vertrokken': vertrokken,
+                                      'overleden': overleden,
+                                      'niet_uitgeschreven': vertrokken | overleden,
+                                      'kind': leeftijd < 18,
+                                      'man': personen['geslacht'] == 'M',
+                                      'naam': personen['naam'],
+                                      'gezinsverhouding': personen['gezinsverhouding']})
+    groups = personen_features.groupby('ads_id_wa', observed=True)
+    sums = groups[['vertrokken', 'overleden', 'niet_uitgeschreven', 'kind', 'man']].sum()
+    leeftijden = groups['leeftijd'].agg(['min', 'max', 'mean', 'std'])
+    aantal_personen = groups.size()
+    aantal_achternamen = groups['naam'].nunique()
+
+    # Combine all aggregates into a single feature dataframe.
+    features = pd.DataFrame(index=aantal_personen.index)
+    features['aantal_personen'] = aantal_personen
+    features['aantal_vertrokken_personen'] = sums['vertrokken']
+    features['aantal_overleden_personen'] = sums['overleden']
+    features['aantal_niet_uitgeschrevenen'] = sums['niet_uitgeschreven']
+    # If there are more inhabitants than people that are incorrectly still registered, then there is no 'leegstand'.
+    features['leegstand'] = ~(aantal_personen > sums['niet_uitgeschreven'])
+    features['leeftijd_jongste_persoon'] = leeftijden['min']
+    features['leeftijd_oudste_persoon'] = leeftijden['max']
+    features['aantal_kinderen'] = sums['kind']
+    features['percentage_kinderen'] = sums['kind'] / aantal_personen
+    features['aantal_mannen'] = sums['man']
+    features['percentage_mannen'] = sums['man'] / aantal_personen
+    features['gemiddelde_leeftijd'] = leeftijden['mean']
+    # Standard deviation of the age is set to 0 when the sample size is 1.
+    features['stdev_leeftijd'] = leeftijden['std'].where(aantal_personen > 1, 0.)
+    features['aantal_achternamen'] = aantal_achternamen
+    features['percentage_achternamen'] = aantal_achternamen / aantal_personen
+
+    # Gezinsverhouding (frequency count per klasse), pivoted to one column per klasse.
+    gezinsverhouding = personen_features.groupby(['ads_id_wa', 'gezinsverhouding'], observed=True).size().unstack(fill_value=0)
+    gezinsverhouding = gezinsverhouding.reindex(features.index, fill_value=0)
+    gezinsverhouding.columns = [int(key) if isinstance(key, float) and key.is_integer() else key
+                                for key in gezinsverhouding.columns]
+    klassen = list(range(1, 8)) + [key for key in gezinsverhouding.columns if key not in range(1, 8)]
+    for key in klassen:
+        counts = gezinsverhouding[key] if key in gezinsverhouding.columns else 0
+        features[f'gezinsverhouding_{key}'] = counts
+        features[f'percentage_gezinsverhouding_{key}'] = counts / aantal_personen
+
+    return features
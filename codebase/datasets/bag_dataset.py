@@ -25,6 +25,7 @@ import re
 
 # Import own modules.
 import datasets
+from .datasets import BAG_MERGE_COLUMNS, BAG_DROP_COLUMNS
 
 # Define HOME and DATA_PATH on a global level.
 HOME = Path.home()  # Home path for old VAO.
@@ -44,35 +45,27 @@ class BagDataset(datasets.MyDataset):
     name = 'bag'
     table_name = 'bag_nummeraanduiding'
     id_column = 'id_nummeraanduiding'
+    stream_download = True
+    storage = 'parquet'
+    explicit_select = True
+    schema_hints = {'status_coordinaat_code': 'category', 'type_woonobject_omschrijving': 'category',
+                    'eigendomsverhouding_id': 'category', 'toegang_id': 'category'}
 
+    @datasets.step('_columnFix')
     def bag_fix(self):
         """Apply specific fixes for the BAG dataset."""
 
-        # Merge columns (three copies).
-        l_merge = ['_gebiedsgerichtwerken_id', 'indicatie_geconstateerd', 'indicatie_in_onderzoek',
-                   '_grootstedelijkgebied_id', 'buurt_id']
-        for m in l_merge:
-            self.data[m] = self.data[m + '_ligplaats'].combine_first(self.data[m + '_verblijfsobject'])
-            self.data[m] = self.data[m].combine_first(self.data[m + '_standplaats'])
-            self.data.drop(columns=[m + '_ligplaats', m + '_standplaats', m + '_verblijfsobject'], inplace=True)
-
-        # Merge columns (four copies). (almost always none, except for columns 0 & 3)
-        l_merge2 = ['document_mutatie', 'document_nummer', 'begin_geldigheid', 'einde_geldigheid']
-        for m in l_merge2:
-            self.data[m] = self.data[m + '_nummeraanduiding'].combine_first(self.data[m + '_verblijfsobject'])
-            self.data[m] = self.data[m].combine_first(self.data[m + '_standplaats'])
-            self.data[m] = self.data[m].combine_first(self.data[m + '_ligplaats'])
-            self.data.drop(columns=[m + '_nummeraanduiding', m + '_ligplaats', m + '_standplaats', m + '_verblijfsobject'], inplace=True)
+        # Merge the columns which have a copy for each BAG table, in order of preference. Columns which were
+        # already merged in the download query (see datasets.create_bag_query) are skipped.
+        for m, sources in BAG_MERGE_COLUMNS.items():
+            sources = [col for col in sources if col in self.columns]
+            if len(sources) == 0:
+                continue
+            merged = self[sources[0]]
+            for col in sources[1:]:
+                merged = merged.combine_first(self[col])
+            self[m] = merged
+            self.drop(columns=sources)
 
         # Drop columns
-        self.data.drop(columns=['_openbare_ruimte_naam_ligplaats','_openbare_ruimte_naam_standplaats', 'mutatie_gebruiker_nummeraanduiding',
-                                'mutatie_gebruiker_ligplaats', 'mutatie_gebruiker_standplaats', 'mutatie_gebruiker_verblijfsobject',
-                                '_huisnummer_ligplaats', '_huisnummer_standplaats', '_huisletter_ligplaats', '_huisletter_standplaats',
-                                '_huisnummer_toevoeging_ligplaats', '_huisnummer_toevoeging_standplaats', '_huisnummer_toevoeging_verblijfsobject',
-                                '_huisnummer_verblijfsobject', '_openbare_ruimte_naam_verblijfsobject', 'date_modified_ligplaats',
-                                'date_modified_standplaats', 'date_modified_verblijfsobject'],
-                                inplace=True)
-
-        # Change dataset version, and save this version of the dataset.
-        self.version += '_columnFix'
-        self.save()
\ No newline at end of file
+        self.drop(columns=[col for col in BAG_DROP_COLUMNS if col in self.columns])
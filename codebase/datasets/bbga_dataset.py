@@ -25,6 +25,7 @@ import re
 
 # Import own modules.
 import datasets
+from .datasets import BBGA_URL, BBGA_SEP, stream_csv, get_http_validators, set_http_validators
 
 # Define HOME and DATA_PATH on a global level.
 HOME = Path.home()  # Home path for old VAO.
@@ -41,4 +42,25 @@ class BbgaDataset(datasets.MyDataset):
     """Create a dataset for the BBGA data."""
 
     # Set the class attributes.
-    name = 'bbga'
\ No newline at end of file
+    name = 'bbga'
+    # Source of the BBGA csv file: a url (e.g. of a local http server for tests), or a local file path.
+    source = BBGA_URL
+    sep = BBGA_SEP
+
+
+    def _force_download(self, limit=9223372036854775807):
+        """
+        Download the BBGA file. When a previous download is cached, a conditional request is made, and the
+        cached download is used if the file was not modified since.
+        """
+        cached = datasets.get_version_store().resolve(self.name, 'download') is not None
+        validators = get_http_validators(self.name) if cached else None
+        data, validators = stream_csv(self.source, validators, sep=self.sep)
+        if data is None:
+            print(f"Dataset '{self.name}' was not modified since the previous download. Using the cached download.")
+            self.load('download')
+            return
+        self.data = data.head(limit)
+        self.data.name = self.name
+        self._save_download()
+        set_http_validators(self.name, validators)
@@ -0,0 +1,88 @@
+####################################################################################################
+"""
+compaction.py
+
+This module implements the dtype compaction that is applied to datasets when they are downloaded.
+Downloaded dataframes contain int64/float64 columns, object columns with strings, and object
+columns with Python date objects. Compaction converts these to smaller types once, at ingest:
+
+- Integer columns are downcast to the smallest integer type that holds all values.
+- Float columns are downcast to float32 when that does not change any value.
+- Object columns containing Python dates/datetimes are parsed to datetime64 columns.
+- Columns can be given an explicit type using schema hints, e.g. {'geslacht': 'category'}. The
+  special types 'category' (for low-cardinality string codes) and 'datetime' are supported, as
+  well as all numpy/pandas dtypes.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+#############
+## Imports ##
+#############
+
+import pandas as pd
+import datetime
+
+
+######################
+## Helper functions ##
+######################
+
+def compact_dtypes(df, schema_hints=None, verbose=True):
+    """
+    Convert the columns of a dataframe to compact types, using the schema hints (column name to
+    type) where given, and automatic downcasting and date parsing for the other columns. Returns
+    the compacted dataframe, and prints the memory usage per column before and after.
+    """
+    schema_hints = schema_hints or {}
+    before = df.memory_usage(index=False, deep=True)
+    dtypes_before = df.dtypes
+    compacted = pd.DataFrame({col: compact_column(df[col], schema_hints.get(col)) for col in df.columns},
+                             index=df.index, columns=df.columns)
+    compacted.name = getattr(df, 'name', None)
+    if verbose:
+        report = memory_report(dtypes_before, before, compacted)
+        changed = report[report['dtype_before'] != report['dtype_after']]
+        if len(changed) > 0:
+            print(changed.to_string())
+        print("Compacted dataframe '%s' from %.1f MB to %.1f MB." % (compacted.name, report['mb_before'].sum(),
+                                                                    report['mb_after'].sum()))
+    return compacted
+
+
+def compact_column(col, hint=None):
+    """Convert a single column to a compact type, using the hinted type if given."""
+    if hint == 'category':
+        return col if col.dtype.name == 'category' else col.astype('category')
+    if hint == 'datetime':
+        return pd.to_datetime(col, errors='coerce')
+    if hint is not None:
+        return col.astype(hint)
+    if pd.api.types.is_bool_dtype(col) or col.dtype.name == 'category':
+        return col
+    if pd.api.types.is_integer_dtype(col):
+        return pd.to_numeric(col, downcast='integer')
+    if pd.api.types.is_float_dtype(col):
+        # Only downcast when every value survives the round trip, so ids and amounts keep their exact value.
+        as_float32 = col.astype('float32')
+        exact = (as_float32.astype(col.dtype) == col) | col.isnull()
+        return as_float32 if exact.all() else col
+    if col.dtype == object and contains_dates(col):
+        return pd.to_datetime(col, errors='coerce')
+    return col
+
+
+def contains_dates(col, sample_size=100):
+    """Check whether an object column contains Python date/datetime objects, based on a sample of its values."""
+    sample = col.dropna().head(sample_size)
+    return len(sample) > 0 and all(isinstance(value, datetime.date) for value in sample)
+
+
+def memory_report(dtypes_before, bytes_before, compacted):
+    """Create a report of the type and memory usage (in MB) of each column, before and after compaction."""
+    report = pd.DataFrame({'dtype_before': dtypes_before.astype(str),
+                           'dtype_after': compacted.dtypes.astype(str),
+                           'mb_before': bytes_before / 1e6,
+                           'mb_after': compacted.memory_usage(index=False, deep=True) / 1e6})
+    return report.round(2)
@@ -13,10 +13,19 @@ Written by Swaan Dekkers & Thomas Jongstra
 ## Imports ##
 #############
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 import pandas.io.sql as sqlio
 import pandas as pd
 import numpy as np
+import psycopg2.pool
+import functools
+import threading
+import inspect
+import json
 import requests
 import psycopg2
 import time
@@ -25,6 +34,12 @@ import re
 
 # Import own modules.
 import config, clean
+from .storage import get_storage, find_storage
+from .version_store import VersionStore, hash_file
+from .lazy_frame import LazyFrame
+from .reference_cache import ReferenceCache
+from .feature_store import FeatureStore
+from .compaction import compact_dtypes
 
 # Define HOME and DATA_PATH on a global level.
 HOME = Path.home()  # Home path for old VAO.
@@ -48,22 +63,117 @@ class MyDataset():
     table_name = None
     id_column = None
 
+    # Stream large tables directly into the local cache in chunks (see stream_dataset), instead of
+    # downloading them into memory in one go.
+    stream_download = False
+
+    # Storage backend for locally saved versions of the dataset ('hdf' or 'parquet', see storage.py).
+    storage = 'hdf'
+
+    # Incremental downloads: column containing the modification time of each row, and the columns that
+    # together identify a row in the source table (by default the id_column).
+    modified_column = None
+    key_columns = None
+
+    # Types for specific columns, applied when the dataset is downloaded (see compaction.py). Columns
+    # without a hint are downcast automatically. Use 'category' for low-cardinality string codes.
+    schema_hints = {}
+
+    # Rules which each row should satisfy: a list of clean.ValidityRule objects. Pass them to the CleanTransformer
+    # (validity_rules) or to clean.clean_dates, to remove the rows which break a rule.
+    validity_rules = []
+
+    # Download an explicit select list with server-side merges of duplicate columns, instead of all
+    # columns (see create_bag_query). Only supported for the BAG.
+    explicit_select = False
+
+    # When processing steps store their result in the version store: after 'every' step, only after the
+    # steps listed in checkpoint_milestones ('milestones'), or when at least checkpoint_interval seconds
+    # have passed since the previous checkpoint ('time'). Checkpoints are written in the background.
+    # Versions that are not stored can not be loaded later, and have no key (self.key is None).
+    checkpoint_policy = 'every'
+    checkpoint_milestones = []
+    checkpoint_interval = 600
+
 
     def __init__(self):
         self._data = None
+        self._lazy = None  # Lazily loaded version from the version store (see lazy_frame.py).
         self._version = None
+        self.key = None  # Key of the current version in the version store (None when it is not stored).
+        self._last_checkpoint = time.time()
+
+
+    @property
+    def data(self):
+        """
+        The data of the dataset. When the dataset was loaded lazily, all its columns are loaded on first access.
+        Steps that only read or assign columns should use self[...], self.columns and self.drop instead, so
+        a lazily loaded version stays lazy. Steps that merge or filter rows need the full dataframe.
+        """
+        if self._lazy is not None:
+            self._data = self._lazy.to_frame()
+            self._lazy = None
+        return self._data
+
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._lazy = None
+
+
+    @property
+    def columns(self):
+        """The column names of the dataset, without loading any data."""
+        return self._lazy.columns if self._lazy is not None else self._data.columns
+
+
+    def __getitem__(self, key):
+        """Get a column (or list of columns). When the dataset was loaded lazily, only these columns are loaded."""
+        return self._lazy[key] if self._lazy is not None else self._data[key]
+
+
+    def __setitem__(self, key, value):
+        """Assign a column. When the dataset was loaded lazily, the other columns are not loaded."""
+        if self._lazy is not None:
+            self._lazy[key] = value
+        else:
+            self._data[key] = value
+
+
+    def drop(self, columns):
+        """Remove columns. When the dataset was loaded lazily, the removed columns are not loaded."""
+        if self._lazy is not None:
+            self._lazy.drop(columns)
+        else:
+            self._data.drop(columns=columns, inplace=True)
 
 
     def save(self):
         """Save a previously processed version of the dataset."""
         print(f"Saving version '{self.version}' of dataframe '{self.name}'.")
-        save_dataset(self.data, self.name, self.version)
+        self.key = get_version_store().commit(self._current_data(), self.name, self.version, storage=self.storage)
 
 
-    def load(self, version):
-        """Load a previously processed version of the dataset."""
+    def load(self, version, columns=None, filters=None, lazy=True):
+        """
+        Load a previously processed version of the dataset. Optionally only load a list of columns,
+        and/or the rows matching a list of filters (see storage.py). Versions in the version store are
+        loaded lazily by default: columns are only loaded from storage when they are used.
+        """
+        wait_for_checkpoints()  # The version can still be written in the background.
         try:
-            self.data = load_dataset(self.name, version)
+            # Load the version from the version store. Fall back to separately saved files (e.g. of older versions).
+            key = get_version_store().resolve(self.name, version)
+            if key is not None and lazy and not filters:
+                self._set_lazy(get_version_store().load_lazy(key, columns))
+            elif key is not None:
+                self.data = get_version_store().load(key, columns, filters)
+                self.data.name = self.name
+            else:
+                self.data = load_dataset(self.name, version, columns, filters)
+            self.key = key
             self.version = version
             print(f"Version '{self.version}' of dataset '{self.name}' loaded!")
         except FileNotFoundError as e:
@@ -75,24 +185,233 @@ class MyDataset():
                 print("Please try loading another version, or creating the version you need.")
 
 
-    def download(self, force=False, limit: int = 9223372036854775807):
-        """Download a copy of the dataset, or restore a previous version if available."""
-        if force == True:
-            self._force_download()
+    def download(self, force=False, incremental=False, limit: int = 9223372036854775807):
+        """
+        Download a copy of the dataset, or restore a previous version if available.
+        With 'incremental' set to True, only download the rows that changed since the previous download.
+        """
+        if incremental == True:
+            self._incremental_download()
+        elif force == True:
+            self._force_download(limit)
         else:
-            try:
-                self.data = load(version='download')
-                print("Loaded cached dataset from local storage. To force a download, \
-                       use the 'download' method with the flag 'force' set to 'True'")
-            except Exception:
-                self._force_download()
+            self.load('download')  # Downloads the dataset when no cached version is available.
 
 
     def _force_download(self, limit=9223372036854775807):
         """Force a dataset download."""
-        self.data = download_dataset(self.name, self.table_name, limit)
+        if self.stream_download:
+            path, bool_cols = stream_dataset(self.name, self.table_name, 'download', limit, storage=self.storage,
+                                             explicit_select=self.explicit_select)
+            self.data = restore_bool_columns(load_dataset(self.name, 'download'), bool_cols)
+            self._save_download()
+            # The streamed file is only needed until its columns are in the version store.
+            os.remove(path)
+        else:
+            self.data = download_dataset(self.name, self.table_name, limit, explicit_select=self.explicit_select)
+            self._save_download()
+
+
+    def _incremental_download(self):
+        """
+        Download the rows that were modified since the previous download (the high-water mark), and
+        upsert them into the cached download. Rows that no longer exist on the server are removed.
+        """
+        watermark = get_watermark(self.name)
+        if self.modified_column is None or watermark is None or get_version_store().resolve(self.name, 'download') is None:
+            print(f"No previous download with a high-water mark found for dataset '{self.name}'. Downloading the full dataset.")
+            self._force_download()
+            return
+
+        start = time.time()
+        print(f"#### Starting incremental download of dataset '{self.name}' (rows modified since {watermark})...")
+        self.load('download')
+        key_columns = self.key_columns or [self.id_column]
+        delta = download_delta(self.table_name, self.modified_column, watermark)
+        server_keys = download_keys(self.table_name, key_columns)
+
+        # Keep the cached rows that still exist on the server, and that have not been modified since.
+        cached_keys = pd.MultiIndex.from_frame(self.data[key_columns])
+        deleted = ~cached_keys.isin(pd.MultiIndex.from_frame(server_keys))
+        modified = cached_keys.isin(pd.MultiIndex.from_frame(delta[key_columns]))
+        if deleted.any() or len(delta) > 0:
+            self.data = pd.concat([self.data[~deleted & ~modified], delta], ignore_index=True, sort=False)
+            self.data.name = self.name
+        print(f"Upserted {len(delta)} modified rows ({modified.sum()} updated, {len(delta) - modified.sum()} new), and removed {deleted.sum()} deleted rows.")
+        print("\n#### ...incremental download done! Spent %.2f seconds.\n" % (time.time()-start))
+        self._save_download()
+
+
+    def _save_download(self):
+        """Cache a downloaded dataset locally, and remember its high-water mark for incremental downloads."""
         self.version = 'download'
-        save_dataset(self.data, self.name, self.version)  # cache dataset locally
+        self.data = compact_dtypes(self.data, self.schema_hints)
+        # The key is based on the downloaded content, so changed source data gives new versions.
+        self.key = get_version_store().commit(self._current_data(), self.name, self.version, step='download',
+                                              params={'table_name': self.table_name}, storage=self.storage)
+        if self.modified_column is not None and self.modified_column in self.columns:
+            watermark = pd.to_datetime(self[self.modified_column], errors='coerce').max()
+            if not pd.isnull(watermark):
+                set_watermark(self.name, watermark)
+
+
+
+    def after_step(self, step_name, columns_before):
+        """
+        Hook which is called after each processing step, both when the step was run and when its result was loaded
+        from the version store. Receives the name of the step, and the columns of the dataset before the step.
+        """
+        pass
+
+
+    def _is_checkpoint(self, step_name):
+        """Check whether the result of a processing step should be stored, according to the checkpoint policy."""
+        if self.checkpoint_policy == 'every':
+            return True
+        if self.checkpoint_policy == 'milestones':
+            return step_name in self.checkpoint_milestones
+        if self.checkpoint_policy == 'time':
+            return time.time() - self._last_checkpoint >= self.checkpoint_interval
+        raise ValueError(f"Unknown checkpoint policy '{self.checkpoint_policy}'.")
+
+
+    def _set_lazy(self, lazy):
+        """Use a lazily loaded version from the version store as the data of the dataset."""
+        self._data = None
+        self._lazy = lazy
+
+
+    def _current_data(self):
+        """Get the data of the dataset, without loading any lazily loaded columns."""
+        return self._lazy if self._lazy is not None else self._data
+
+
+
+####################
+## Step decorator ##
+####################
+
+def step(suffix, reference_tables=(), csv_files=()):
+    """
+    Decorator for dataset processing steps, which create a new version of the dataset.
+
+    The new version gets the name of the current version plus the suffix, and is stored in the
+    version store. Its key is based on the step, its parameters and the content of its inputs (the
+    dataset itself, any dataframe arguments, and the reference tables and csv files which the step
+    reads). When the step has been run before on identical inputs, the stored result is loaded
+    instead of running the step again. Other arguments must be simple values (e.g. numbers, strings,
+    or lists and dicts of these), so they can be part of the key.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            store = get_version_store()
+
+            # Describe the inputs: dataframes and files by their content hash, other arguments by their value.
+            arguments = inspect.signature(method).bind(self, *args, **kwargs).arguments
+            parents = [store.content_hash(self._current_data())]
+            params = {}
+            for arg_name, arg in arguments.items():
+                if isinstance(arg, pd.DataFrame):
+                    parents.append(store.content_hash(arg))
+                elif arg_name != 'self':
+                    params[arg_name] = describe_argument(method.__name__, arg_name, arg)
+            parents += [reference_table_hash(table_name) for table_name in reference_tables]
+            parents += [file_hash(csv_path) for csv_path in csv_files]
+            step_name = f'{type(self).__name__}.{method.__name__}'
+            key = store.make_key(step_name, parents, params)
+            version = self.version + suffix
+            columns_before = list(self.columns)
+
+            if is_checkpoint_pending(key):
+                wait_for_checkpoints()  # The same step on the same inputs was just run, and is still being stored.
+            if store.has(key):
+                self._set_lazy(store.load_lazy(key))
+                store.tag(self.name, version, key)
+                print(f"Inputs of step '{method.__name__}' are unchanged: loaded version '{version}' of dataset '{self.name}' from storage.")
+            else:
+                method(self, *args, **kwargs)
+                if self._is_checkpoint(method.__name__):
+                    print(f"Saving version '{version}' of dataframe '{self.name}'.")
+                    write_checkpoint(self._current_data(), self.name, version, key=key, step=step_name, params=params,
+                                     parents=parents, storage=self.storage)
+                    self._last_checkpoint = time.time()
+                else:
+                    key = None  # The version is not stored, so it can not be loaded or referred to.
+            self.version = version
+            self.key = key
+            self.after_step(method.__name__, columns_before)
+        return wrapper
+    return decorator
+
+
+
+# Types of step arguments which are described by their value in the key of a version.
+SIMPLE_TYPES = (type(None), bool, int, float, str, np.integer, np.floating, np.bool_)
+
+
+def describe_argument(step_name, arg_name, arg):
+    """Describe a (non-dataframe) step argument by its value, for the key of a version."""
+    if isinstance(arg, SIMPLE_TYPES):
+        return repr(arg)
+    if isinstance(arg, (list, tuple, dict)):
+        values = list(arg.keys()) + list(arg.values()) if isinstance(arg, dict) else list(arg)
+        if all(isinstance(value, SIMPLE_TYPES) for value in values):
+            return json.dumps(arg, sort_keys=True, default=repr)
+    raise TypeError(f"Argument '{arg_name}' of step '{step_name}' has type {type(arg).__name__}, which can not be "
+                    "part of a version key. Pass a dataframe or a simple value instead.")
+
+
+# Content hashes of files read by processing steps, by (path, modification time, size).
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_hash(path):
+    """Get the content hash of a file. The file is only hashed again when it has been modified."""
+    file_key = (path, os.path.getmtime(path), os.path.getsize(path))
+    with _file_hashes_lock:
+        if file_key not in _file_hashes:
+            _file_hashes[file_key] = hash_file(path)
+        return _file_hashes[file_key]
+
+
+
+#################
+## Checkpoints ##
+#################
+
+# Checkpoints are written by a single background thread, in the order in which they were made.
+_checkpoint_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+_pending_checkpoints = []
+_pending_checkpoints_lock = threading.Lock()
+
+
+def write_checkpoint(data, dataset_name, version, **commit_args):
+    """
+    Store a version of a dataset in the version store, on the background writer thread. The data is
+    copied first, so later processing steps can not change what is written.
+    """
+    data_snapshot = data.snapshot() if isinstance(data, LazyFrame) else data.copy()
+    future = _checkpoint_writer.submit(get_version_store().commit, data_snapshot, dataset_name, version, **commit_args)
+    with _pending_checkpoints_lock:
+        _pending_checkpoints.append((commit_args.get('key'), future))
+    return future
+
+
+def wait_for_checkpoints():
+    """Wait until all background checkpoints have been written. Raises the error of a failed checkpoint."""
+    with _pending_checkpoints_lock:
+        pending = list(_pending_checkpoints)
+        _pending_checkpoints.clear()
+    for _, future in pending:
+        future.result()
+
+
+def is_checkpoint_pending(key):
+    """Check whether the version with the given key is still being written in the background."""
+    with _pending_checkpoints_lock:
+        return any(pending_key == key and not future.done() for pending_key, future in _pending_checkpoints)
 
 
 
@@ -100,7 +419,7 @@ class MyDataset():
 ## Helper functions ##
 ######################
 
-def download_dataset(dataset_name, table_name, limit=9223372036854775807):
+def download_dataset(dataset_name, table_name, limit=9223372036854775807, explicit_select=False):
         """Download a new copy of the dataset from its source."""
 
         start = time.time()
@@ -108,51 +427,392 @@ def download_dataset(dataset_name, table_name, limit=9223372036854775807):
 
         if dataset_name == 'bbga':
             # Download BBGA file, interpret as dataframe, and return.
-            url = "https://api.data.amsterdam.nl/dcatd/datasets/G5JpqNbhweXZSw/purls/LXGOPUQQfAXBbg"
-            res = requests.get(url)
-            df = pd.read_csv(res.content)
+            df, _ = stream_csv(BBGA_URL, sep=BBGA_SEP)
             return df
 
-        # Create a server connection.
-        # By default, we assume the table is in ['import_adres', 'import_wvs', 'import_stadia', 'bwv_personen', 'bag_verblijfsobject']
-        conn = psycopg2.connect(host = config.HOST,
-                                dbname = config.DB,
-                                user = config.USER,
-                                password = config.PASSWORD)
-        if table_name in ['bag_nummeraanduiding', 'bag_verblijfsobject']:
-            conn = psycopg2.connect(host = config.BAG_HOST,
-                            dbname = config.BAG_DB,
-                            user = config.BAG_USER,
-                            password = config.BAG_PASSWORD)
-
-        # Create query to download the specific table data from the server.
-        # By default, we assume the table is in ['import_adres', 'import_wvs', 'import_stadia', 'bwv_personen', 'bag_verblijfsobject']
-        sql = f"select * from public.{table_name} limit {limit};"
-        if table_name in ['bag_nummeraanduiding']:
-            sql = """
-            SELECT *
-            FROM public.bag_nummeraanduiding
-            FULL JOIN bag_ligplaats ON bag_nummeraanduiding.ligplaats_id = bag_ligplaats.id
-            FULL JOIN bag_standplaats ON bag_nummeraanduiding.standplaats_id = bag_standplaats.id
-            FULL JOIN bag_verblijfsobject ON bag_nummeraanduiding.verblijfsobject_id = bag_verblijfsobject.id;
-            """
-
-        # Get data & convert to dataframe.
-        df = sqlio.read_sql_query(sql, conn)
+        # Get data & convert to dataframe, using a pooled server connection.
+        with connection(table_name) as conn:
+            # Create a query to download the specific table data from the server.
+            sql = create_query(table_name, limit, explicit_select, conn)
+            df = sqlio.read_sql_query(sql, conn)
 
-        # Close connection to server.
-        conn.close()
+        if dataset_name == 'bag' and not explicit_select:
+            df = apply_bag_colname_fix(df)
 
         # Name dataframe according to table name. Beware: name will be removed by pickling.
         df.name = dataset_name
 
-        if dataset_name == 'bag':
-            df = apply_bag_colname_fix(df)
-
         print("\n#### ...download done! Spent %.2f seconds.\n" % (time.time()-start))
         return df
 
 
+# Connection pools per database server, shared by all (concurrent) downloads. Each pool has a semaphore with
+# one slot per connection, so users wait for a free connection instead of failing when the pool is exhausted.
+POOL_SIZE = 4
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(table_name):
+    """
+    Get the connection pool for the database server which contains the given table, and the semaphore
+    which limits the number of connections that are borrowed at the same time.
+    """
+    # By default, we assume the table is in ['import_adres', 'import_wvs', 'import_stadia', 'bwv_personen', 'bag_verblijfsobject']
+    if table_name in ['bag_nummeraanduiding', 'bag_verblijfsobject']:
+        params = dict(host = config.BAG_HOST, dbname = config.BAG_DB, user = config.BAG_USER, password = config.BAG_PASSWORD)
+    else:
+        params = dict(host = config.HOST, dbname = config.DB, user = config.USER, password = config.PASSWORD)
+    with _pools_lock:
+        if (params['host'], params['dbname']) not in _pools:
+            _pools[(params['host'], params['dbname'])] = (psycopg2.pool.ThreadedConnectionPool(1, POOL_SIZE, **params),
+                                                          threading.BoundedSemaphore(POOL_SIZE))
+        return _pools[(params['host'], params['dbname'])]
+
+
+@contextmanager
+def connection(table_name):
+    """
+    Borrow a connection to the database server which contains the given table from its pool. Waits
+    until a connection is free when all connections of the pool are in use.
+    """
+    pool, slots = get_pool(table_name)
+    with slots:
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.rollback()  # End the read transaction, so the connection is clean for its next user.
+            pool.putconn(conn)
+        except Exception:
+            pool.putconn(conn, close=True)  # The connection can be in a broken state, so do not reuse it.
+            raise
+
+
+def create_query(table_name, limit=9223372036854775807, explicit_select=False, conn=None):
+    """
+    Create the query to download the specific table data from the server. With explicit_select, the BAG
+    query selects only the columns that are kept by BagDataset.bag_fix (which needs a connection).
+    """
+    # By default, we assume the table is in ['import_adres', 'import_wvs', 'import_stadia', 'bwv_personen', 'bag_verblijfsobject']
+    if table_name in ['bag_nummeraanduiding'] and explicit_select:
+        return create_bag_query(conn)
+    if table_name in ['bag_nummeraanduiding']:
+        return """
+        SELECT *
+        FROM public.bag_nummeraanduiding
+        FULL JOIN bag_ligplaats ON bag_nummeraanduiding.ligplaats_id = bag_ligplaats.id
+        FULL JOIN bag_standplaats ON bag_nummeraanduiding.standplaats_id = bag_standplaats.id
+        FULL JOIN bag_verblijfsobject ON bag_nummeraanduiding.verblijfsobject_id = bag_verblijfsobject.id;
+        """
+    return f"select * from public.{table_name} limit {limit};"
+
+
+# Tables joined in the BAG query (table name, alias, column suffix), in the order of the join.
+BAG_TABLES = [('bag_nummeraanduiding', 'n', 'nummeraanduiding'), ('bag_ligplaats', 'l', 'ligplaats'),
+              ('bag_standplaats', 's', 'standplaats'), ('bag_verblijfsobject', 'v', 'verblijfsobject')]
+
+# BAG columns which are merged by BagDataset.bag_fix (merged column: source columns, in order of preference).
+BAG_MERGE_COLUMNS = {**{m: [m + '_ligplaats', m + '_verblijfsobject', m + '_standplaats']
+                        for m in ['_gebiedsgerichtwerken_id', 'indicatie_geconstateerd', 'indicatie_in_onderzoek',
+                                  '_grootstedelijkgebied_id', 'buurt_id']},
+                     **{m: [m + '_nummeraanduiding', m + '_verblijfsobject', m + '_standplaats', m + '_ligplaats']
+                        for m in ['document_mutatie', 'document_nummer', 'begin_geldigheid', 'einde_geldigheid']}}
+
+# BAG columns which are dropped by BagDataset.bag_fix.
+BAG_DROP_COLUMNS = ['_openbare_ruimte_naam_ligplaats','_openbare_ruimte_naam_standplaats', 'mutatie_gebruiker_nummeraanduiding',
+                    'mutatie_gebruiker_ligplaats', 'mutatie_gebruiker_standplaats', 'mutatie_gebruiker_verblijfsobject',
+                    '_huisnummer_ligplaats', '_huisnummer_standplaats', '_huisletter_ligplaats', '_huisletter_standplaats',
+                    '_huisnummer_toevoeging_ligplaats', '_huisnummer_toevoeging_standplaats', '_huisnummer_toevoeging_verblijfsobject',
+                    '_huisnummer_verblijfsobject', '_openbare_ruimte_naam_verblijfsobject', 'date_modified_ligplaats',
+                    'date_modified_standplaats', 'date_modified_verblijfsobject']
+
+
+def create_bag_query(conn):
+    """
+    Create the BAG query with an explicit select list. The columns get the same names as after
+    apply_bag_colname_fix, the columns merged by BagDataset.bag_fix are merged on the server using
+    COALESCE, and the columns dropped by bag_fix are not selected at all.
+    """
+    # Get the columns of the BAG tables, in the same order as 'SELECT *' would return them.
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT table_name, column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name IN %s
+        ORDER BY ordinal_position;
+        """, (tuple(table for table, _, _ in BAG_TABLES),))
+    rows = cur.fetchall()
+    cur.close()
+    columns = [(alias, col, data_type) for table, alias, _ in BAG_TABLES for t, col, data_type in rows if t == table]
+
+    # Name the columns in the same way as a regular download does.
+    names = apply_bag_colname_fix(pd.DataFrame(columns=[col for _, col, _ in columns])).columns
+    sources = dict(zip(names, columns))
+
+    # Select the columns which are kept, and add the merged columns at the end (like bag_fix does).
+    merged = {col for cols in BAG_MERGE_COLUMNS.values() for col in cols}
+    select = [f'{alias}."{col}" AS "{name}"' for name, (alias, col, _) in sources.items()
+              if name not in merged and name not in BAG_DROP_COLUMNS]
+    for name, cols in BAG_MERGE_COLUMNS.items():
+        present = [sources[col] for col in cols if col in sources]
+        if len(present) == 0:
+            continue
+        # Columns of different types can not be merged directly, so merge their text representations.
+        cast = '::text' if len({data_type for _, _, data_type in present}) > 1 else ''
+        values = ', '.join(f'{alias}."{col}"{cast}' for alias, col, _ in present)
+        select.append(f'COALESCE({values}) AS "{name}"')
+
+    select_list = ',\n               '.join(select)
+    return f"""
+        SELECT {select_list}
+        FROM public.bag_nummeraanduiding AS n
+        FULL JOIN public.bag_ligplaats AS l ON n.ligplaats_id = l.id
+        FULL JOIN public.bag_standplaats AS s ON n.standplaats_id = s.id
+        FULL JOIN public.bag_verblijfsobject AS v ON n.verblijfsobject_id = v.id;
+        """
+
+
+# Types of streamed Postgres columns, by Postgres type oid. All other types are parsed as strings.
+PG_TYPES = {16: 'bool', 20: 'int', 21: 'int', 23: 'int', 700: 'float64', 701: 'float64', 1700: 'float64',
+            1082: 'datetime', 1114: 'datetime', 1184: 'datetimetz'}
+
+
+def stream_dataset(dataset_name, table_name, version='download', limit=9223372036854775807, chunksize=100000,
+                   storage='hdf', conn=None, explicit_select=False):
+    """
+    Stream a table from the server into the local cache, using the Postgres COPY command.
+
+    The COPY output is written to a local staging file as it arrives, and then parsed in chunks of
+    'chunksize' rows into typed columns, which are appended to the cache one chunk at a time. This way
+    the rows never exist as Python tuples, and peak memory stays bounded by the chunksize. A connection
+    can be passed in (e.g. to a local test database); by default one is created for the table.
+
+    Columns get the same types as with download_dataset: integer columns are int64, or float64 when
+    they have missing values, and boolean columns are bool. HDF5 and Parquet tables can not hold
+    booleans with missing values, so these columns are stored as floats (1/0/NaN). Returns the path
+    of the cache file, and the names of these columns (see restore_bool_columns).
+    """
+
+    start = time.time()
+    print(f"#### Starting streaming download of dataset '{dataset_name}'...")
+
+    csv_path = os.path.join(DATA_PATH, f'{dataset_name}_{version}.csv')
+    backend = get_storage(storage)
+    dataset_path = os.path.join(DATA_PATH, f'{dataset_name}_{version}.{backend.extension}')
+    try:
+        with (nullcontext(conn) if conn is not None else connection(table_name)) as conn:
+            # Remove the trailing semicolon, so the query can be used inside the COPY command.
+            sql = create_query(table_name, limit, explicit_select, conn).strip().rstrip(';')
+            cur = conn.cursor()
+            # Get the column names and types, without fetching any rows.
+            cur.execute(f"SELECT * FROM ({sql}) AS q LIMIT 0;")
+            names = [col[0] for col in cur.description]
+            types = [PG_TYPES.get(col[1], 'str') for col in cur.description]
+            # Copy the query result to the local staging file. Psycopg2 writes the data straight to the file.
+            with open(csv_path, 'wb') as f:
+                cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, NULL '\\N');", f)
+            cur.close()
+
+        # Rename the (duplicate) BAG columns, in the same way as is done for a regular download.
+        if dataset_name == 'bag' and not explicit_select:
+            names = list(apply_bag_colname_fix(pd.DataFrame(columns=names)).columns)
+        types = dict(zip(names, types))
+        str_cols = [col for col in names if types[col] == 'str']
+        int_bool_cols = [col for col in names if types[col] in ['int', 'bool']]
+
+        def read_chunks(parse_types):
+            return pd.read_csv(csv_path, header=None, names=names, chunksize=chunksize, encoding='utf-8',
+                               dtype={col: (str if t in ['str', 'bool'] else t) for col, t in parse_types.items() if 'datetime' not in t},
+                               na_values=['\\N'], keep_default_na=False)
+
+        # First pass: find the integer and boolean columns with missing values, and (HDF5 only) the maximum string
+        # length (in UTF-8 bytes) per string column, which HDF5 tables need up front.
+        itemsizes = dict.fromkeys(str_cols, 1)
+        with_missing = set()
+        for chunk in read_chunks({col: 'float64' if t == 'int' else t for col, t in types.items()}):
+            with_missing.update(col for col in int_bool_cols if chunk[col].isnull().any())
+            if backend.extension == 'h5':
+                for col in str_cols:
+                    itemsizes[col] = max(itemsizes[col], int(chunk[col].str.encode('utf-8').str.len().fillna(0).max()))
+        bool_cols_with_missing = [col for col in names if types[col] == 'bool' and col in with_missing]
+
+        # Second pass: convert each chunk to typed columns and append it to the cache.
+        rows = 0
+        parse_types = {col: ('float64' if col in with_missing else 'int64') if t == 'int' else t for col, t in types.items()}
+        with backend.writer(dataset_path, dataset_name, itemsizes) as writer:
+            for chunk in read_chunks(parse_types):
+                for col, t in types.items():
+                    if t == 'bool':
+                        chunk[col] = chunk[col].map({'t': 1., 'f': 0.}) if col in with_missing else chunk[col] == 't'
+                    elif t == 'datetime':
+                        chunk[col] = pd.to_datetime(chunk[col], errors='coerce')
+                    elif t == 'datetimetz':
+                        chunk[col] = pd.to_datetime(chunk[col], errors='coerce', utc=True).dt.tz_convert(None)
+                writer.write(chunk)
+                rows += len(chunk)
+    finally:
+        # Remove the staging file, also when the download or parsing failed.
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+
+    print("\n#### ...streamed %d rows! Spent %.2f seconds.\n" % (rows, time.time()-start))
+    return dataset_path, bool_cols_with_missing
+
+
+def restore_bool_columns(df, cols):
+    """Convert boolean columns that were streamed as floats (1/0/NaN) back to True/False/None, like download_dataset."""
+    for col in cols:
+        df[col] = df[col].map({1.: True, 0.: False}).astype(object).where(df[col].notnull(), None)
+    return df
+
+
+def download_delta(table_name, modified_column, since):
+    """Download the rows of a table that were modified at or after the given time."""
+    sql = f"select * from public.{table_name} where {modified_column} >= %(since)s;"
+    with connection(table_name) as conn:
+        df = sqlio.read_sql_query(sql, conn, params={'since': str(since)})
+    return df
+
+
+def download_keys(table_name, key_columns):
+    """Download only the key columns of all rows in a table, to detect deleted rows."""
+    sql = f"select {', '.join(key_columns)} from public.{table_name};"
+    with connection(table_name) as conn:
+        df = sqlio.read_sql_query(sql, conn)
+    return df
+
+
+def download_datasets(dataset_objects, max_workers=4, force=True, incremental=False):
+    """
+    Download several datasets concurrently, using a bounded pool of threads. The downloads share the
+    connection pools, so the total time is about that of the slowest dataset instead of the sum.
+    Returns a report with the wall time, number of rows and in-memory size (bytes) per dataset. The
+    in-memory size is only known for downloaded data: versions restored from the local cache are
+    loaded lazily, and are not loaded just for the report.
+    """
+
+    def download(dataset):
+        start = time.time()
+        dataset.download(force=force, incremental=incremental)
+        data = dataset._current_data()
+        return {'dataset': dataset.name,
+                'seconds': time.time() - start,
+                'rows': len(data),  # A lazily loaded version knows its length without loading any columns.
+                'memory_bytes': int(data.memory_usage(deep=True).sum()) if isinstance(data, pd.DataFrame) else None}
+
+    start = time.time()
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download, dataset): dataset for dataset in dataset_objects}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Download of dataset '{futures[future].name}' failed: {e}")
+                results.append({'dataset': futures[future].name, 'seconds': None, 'rows': None, 'memory_bytes': None})
+    report = pd.DataFrame(results, columns=['dataset', 'seconds', 'rows', 'memory_bytes'])
+    print(report)
+    print("\n#### All downloads done! Spent %.2f seconds.\n" % (time.time()-start))
+    return report
+
+
+# Lock for the watermarks file, which can be written by concurrent downloads.
+_watermarks_lock = threading.Lock()
+
+
+def get_watermark(dataset_name):
+    """Get the high-water mark (latest modification time) of the previous download of a dataset."""
+    path = os.path.join(DATA_PATH, 'watermarks.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        watermark = json.load(f).get(dataset_name)
+    return pd.Timestamp(watermark) if watermark is not None else None
+
+
+def set_watermark(dataset_name, watermark):
+    """Remember the high-water mark (latest modification time) of a downloaded dataset."""
+    path = os.path.join(DATA_PATH, 'watermarks.json')
+    with _watermarks_lock:
+        watermarks = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                watermarks = json.load(f)
+        watermarks[dataset_name] = pd.Timestamp(watermark).isoformat()
+        with open(path, 'w') as f:
+            json.dump(watermarks, f)
+
+
+# Location and separator of the BBGA csv file.
+BBGA_URL = "https://api.data.amsterdam.nl/dcatd/datasets/G5JpqNbhweXZSw/purls/LXGOPUQQfAXBbg"
+BBGA_SEP = ';'
+
+
+def stream_csv(source, validators=None, chunksize=100000, sep=',', retries=3, timeout=60):
+    """
+    Download a csv file from a url (or read it from a local file path), and parse it in chunks while it
+    is being downloaded. The validators of a previous download (ETag/Last-Modified headers, or the
+    modification time of a local file) can be given. When the file has not been modified since, it is
+    not downloaded or parsed again, and None is returned instead of a dataframe.
+    Returns the dataframe and the validators of this download.
+    """
+    validators = validators or {}
+
+    # Local file (e.g. for offline tests): use its modification time as validator.
+    if not source.startswith(('http://', 'https://')):
+        path = source[len('file://'):] if source.startswith('file://') else source
+        new_validators = {'mtime': os.path.getmtime(path)}
+        if validators.get('mtime') == new_validators['mtime']:
+            return None, validators
+        return pd.concat(pd.read_csv(path, sep=sep, chunksize=chunksize), ignore_index=True), new_validators
+
+    # Conditional request, which is retried on connection errors and server errors.
+    retry = Retry(total=retries, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    with requests.Session() as session:
+        session.mount('http://', HTTPAdapter(max_retries=retry))
+        session.mount('https://', HTTPAdapter(max_retries=retry))
+        with session.get(source, headers=headers, stream=True, timeout=timeout) as res:
+            if res.status_code == 304:
+                return None, validators
+            res.raise_for_status()
+            new_validators = {'etag': res.headers.get('ETag'), 'last_modified': res.headers.get('Last-Modified')}
+            # Parse the response body while it arrives (decompressing it if needed).
+            res.raw.decode_content = True
+            df = pd.concat(pd.read_csv(res.raw, sep=sep, chunksize=chunksize), ignore_index=True)
+    return df, new_validators
+
+
+# Lock for the http validators file, which can be written by concurrent downloads.
+_http_validators_lock = threading.Lock()
+
+
+def get_http_validators(dataset_name):
+    """Get the validators (e.g. ETag) of the previous download of a dataset from an http source."""
+    path = os.path.join(DATA_PATH, 'http_validators.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get(dataset_name)
+
+
+def set_http_validators(dataset_name, validators):
+    """Remember the validators of a dataset downloaded from an http source."""
+    path = os.path.join(DATA_PATH, 'http_validators.json')
+    with _http_validators_lock:
+        all_validators = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                all_validators = json.load(f)
+        all_validators[dataset_name] = validators
+        with open(path, 'w') as f:
+            json.dump(all_validators, f)
+
+
 def apply_bag_colname_fix(df):
     """Fix BAG columns directly after download."""
 
@@ -204,41 +864,132 @@ def apply_bag_colname_fix(df):
 def add_column(df, new_col, match_col, csv_path, key='lcolumn', val='ncolumn'):
     """Add a new column to dataframe based on the match_column, and the mapping in the csv.
 
-    df: dataframe to be augmented.
+    df: dataframe (or dataset) to be augmented.
     new_col: name of new dataframe column.
     match_col: colum to match with the csv variable 'key'.
     csv_path: path to the csv file which is used for augmentation.
     key: name of column in csv file containing keys.
     val: name of column in csv file containing values.
     """
+    add_columns(df, match_col, {new_col: csv_path}, key, val)
+
+
+def add_columns(df, match_col, csv_paths, key='lcolumn', val='ncolumn'):
+    """Add several new columns to dataframe based on the match_column, using one mapping csv per new column.
+
+    The match column is factorized once, and only its unique values are mapped. The new columns are categorical.
+
+    df: dataframe (or dataset) to be augmented.
+    match_col: colum to match with the csv variables 'key'.
+    csv_paths: dict with the name of each new dataframe column, and the path to the csv file used to create it.
+    key: name of column in csv files containing keys.
+    val: name of column in csv files containing values.
+    """
+    codes, uniques = pd.factorize(df[match_col])
+    for new_col, csv_path in csv_paths.items():
+        # Map the unique values (rows with a missing value, code -1, stay missing), and use the results as categories.
+        mapped = get_mapping(csv_path, key, val).reindex(uniques).values
+        categories = pd.Index(pd.unique(mapped[pd.notnull(mapped)]))
+        unique_codes = np.append(categories.get_indexer(mapped), -1)
+        df[new_col] = pd.Categorical.from_codes(unique_codes[codes], categories)
+
+        # Print information about performed operation to terminal.
+        print(f"Dataframe \"%s\": added column \"%s\"!" % (df.name, new_col))
+
 
-    # Load csv file.
-    df_label = pd.read_csv(csv_path)
+# Compiled mappings, by (csv path, modification time, key column, value column).
+_mappings = {}
+_mappings_lock = threading.Lock()
+
+
+def get_mapping(csv_path, key='lcolumn', val='ncolumn'):
+    """
+    Get the mapping in a csv file, as a Series with the keys as index and the values as values (both lowercase).
+    Mappings are compiled once, and again only when the csv file is modified.
+    """
+    mapping_key = (csv_path, os.path.getmtime(csv_path), key, val)
+    with _mappings_lock:
+        if mapping_key not in _mappings:
+            df_label = get_reference_cache().get_csv(csv_path, columns=[key, val])
+            mapping = pd.Series(df_label[val].str.lower().values, index=df_label[key].str.lower().values)
+            # With duplicate keys, the last value is used.
+            _mappings[mapping_key] = mapping[~mapping.index.duplicated(keep='last')]
+        return _mappings[mapping_key]
 
-    # Transform csv string data to lowercase.
-    df_label[key] = df_label[key].str.lower()
-    df_label[val] = df_label[val].str.lower()
 
-    # Create a dict mapping: key -> val, based on the csv data.
-    label_dict = dict(zip(df_label[key], df_label[val]))
+def get_version_store():
+    """Get the version store in the data directory (see version_store.py)."""
+    return VersionStore(os.path.join(DATA_PATH, 'version_store'))
 
-    # Create a new dataframe column. If match_col matches with 'key', set the value to 'val'.
-    df[new_col] = df[match_col].apply(lambda x: label_dict.get(x))
 
-    # Print information about performed operation to terminal.
-    print(f"Dataframe \"%s\": added column \"%s\"!" % (df.name, new_col))
+# Reference tables cached per data directory, so their in-memory copies are shared by all datasets.
+_reference_caches = {}
+_reference_caches_lock = threading.Lock()
 
+# Time (in seconds) after which cached reference tables are downloaded again, per table.
+REFERENCE_TTLS = {'bwv_adres_periodes': 24 * 60 * 60}
+DEFAULT_REFERENCE_TTL = 24 * 60 * 60
 
-def save_dataset(data, dataset_name, version):
-    """Save a version of the given dataframe."""
-    dataset_path = os.path.join(DATA_PATH, f'{dataset_name}_{version}.h5')
-    data.to_hdf(path_or_buf=dataset_path, key=dataset_name, mode='w')
 
+def get_reference_cache():
+    """Get the reference table cache in the data directory (see reference_cache.py)."""
+    path = os.path.join(DATA_PATH, 'reference')
+    with _reference_caches_lock:
+        if path not in _reference_caches:
+            _reference_caches[path] = ReferenceCache(path)
+        return _reference_caches[path]
 
-def load_dataset(dataset_name, version):
-    """Load a version of the dataframe from file. Rename it (pickling removes name)."""
-    dataset_path = os.path.join(DATA_PATH, f'{dataset_name}_{version}.h5')
+
+def get_reference_table(table_name, columns=None):
+    """
+    Get a reference table (e.g. for enriching a dataset) from the reference cache. The table is only
+    downloaded when it is not cached, or when its cached copy is older than its TTL (see REFERENCE_TTLS).
+    """
+    ttl = REFERENCE_TTLS.get(table_name, DEFAULT_REFERENCE_TTL)
+    return get_reference_cache().get(table_name, lambda: download_dataset(table_name, table_name), ttl, columns)
+
+
+def reference_table_hash(table_name):
+    """
+    Get the content hash of the cached copy of a reference table, e.g. to detect that a processing step
+    which reads the table has new input. An outdated copy is downloaded again first (see REFERENCE_TTLS).
+    """
+    ttl = REFERENCE_TTLS.get(table_name, DEFAULT_REFERENCE_TTL)
+    return file_hash(get_reference_cache().refresh(table_name, lambda: download_dataset(table_name, table_name), ttl))
+
+
+# Feature stores per data directory, so their opened feature sets are shared by all datasets.
+_feature_stores = {}
+_feature_stores_lock = threading.Lock()
+
+
+def get_feature_store():
+    """Get the per-address feature store in the data directory (see feature_store.py)."""
+    path = os.path.join(DATA_PATH, 'feature_store')
+    with _feature_stores_lock:
+        if path not in _feature_stores:
+            _feature_stores[path] = FeatureStore(path)
+        return _feature_stores[path]
+
+
+def save_dataset(data, dataset_name, version, storage='hdf'):
+    """Save a version of the given dataframe, using the given storage backend ('hdf' or 'parquet')."""
+    backend = get_storage(storage)
+    dataset_path = os.path.join(DATA_PATH, f'{dataset_name}_{version}.{backend.extension}')
+    backend.save(data, dataset_path, dataset_name)
+
+
+def load_dataset(dataset_name, version, columns=None, filters=None):
+    """
+    Load a version of the dataframe from file. Rename it (pickling removes name).
+    The storage backend is detected from the saved file. Optionally only load the given columns,
+    and/or the rows matching the given filters (see storage.py).
+    """
+    dataset_path = os.path.join(DATA_PATH, f'{dataset_name}_{version}')
     print(f'Trying to load dataset "{dataset_name}" version "{version}" from path "{dataset_path}".')
-    data = pd.read_hdf(path_or_buf=dataset_path, key=dataset_name, mode='r')
+    backend = find_storage(dataset_path)
+    if backend is None:
+        raise FileNotFoundError(f'No saved file found for dataset "{dataset_name}" version "{version}".')
+    data = backend.load(f'{dataset_path}.{backend.extension}', dataset_name, columns, filters)
     data.name = dataset_name # Set the dataframe name again after loading (it is lost when saving).
     return data
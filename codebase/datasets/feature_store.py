@@ -0,0 +1,198 @@
+####################################################################################################
+"""
+feature_store.py
+
+This module implements a store for features per address (keyed by adres_id), which is filled by the
+enrichment steps of the adres dataset (BAG, personen and hotline features). Scoring and the dashboard
+can look up the features of a list of addresses, without loading the full enriched dataset.
+
+Each feature set (e.g. 'bag') is stored in its own directory, with the keys sorted in a numpy file and
+one numpy file per column. Numeric and boolean columns are stored as they are, datetime columns as
+int64 timestamps, and other columns as categorical codes (with the categories in the manifest). The
+files are memory-mapped, so a lookup only reads the rows it needs: the keys are found with a binary
+search. Recently used feature sets are kept open in memory (least recently used first).
+
+A manifest (json) per feature set refers to its current directory. Writing a feature set creates a new
+directory and then replaces the manifest, so readers never see a half-written feature set.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+#############
+## Imports ##
+#############
+
+from collections import OrderedDict
+import pandas as pd
+import numpy as np
+import threading
+import shutil
+import json
+import time
+import os
+
+# Import own modules.
+from .version_store import write_json
+
+
+#########################
+## Feature store class ##
+#########################
+
+class FeatureStore():
+    """Store of feature sets keyed by address, with memory-mapped columns and binary search lookups."""
+
+    def __init__(self, path, max_sets=8):
+        self.path = path
+        self.max_sets = max_sets
+        self._sets = OrderedDict()  # name: (modification time, feature set), least recently used first.
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+
+    def write(self, name, df, key_column='adres_id', columns=None, version=None):
+        """
+        Store columns of a dataframe (by default all columns) as a feature set, keyed by the key column. Replaces
+        the previous version of the feature set. Rows without a key are skipped, and with duplicate keys the
+        last row is used. Optionally remember the version (e.g. a version store key) the features come from.
+        """
+        columns = [col for col in (columns if columns is not None else df.columns) if col != key_column]
+        keys = df[key_column]
+        keep = np.flatnonzero(~keys.duplicated(keep='last').values & keys.notnull().values)
+        positions = keep[np.argsort(key_array(keys.values[keep]), kind='mergesort')]
+
+        directory = f'{name}-{time.time_ns()}'
+        os.makedirs(os.path.join(self.path, directory))
+        np.save(os.path.join(self.path, directory, 'keys.npy'), key_array(keys.values[positions]))
+        manifest = {'directory': directory, 'key_column': key_column, 'version': version, 'columns': {}}
+        for i, col in enumerate(columns):
+            values, description = encode_column(df[col].iloc[positions])
+            np.save(os.path.join(self.path, directory, f'{i}.npy'), values)
+            manifest['columns'][col] = dict(description, file=f'{i}.npy')
+        with self._lock:
+            write_json(self._manifest_path(name), manifest)
+            self._sets.pop(name, None)
+
+        # Remove the previous versions of the feature set. Readers which still use them keep their open files.
+        for other in os.listdir(self.path):
+            if other.rsplit('-', 1)[0] == name and other != directory:
+                shutil.rmtree(os.path.join(self.path, other), ignore_errors=True)
+        print(f"Stored {len(columns)} features of {len(positions)} addresses in feature set '{name}'.")
+
+
+    def lookup(self, keys, columns=None, names=None):
+        """
+        Look up the features of a list of keys (e.g. adres_ids) in all feature sets, or in the given feature sets.
+        Optionally only return a list of columns. Returns a dataframe indexed by the keys, in the given order.
+        Keys which are not in a feature set get missing values for its columns.
+        """
+        keys = np.asarray(keys)
+        frames = []
+        for name in (names if names is not None else self.names()):
+            feature_set = self._open(name)
+            set_columns = [col for col in (columns if columns is not None else feature_set.columns)
+                           if col in feature_set.columns]
+            if len(set_columns) > 0:
+                frames.append(feature_set.lookup(keys, set_columns))
+        data = pd.concat(frames, axis=1) if frames else pd.DataFrame(index=range(len(keys)))
+        data.index = pd.Index(keys, name='adres_id')
+        return data
+
+
+    def get(self, key, columns=None, names=None):
+        """Look up the features of a single key (e.g. an adres_id) as a Series."""
+        return self.lookup([key], columns, names).iloc[0]
+
+
+    def names(self):
+        """Get the names of all stored feature sets."""
+        return sorted(filename[:-len('.json')] for filename in os.listdir(self.path) if filename.endswith('.json'))
+
+
+    def columns(self, names=None):
+        """Get the feature columns in all feature sets, or in the given feature sets."""
+        return [col for name in (names if names is not None else self.names()) for col in self._open(name).columns]
+
+
+    def version(self, name):
+        """Get the version a feature set was stored from (see write). Returns None if it is unknown or not stored."""
+        if not os.path.exists(self._manifest_path(name)):
+            return None
+        with open(self._manifest_path(name)) as f:
+            return json.load(f).get('version')
+
+
+    def _open(self, name):
+        """Get an opened feature set from memory if it is up to date, and open it otherwise. Forgets the least recently used sets."""
+        with self._lock:
+            mtime = os.path.getmtime(self._manifest_path(name))
+            if name not in self._sets or self._sets[name][0] != mtime:
+                with open(self._manifest_path(name)) as f:
+                    manifest = json.load(f)
+                self._sets[name] = (mtime, FeatureSet(os.path.join(self.path, manifest['directory']), manifest))
+            self._sets.move_to_end(name)
+            while len(self._sets) > self.max_sets:
+                self._sets.popitem(last=False)
+            return self._sets[name][1]
+
+
+    def _manifest_path(self, name):
+        return os.path.join(self.path, f'{name}.json')
+
+
+class FeatureSet():
+    """An opened feature set, with its sorted keys and memory-mapped columns."""
+
+    def __init__(self, path, manifest):
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.descriptions = manifest['columns']
+        self.columns = list(self.descriptions)
+        self.values = {col: np.load(os.path.join(path, description['file']), mmap_mode='r')
+                       for col, description in self.descriptions.items()}
+
+
+    def lookup(self, keys, columns):
+        """Look up the given columns for a list of keys, using a binary search over the sorted keys."""
+        keys = keys.astype(self.keys.dtype)
+        positions = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        found = (self.keys[positions] == keys) if len(self.keys) > 0 else np.zeros(len(keys), dtype=bool)
+        positions = np.where(found, positions, 0)
+        return pd.DataFrame({col: decode_column(self.values[col][positions] if len(self.keys) > 0 else
+                                                np.zeros(len(keys), dtype=self.values[col].dtype),
+                                                self.descriptions[col], found) for col in columns},
+                            columns=columns)
+
+
+######################
+## Helper functions ##
+######################
+
+def key_array(keys):
+    """Convert keys to an array that can be sorted and stored without pickling: numbers, or strings otherwise."""
+    keys = np.asarray(keys)
+    return keys if np.issubdtype(keys.dtype, np.number) else keys.astype(str)
+
+
+def encode_column(col):
+    """Convert a column to an array that can be memory-mapped, and a description of how to convert it back."""
+    if pd.api.types.is_bool_dtype(col) or pd.api.types.is_numeric_dtype(col):
+        return np.asarray(col.values), {'kind': 'numeric'}
+    if pd.api.types.is_datetime64_dtype(col):
+        return col.values.astype('datetime64[ns]').astype('int64'), {'kind': 'datetime'}
+    codes, categories = pd.factorize(col)
+    categories = [value if isinstance(value, (str, int, float)) else str(value) for value in categories]
+    codes = codes.astype(np.int32 if len(categories) >= np.iinfo(np.int16).max else np.int16)
+    return codes, {'kind': 'category', 'categories': categories}
+
+
+def decode_column(values, description, found):
+    """Convert stored values back to a column. Values of keys that were not found become missing values."""
+    if description['kind'] == 'category':
+        codes = np.where(found, values, -1)
+        return pd.Categorical.from_codes(codes, description['categories'])
+    if description['kind'] == 'datetime':
+        return pd.Series(values.astype('datetime64[ns]')).where(found)
+    if found.all():
+        return np.asarray(values)
+    return pd.Series(values).where(found)
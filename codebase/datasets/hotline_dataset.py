@@ -43,4 +43,5 @@ class HotlineDataset(datasets.MyDataset):
     # Set the class attributes.
     name = 'hotline'
     table_name = 'bwv_hotline_melding'
-    id_column = 'id'
\ No newline at end of file
+    id_column = 'id'
+    modified_column = 'wzs_update_datumtijd'
\ No newline at end of file
@@ -0,0 +1,105 @@
+####################################################################################################
+"""
+lazy_frame.py
+
+This module implements a lazily loaded view on a dataset version in the version store. Columns are
+only loaded from storage when they are accessed. Loaded columns are cached weakly, so they are
+released as soon as nothing else refers to them. Columns that are not (re)assigned keep their
+stored content hash, so a new version can be stored without loading or hashing them again.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+#############
+## Imports ##
+#############
+
+import pandas as pd
+import weakref
+import copy
+
+
+######################
+## Lazy frame class ##
+######################
+
+class LazyFrame():
+    """Dataframe-like view on a stored dataset version, which loads columns on demand."""
+
+    def __init__(self, store, manifest, columns=None):
+        self.store = store
+        self.name = manifest['dataset']
+        self.hashes = {col: h for col, h in manifest['columns'] if columns is None or col in columns}
+        self._columns = list(self.hashes)
+        self._assigned = {}  # Columns that were assigned after loading (kept in memory).
+        self._loaded = weakref.WeakValueDictionary()  # Stored columns that are in use (released when unused).
+        index = manifest['index']
+        if 'range' in index:
+            self.index = pd.RangeIndex(*index['range'], name=index['name'])
+        else:
+            self.index = pd.Index(store.load_object(index['object']).values, name=index['name'])
+
+
+    @property
+    def columns(self):
+        return pd.Index(self._columns)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __contains__(self, col):
+        return col in self._columns
+
+
+    def __getitem__(self, key):
+        """Get a single column as a Series, or a list of columns as a dataframe."""
+        if isinstance(key, list):
+            return pd.DataFrame({col: self[col] for col in key}, index=self.index, columns=key)
+        if key in self._assigned:
+            return self._assigned[key]
+        if key not in self.hashes:
+            raise KeyError(key)
+        series = self._loaded.get(key)
+        if series is None:
+            series = pd.Series(self.store.load_object(self.hashes[key]).values, index=self.index, name=key)
+            self._loaded[key] = series
+        return series
+
+
+    def __setitem__(self, key, value):
+        """Assign a column. Series are aligned on the index, like with a dataframe."""
+        if isinstance(value, pd.Series):
+            value = value.reindex(self.index)
+        else:
+            value = pd.Series(value, index=self.index)
+        self._assigned[key] = value.rename(key)
+        self.hashes.pop(key, None)
+        if key not in self._columns:
+            self._columns.append(key)
+
+
+    def drop(self, columns):
+        """Remove columns, without loading them."""
+        for col in columns:
+            self._columns.remove(col)
+            self._assigned.pop(col, None)
+            self.hashes.pop(col, None)
+
+
+    def snapshot(self):
+        """Create a copy which is not affected by later changes to this lazy frame. Stored columns are not loaded."""
+        snapshot = copy.copy(self)
+        snapshot.hashes = dict(self.hashes)
+        snapshot._columns = list(self._columns)
+        snapshot._assigned = {col: values.copy() for col, values in self._assigned.items()}
+        return snapshot
+
+
+    def to_frame(self):
+        """Load all columns, and return them as a dataframe."""
+        data = pd.DataFrame({col: self[col] for col in self._columns}, index=self.index, columns=self._columns)
+        data.name = self.name
+        return data
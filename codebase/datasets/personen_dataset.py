@@ -43,4 +43,7 @@ class PersonenDataset(datasets.MyDataset):
     # Set the class attributes.
     name = 'personen'
     table_name = 'bwv_personen'
-    id_column = 'id'
\ No newline at end of file
+    id_column = 'id'
+    stream_download = True
+    storage = 'parquet'
+    schema_hints = {'geslacht': 'category', 'gezinsverhouding': 'category'}
\ No newline at end of file
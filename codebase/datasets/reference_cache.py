@@ -0,0 +1,113 @@
+####################################################################################################
+"""
+reference_cache.py
+
+This module implements a cache for reference tables: auxiliary tables which are used to enrich
+datasets (e.g. bwv_adres_periodes, or a csv file with a mapping of categories). A reference table
+is loaded from its source once, and then kept on local storage for a limited time (its TTL, time
+to live). Recently used tables (or selections of their columns) are also kept in memory, up to a
+maximum number of tables, so repeated enrichment runs do not even read them from disk.
+
+Tables returned by the cache are shared between all users of the cache, and should not be modified.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+#############
+## Imports ##
+#############
+
+from collections import OrderedDict
+import pandas as pd
+import threading
+import time
+import os
+
+# Import own modules.
+from .storage import get_storage, find_storage
+
+
+###########################
+## Reference cache class ##
+###########################
+
+class ReferenceCache():
+    """Cache for reference tables, on local storage (with a TTL per table) and in memory (least recently used)."""
+
+    def __init__(self, path, max_tables=8):
+        self.path = path
+        self.max_tables = max_tables
+        self._tables = OrderedDict()  # (name, columns): (modification time, table), least recently used first.
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+
+    def get(self, name, loader, ttl, columns=None, storage='parquet'):
+        """
+        Get a reference table. The loader function is called to load the full table from its source when
+        there is no copy on local storage, or when the copy is older than ttl seconds. Optionally only
+        return a list of columns.
+        """
+        with self._lock:
+            self.refresh(name, loader, ttl, storage)
+            return self._get_in_memory((name, columns), self._mtime(name), lambda: self._load(name, columns))
+
+
+    def refresh(self, name, loader, ttl, storage='parquet'):
+        """
+        Make sure the local copy of a reference table is at most ttl seconds old, by loading it from its
+        source (using the loader function) otherwise. Returns the path of the local copy.
+        """
+        # Tables are (re)loaded one at a time, so concurrent users do not load the same table twice.
+        with self._lock:
+            mtime = self._mtime(name)
+            if mtime is None or time.time() - mtime >= ttl:
+                print(f"Reference table '{name}' is not cached or outdated. Loading it from its source.")
+                backend = get_storage(storage)
+                backend.save(loader(), os.path.join(self.path, f'{name}.{backend.extension}'), name)
+            path = os.path.join(self.path, name)
+            return f'{path}.{find_storage(path).extension}'
+
+
+    def get_csv(self, csv_path, columns=None):
+        """Get a reference table from a csv file. The file is read again when it has been modified."""
+        with self._lock:
+            return self._get_in_memory((csv_path, columns), os.path.getmtime(csv_path),
+                                       lambda: pd.read_csv(csv_path, usecols=columns))
+
+
+    def invalidate(self, name):
+        """Remove a reference table from the cache, so it is loaded from its source again on next use."""
+        with self._lock:
+            for key in [key for key in self._tables if key[0] == name]:
+                del self._tables[key]
+            path = os.path.join(self.path, name)
+            backend = find_storage(path)
+            while backend is not None:
+                os.remove(f'{path}.{backend.extension}')
+                backend = find_storage(path)
+
+
+    def _get_in_memory(self, key, mtime, load):
+        """Get a table from memory if it is up to date, and load it otherwise. Forgets the least recently used tables."""
+        key = (key[0], tuple(key[1]) if key[1] is not None else None)
+        if key not in self._tables or self._tables[key][0] != mtime:
+            self._tables[key] = (mtime, load())
+        self._tables.move_to_end(key)
+        while len(self._tables) > self.max_tables:
+            self._tables.popitem(last=False)
+        return self._tables[key][1]
+
+
+    def _load(self, name, columns=None):
+        path = os.path.join(self.path, name)
+        backend = find_storage(path)
+        return backend.load(f'{path}.{backend.extension}', name, columns=columns)
+
+
+    def _mtime(self, name):
+        """Get the time at which a reference table was stored locally. Returns None if it is not stored."""
+        path = os.path.join(self.path, name)
+        backend = find_storage(path)
+        return None if backend is None else os.path.getmtime(f'{path}.{backend.extension}')
@@ -44,11 +44,13 @@ class StadiaDataset(datasets.MyDataset):
     name = 'stadia'
     table_name = 'import_stadia'
     id_column = 'stadium_id'
+    modified_column = 'wzs_update_datumtijd'
+    key_columns = ['adres_id', 'wvs_nr', 'sta_nr']
+    validity_rules = clean.DATE_RULES
 
 
+    @datasets.step('_ids')
     def add_zaak_stadium_ids(self):
         """Add necessary id's to the dataset."""
-        self.data['zaak_id'] = self.data['adres_id'].astype(int).astype(str) + '_' + self.data['wvs_nr'].astype(int).astype(str)
-        self.data['stadium_id'] = self.data['zaak_id'] + '_' + self.data['sta_nr'].astype(int).astype(str)
-        self.version += '_ids'
-        self.save()
\ No newline at end of file
+        self['zaak_id'] = self['adres_id'].astype(int).astype(str) + '_' + self['wvs_nr'].astype(int).astype(str)
+        self['stadium_id'] = self['zaak_id'] + '_' + self['sta_nr'].astype(int).astype(str)
\ No newline at end of file
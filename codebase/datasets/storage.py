@@ -0,0 +1,216 @@
+####################################################################################################
+"""
+storage.py
+
+This module implements the storage backends used to save and load dataset versions on local storage.
+The HDF5 backend stores complete dataframes, and is always available. The Parquet backend stores
+dataframes in a compressed columnar format, which allows loading a selection of columns, and
+skipping row groups using filters. It requires the pyarrow package.
+
+Filters use the same notation as pyarrow: a list of (column, operator, value) tuples, which must
+all hold. A list of such lists combines these conjunctions with 'or'.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+#############
+## Imports ##
+#############
+
+import pandas as pd
+import threading
+import os
+
+# Import the optional Parquet dependency.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+######################
+## Storage backends ##
+######################
+
+# The HDF5 library is not thread-safe, so all HDF5 file access (e.g. by concurrent downloads) is serialized.
+_hdf_lock = threading.RLock()
+
+
+class HdfStorage():
+    """Store dataset versions as HDF5 files. Filters and column selections are applied after loading."""
+
+    extension = 'h5'
+
+
+    def save(self, data, path, name, index=True):
+        """Save a dataframe to the given path. The index is always stored."""
+        # The fixed format can not contain categorical columns, so use the table format for those.
+        fmt = 'table' if any(str(dtype) == 'category' for dtype in data.dtypes) else 'fixed'
+        with _hdf_lock:
+            data.to_hdf(path_or_buf=path, key=name, mode='w', format=fmt)
+
+
+    def load(self, path, name, columns=None, filters=None):
+        """Load a dataframe from the given path."""
+        with _hdf_lock:
+            data = pd.read_hdf(path_or_buf=path, key=name, mode='r')
+        if filters:
+            data = data[filter_mask(data, filters)]
+        if columns is not None:
+            data = data[columns]
+        return data
+
+
+    def writer(self, path, name, min_itemsize=None):
+        """Create a writer, which appends chunks of a dataframe to an HDF5 table one at a time."""
+        return HdfChunkWriter(path, name, min_itemsize)
+
+
+class ParquetStorage():
+    """Store dataset versions as compressed Parquet files, which can be read per column and per row group."""
+
+    extension = 'parquet'
+
+
+    def __init__(self, compression='snappy', row_group_size=100000):
+        self.compression = compression
+        self.row_group_size = row_group_size
+
+
+    def save(self, data, path, name, index=True):
+        """
+        Save a dataframe to the given path. Falls back to HDF5 for data that Parquet can not store.
+        Set index to False to not store the index (it is restored as a range index when loading).
+        """
+        try:
+            table = pa.Table.from_pandas(data, preserve_index=index)
+            pq.write_table(table, path, compression=self.compression, row_group_size=self.row_group_size)
+        except pa.ArrowException as e:
+            print(f"Could not store dataset '{name}' as Parquet ({e}). Falling back to HDF5.")
+            if os.path.exists(path):
+                os.remove(path)
+            HdfStorage().save(data, os.path.splitext(path)[0] + '.' + HdfStorage.extension, name)
+
+
+    def load(self, path, name, columns=None, filters=None):
+        """Load a dataframe from the given path, reading only the given columns and matching row groups."""
+        table = pq.read_table(path, columns=columns, filters=filters, use_pandas_metadata=True, memory_map=True)
+        return table.to_pandas()
+
+
+    def writer(self, path, name, min_itemsize=None):
+        """Create a writer, which appends chunks of a dataframe to a Parquet file one row group at a time."""
+        return ParquetChunkWriter(path, self.compression)
+
+
+##########################
+## Chunk writer classes ##
+##########################
+
+class HdfChunkWriter():
+    """Append dataframe chunks to an HDF5 table. String columns need a maximum length up front (min_itemsize)."""
+
+    def __init__(self, path, name, min_itemsize=None):
+        self.name = name
+        self.min_itemsize = min_itemsize
+        with _hdf_lock:
+            self.store = pd.HDFStore(path, mode='w')
+
+    def write(self, chunk):
+        with _hdf_lock:
+            self.store.append(self.name, chunk, format='table', min_itemsize=self.min_itemsize, index=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        with _hdf_lock:
+            self.store.close()
+
+
+class ParquetChunkWriter():
+    """Append dataframe chunks to a Parquet file. The schema is taken from the first chunk."""
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.compression = compression
+        self.schema = None
+        self.parquet_writer = None
+
+    def write(self, chunk):
+        if self.parquet_writer is None:
+            # Columns that are empty in the first chunk can not be typed yet, so store them as strings.
+            schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+            fields = [pa.field(f.name, pa.string()) if f.type == pa.null() else f for f in schema]
+            self.schema = pa.schema(fields, metadata=schema.metadata)
+            self.parquet_writer = pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+        table = pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False)
+        self.parquet_writer.write_table(table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+######################
+## Helper functions ##
+######################
+
+STORAGE_BACKENDS = {'hdf': HdfStorage(), 'parquet': ParquetStorage()}
+
+
+def get_storage(storage='hdf'):
+    """Get a storage backend by name. Falls back to HDF5 when pyarrow is not installed."""
+    if storage == 'parquet' and pq is None:
+        print("Package 'pyarrow' is not installed. Falling back to HDF5 storage.")
+        storage = 'hdf'
+    return STORAGE_BACKENDS[storage]
+
+
+def find_storage(path_without_extension):
+    """Find the backend of the most recently saved file for a dataset version. Returns None if there is none."""
+    candidates = []
+    for name, backend in STORAGE_BACKENDS.items():
+        path = f'{path_without_extension}.{backend.extension}'
+        if os.path.exists(path) and (name != 'parquet' or pq is not None):
+            candidates.append((os.path.getmtime(path), name))
+    if not candidates:
+        return None
+    return STORAGE_BACKENDS[max(candidates)[1]]
+
+
+def filter_mask(data, filters):
+    """Compute a boolean row mask for a dataframe, based on filters in pyarrow notation."""
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    mask = pd.Series(False, index=data.index)
+    for conjunction in filters:
+        conjunction_mask = pd.Series(True, index=data.index)
+        for col, op, val in conjunction:
+            values = data[col]
+            if op in ['=', '==']:
+                conjunction_mask &= values == val
+            elif op == '!=':
+                conjunction_mask &= values != val
+            elif op == '<':
+                conjunction_mask &= values < val
+            elif op == '<=':
+                conjunction_mask &= values <= val
+            elif op == '>':
+                conjunction_mask &= values > val
+            elif op == '>=':
+                conjunction_mask &= values >= val
+            elif op == 'in':
+                conjunction_mask &= values.isin(val)
+            elif op == 'not in':
+                conjunction_mask &= ~values.isin(val)
+            else:
+                raise ValueError(f"Unknown filter operator '{op}'.")
+        mask |= conjunction_mask
+    return mask
@@ -0,0 +1,276 @@
+####################################################################################################
+"""
+version_store.py
+
+This module implements a content-addressed store for dataset versions.
+
+Every column (and non-trivial index) is stored once, as an object named after the hash of its
+content. A version is a small manifest listing the objects of its columns. Columns that do not
+change between versions are therefore shared, instead of being written again for every step.
+
+Each version is keyed by the processing step that created it, its parameters, and the content
+hashes of its inputs (its parents). Running a step again on identical inputs finds the existing
+version, instead of computing it again. The parent hashes link the versions into a lineage graph.
+The readable version names (e.g. 'download_leegstand_woningId') are kept as references to keys.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+#############
+## Imports ##
+#############
+
+import pandas as pd
+import threading
+import hashlib
+import pickle
+import json
+import time
+import os
+
+# Import own modules.
+from .storage import get_storage, find_storage, filter_mask
+from .lazy_frame import LazyFrame
+
+
+#########################
+## Version store class ##
+#########################
+
+# Lock for the refs files, which can be written concurrently (e.g. by background checkpoints).
+_refs_lock = threading.Lock()
+
+
+class VersionStore():
+    """Content-addressed store for dataset versions, with deduplicated column objects and lineage."""
+
+    def __init__(self, path):
+        self.path = path
+        self.objects_path = os.path.join(path, 'objects')
+        self.versions_path = os.path.join(path, 'versions')
+        self.refs_path = os.path.join(path, 'refs')
+        for p in [self.objects_path, self.versions_path, self.refs_path]:
+            os.makedirs(p, exist_ok=True)
+
+
+    def make_key(self, step, parents, params=None):
+        """Compute the key of a version, based on the step that creates it, its parents and its parameters."""
+        description = json.dumps([step, list(parents), params or {}], sort_keys=True, default=str)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+
+    def content_hash(self, data):
+        """Compute the content hash of a dataframe (or lazy frame), based on its column names, column contents and index."""
+        return hash_manifest(self.column_hashes(data), index_description(data.index))
+
+
+    def column_hashes(self, data):
+        """Compute the content hash of each column. Stored columns of a lazy frame keep their known hash, without loading."""
+        known = data.hashes if isinstance(data, LazyFrame) else {}
+        return [[col, known[col] if col in known else hash_values(data[col])] for col in data.columns]
+
+
+    def has(self, key):
+        """Check whether a version with the given key is in the store."""
+        return os.path.exists(self._manifest_path(key))
+
+
+    def commit(self, data, dataset_name, version, key=None, step='save', params=None, parents=(), storage='hdf'):
+        """
+        Store a version of a dataframe (or lazy frame), and refer to it by the given version name. Only
+        column objects that are not yet in the store are written. Without a key, the key is based on the
+        content. Returns the key of the stored version.
+        """
+        columns = self.column_hashes(data)
+        for col, h in columns:
+            if not self.has_object(h):
+                self._write_object(h, data[col], storage)
+        index = index_description(data.index)
+        if 'object' in index and not self.has_object(index['object']):
+            self._write_object(index['object'], pd.Series(data.index), storage)
+        content = hash_manifest(columns, index)
+        if key is None:
+            key = self.make_key(step, parents, dict(params or {}, content=content))
+        manifest = {'key': key,
+                    'dataset': dataset_name,
+                    'step': step,
+                    'params': params or {},
+                    'parents': list(parents),
+                    'content': content,
+                    'columns': columns,
+                    'index': index,
+                    'created': time.time()}
+        write_json(self._manifest_path(key), manifest)
+        self.tag(dataset_name, version, key)
+        return key
+
+
+    def load(self, key, columns=None, filters=None):
+        """Load the version with the given key as a dataframe. Optionally only load the given columns/rows."""
+        manifest = self.manifest(key)
+        names = [col for col, _ in manifest['columns']]
+        if columns is not None:
+            names = [col for col in names if col in columns or (filters and col in filter_columns(filters))]
+        hashes = dict(manifest['columns'])
+        data = pd.DataFrame({col: self.load_object(hashes[col]) for col in names}, columns=names)
+        index = manifest['index']
+        if 'range' in index:
+            data.index = pd.RangeIndex(*index['range'], name=index['name'])
+        else:
+            data.index = pd.Index(self.load_object(index['object']).values, name=index['name'])
+        if filters:
+            data = data[filter_mask(data, filters)]
+        if columns is not None:
+            data = data[[col for col in columns if col in data.columns]]
+        return data
+
+
+    def load_lazy(self, key, columns=None):
+        """Load the version with the given key as a lazy frame, which only loads columns when they are accessed."""
+        return LazyFrame(self, self.manifest(key), columns)
+
+
+    def has_object(self, h):
+        """Check whether a column object is in the store."""
+        return find_storage(os.path.join(self.objects_path, h)) is not None
+
+
+    def load_object(self, h):
+        """Load a single column object (as a Series without index) from the store."""
+        path = os.path.join(self.objects_path, h)
+        backend = find_storage(path)
+        if backend is None:
+            raise FileNotFoundError(f"Object '{h}' is missing from the version store.")
+        return backend.load(f'{path}.{backend.extension}', 'column')['values'].reset_index(drop=True)
+
+
+    def manifest(self, key):
+        """Get the manifest of a version."""
+        with open(self._manifest_path(key)) as f:
+            return json.load(f)
+
+
+    def tag(self, dataset_name, version, key):
+        """Refer to a version key using a readable version name."""
+        with _refs_lock:
+            refs = self.refs(dataset_name)
+            refs[version] = key
+            write_json(self._refs_path(dataset_name), refs)
+
+
+    def refs(self, dataset_name):
+        """Get all readable version names of a dataset, and the keys they refer to."""
+        path = self._refs_path(dataset_name)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+
+    def resolve(self, dataset_name, version):
+        """Get the key referred to by a version name. Returns None if the name is unknown."""
+        key = self.refs(dataset_name).get(version)
+        return key if key is not None and self.has(key) else None
+
+
+    def lineage(self, key):
+        """Get the manifests of a version and all versions it was derived from (nearest first)."""
+        by_content = {}
+        for filename in os.listdir(self.versions_path):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(self.versions_path, filename)) as f:
+                manifest = json.load(f)
+            by_content.setdefault(manifest['content'], manifest)
+        lineage = []
+        todo = [self.manifest(key)]
+        seen = set()
+        while todo:
+            manifest = todo.pop(0)
+            if manifest['key'] in seen:
+                continue
+            seen.add(manifest['key'])
+            lineage.append(manifest)
+            todo += [by_content[parent] for parent in manifest['parents'] if parent in by_content]
+        return lineage
+
+
+    def _write_object(self, h, values, storage):
+        path = os.path.join(self.objects_path, h)
+        if not self.has_object(h):
+            # Write to a temporary file first, so concurrent writers of the same object do not interfere.
+            backend = get_storage(storage)
+            tmp_path = f'{path}.tmp{threading.get_ident()}'
+            data = pd.DataFrame({'values': values.values})
+            backend.save(data, f'{tmp_path}.{backend.extension}', 'column', index=False)
+            for extension in ['parquet', 'h5']:  # The Parquet backend can fall back to HDF5.
+                if os.path.exists(f'{tmp_path}.{extension}'):
+                    os.replace(f'{tmp_path}.{extension}', f'{path}.{extension}')
+
+
+    def _manifest_path(self, key):
+        return os.path.join(self.versions_path, f'{key}.json')
+
+
+    def _refs_path(self, dataset_name):
+        return os.path.join(self.refs_path, f'{dataset_name}.json')
+
+
+######################
+## Helper functions ##
+######################
+
+def hash_values(values):
+    """Compute the content hash of a column (or index) from its values and type. Its name is not included."""
+    h = hashlib.sha1(str(values.dtype).encode())
+    try:
+        h.update(pd.util.hash_pandas_object(values, index=False).values.tobytes())
+        # Values are hashed by their string representation, so e.g. True and 'True' get the same hash. In
+        # columns that mix types, the type of each value is part of the hash too.
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True).startswith('mixed'):
+            types = pd.Series([type(value).__name__ for value in values], dtype=object)
+            h.update(pd.util.hash_pandas_object(types, index=False).values.tobytes())
+    except TypeError:
+        # Unhashable values (e.g. lists) are hashed using their pickled representation.
+        h.update(pickle.dumps(list(values)))
+    return h.hexdigest()
+
+
+def hash_file(path, block_size=1 << 20):
+    """Compute the content hash of a file (e.g. a csv file or reference table which a processing step reads)."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def index_description(index):
+    """Describe an index: a range index is described by its bounds, other indices by their content hash."""
+    if isinstance(index, pd.RangeIndex):
+        step = int(index[1] - index[0]) if len(index) > 1 else 1
+        start = int(index[0]) if len(index) > 0 else 0
+        return {'range': [start, start + step * len(index), step], 'name': index.name}
+    return {'object': hash_values(pd.Series(index)), 'name': index.name}
+
+
+def hash_manifest(column_hashes, index):
+    """Compute the content hash of a dataframe from its column hashes and index description."""
+    description = json.dumps([[list(c) for c in column_hashes], index], sort_keys=True, default=str)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def filter_columns(filters):
+    """Get the names of all columns used in a list of filters."""
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    return {col for conjunction in filters for col, _, _ in conjunction}
+
+
+def write_json(path, content):
+    """Write a json file atomically, so readers never see a half-written file."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f, default=str)
+    os.replace(tmp_path, path)
@@ -32,6 +32,9 @@ HOME = Path.home()  # Home path for old VAO.
 # HOME = os.path.join('/data', USERNAME)  # Set home for new VAO.
 DATA_PATH = os.path.join(HOME, 'Documents/woonfraude/data/')
 
+# Mapping of beh_oms values to case categories.
+CATEGORIES_CSV_PATH = os.path.join(DATA_PATH, 'aanvulling_beh_oms.csv')
+
 
 ########################
 ## ZakenDataset class ##
@@ -44,27 +47,35 @@ class ZakenDataset(datasets.MyDataset):
     name = 'zaken'
     table_name = 'import_wvs'
     id_column = 'zaak_id'
+    storage = 'parquet'
+    modified_column = 'wzs_update_datumtijd'
+    key_columns = ['adres_id', 'wvs_nr']
+    validity_rules = clean.DATE_RULES
+    schema_hints = {'sdl_naam': 'category', 'beh_code': 'category'}
 
 
+    @datasets.step('_categories', csv_files=[CATEGORIES_CSV_PATH])
     def add_categories(self):
         """Add categories to the zaken dataframe."""
-        clean.lower_strings(self.data)
-        datasets.add_column(df=self.data, new_col='categorie', match_col='beh_oms',
-                   csv_path=os.path.join(HOME, 'Documents/woonfraude/data/aanvulling_beh_oms.csv'))
-        self.version += '_categories'
-        self.save()
+        # Only lower the column which is matched with the (lowercase) mapping. All string columns are lowered later
+        # by the CleanTransformer. Working on the dataset itself (not self.data), a lazily loaded version then only
+        # loads beh_oms.
+        clean.lower_strings(self, ['beh_oms'])
+        datasets.add_column(df=self, new_col='categorie', match_col='beh_oms', csv_path=CATEGORIES_CSV_PATH)
 
 
+    @datasets.step('_filterCategories')
     def filter_categories(self):
         """
         Remove cases (zaken) with categories 'woningkwaliteit' or 'afdeling vergunninen beheer'.
         These cases do not contain reliable samples.
         """
-        self.data = self.data[~self.data.categorie.isin(['woningkwaliteit', 'afdeling vergunningen en beheer'])]
-        self.version += '_filterCategories'
-        self.save()
+        data = self.data[~self.data.categorie.isin(['woningkwaliteit', 'afdeling vergunningen en beheer'])]
+        # Remove the filtered categories, so they get no (empty) features when the categories are HOT encoded.
+        self.data = data.assign(categorie=data['categorie'].cat.remove_unused_categories())
 
 
+    @datasets.step('_finishedCases')
     def keep_finished_cases(self, stadia):
         """Only keep cases (zaken) that have 100% certainly been finished. Uses stadia dataframe as input."""
 
@@ -72,42 +83,29 @@ class ZakenDataset(datasets.MyDataset):
         zaken = self.data
 
         # Select finished zoeklicht cases.
-        zaken['mask'] = zaken.afs_oms == 'zl woning is beschikbaar gekomen'
-        zaken['mask'] += zaken.afs_oms == 'zl geen woonfraude'
-
-        # Indicate which stadia are indicative of finished cases.
-        stadia['mask'] = stadia.sta_oms.isin(['rapport naar han', 'bd naar han'])
+        zl_mask = zaken.afs_oms.isin(['zl woning is beschikbaar gekomen', 'zl geen woonfraude'])
 
-        # Indicate which stadia are from before 2013. Cases linked to these stadia should be
-        # disregarded. Before 2013, 'rapport naar han' and 'bd naar han' were used inconsistently.
-        timestamp_2013 =  pd.Timestamp('2013-01-01')
-        stadia['before_2013'] = stadia.begindatum < timestamp_2013
-
-        # Create groups linking cases to their stadia.
-        zaak_groups = stadia.groupby('zaak_id').groups
+        # Indicate per case whether any of its stadia indicates a finished case, and whether any of its stadia is
+        # from before 2013. Cases linked to these stadia should be disregarded. Before 2013, 'rapport naar han'
+        # and 'bd naar han' were used inconsistently.
+        timestamp_2013 = pd.Timestamp('2013-01-01')
+        zaak_stadia = pd.DataFrame({'zaak_id': stadia.zaak_id,
+                                    'finished': stadia.sta_oms.isin(['rapport naar han', 'bd naar han']),
+                                    'before_2013': stadia.begindatum < timestamp_2013})
+        zaak_stadia = zaak_stadia.groupby('zaak_id').agg({'finished': 'any', 'before_2013': 'any'})
 
         # Select all finished cases based on "rapport naar han" and "bd naar han" stadia.
-        keep_ids = []
-        for zaak_id, stadia_ids in zaak_groups.items():
-            zaak_stadia = stadia.loc[stadia_ids]
-            if sum(zaak_stadia['mask']) >= 1 and sum(zaak_stadia['before_2013']) == 0:
-                keep_ids.append(zaak_id)
-        rap_zaken = zaken[zaken.zaak_id.isin(keep_ids)]
-
-        # Combine all finished cases.
-        finished_cases = pd.concat([zl_zaken, rap_zaken], sort=True)
+        keep_ids = zaak_stadia.index[zaak_stadia.finished & ~zaak_stadia.before_2013]
+        rap_mask = zaken.zaak_id.isin(keep_ids)
 
-        # Remove possible duplicates and temporary mask.
-        finished_cases.drop_duplicates(inplace=True)
-        finished_cases.drop(columns=['mask'], inplace=True)
+        # Combine all finished cases, and remove possible duplicates.
+        finished_cases = zaken[zl_mask | rap_mask].drop_duplicates()
 
         # Print results.
         print(f'Selected {len(finished_cases)} finished cases from a total of {len(zaken)} cases.')
 
         # Only keep the sleection of finished of cases.
         self.data = finished_cases
-        self.version += '_finishedCases'
-        self.save()
 
 
     def add_binary_label_zaken(self, stadia):
@@ -15,10 +15,16 @@ Written by Swaan Dekkers & Thomas Jongstra
 #############
 
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from sklearn.utils.validation import check_is_fitted
+from concurrent.futures import ProcessPoolExecutor
+import scipy.sparse as sp
 import pandas as pd
 import numpy as np
+import tempfile
+import shutil
 import math
+import os
 
 
 #####################################
@@ -26,91 +32,384 @@ import math
 #####################################
 
 class FeatureExtractionTransformer(BaseEstimator, TransformerMixin):
-    """Class for performing feature extraction steps on dataframes within the sklearn pipeline."""
+    """
+    Class for performing feature extraction steps on dataframes within the sklearn pipeline. The vocabularies of
+    the text and categorical columns are learned by fit, so transform always creates the same feature columns.
+    """
 
     def __init__(self,
                  text_features_cols_hot: list = [],  # List should contain names of text columns to extract features from.
                  categorical_cols_hot: list = [],  # List should contain names of categorical columnsto extract features from, using HOT encoding.
                  categorical_cols_no_hot: list = [], # List should contain names of categorical columns to extract features from, not using HOT encoding.
                  extract_date_features: bool = False,  # Boolean indicating whether features should be extracted from all date columns.
+                 date_features_cyclical: bool = False,  # Also encode the month, day and weekday of dates as cyclical (sin/cos) features.
+                 date_features_reference: str = None,  # Also add the number of days since this date (e.g. '2010-01-01') for each date column.
+                 date_features_missing: float = np.nan,  # Value of the date features of missing dates (e.g. -1 to get integer date features).
+                 sparse: bool = False,  # Return a SparseFeatures object, with the text and HOT encoded features in a sparse matrix.
+                 n_hash_features: int = None,  # Hash text and HOT encoded values into this many features per column, instead of learning vocabularies.
+                 n_jobs: int = 1,  # Number of processes extracting the features of the text and categorical columns (-1 for all CPUs).
                 ):
         self.text_features_cols_hot = text_features_cols_hot
         self.categorical_cols_hot = categorical_cols_hot
         self.categorical_cols_no_hot = categorical_cols_no_hot
         self.extract_date_features = extract_date_features
+        self.date_features_cyclical = date_features_cyclical
+        self.date_features_reference = date_features_reference
+        self.date_features_missing = date_features_missing
+        self.sparse = sparse
+        self.n_hash_features = n_hash_features
+        self.n_jobs = n_jobs
 
     def fit(self, X, y=None):
+        """Learn the vocabulary of each text and categorical column (not needed for hashed columns)."""
+        self.vectorizers_ = {col: fit_vectorizer(X[col], self.n_hash_features) for col in self.text_features_cols_hot}
+        hot_cols = [] if self.n_hash_features else self.categorical_cols_hot
+        self.vocabularies_ = {col: learn_vocabulary(X[col]) for col in hot_cols + self.categorical_cols_no_hot}
+        self.feature_names_ = [name for col in self.text_features_cols_hot for name in text_feature_names(col, self.vectorizers_[col])] + \
+                              hot_feature_names(self.categorical_cols_hot, self.vocabularies_, self.n_hash_features)
         return self
 
     def transform(self, X):
+        check_is_fitted(self, 'vocabularies_')
+        if self.n_jobs != 1:
+            return self._transform_parallel(X)
+        # In sparse mode, the text and HOT encoded features are collected as sparse blocks (names, matrix).
+        blocks = []
         if self.text_features_cols_hot != []:
-            X = extract_text_features_cols_hot(X, self.text_features_cols_hot)
+            if self.sparse:
+                blocks += [text_features_col(X[col], self.vectorizers_[col]) for col in self.text_features_cols_hot]
+            else:
+                X = extract_text_features_cols_hot(X, self.text_features_cols_hot, self.vectorizers_)
         if self.categorical_cols_hot != []:
-            X = extract_categorical_cols_hot(X, self.categorical_cols_hot)
+            if self.sparse:
+                blocks.append((hot_feature_names(self.categorical_cols_hot, self.vocabularies_, self.n_hash_features),
+                               hot_features(X, self.categorical_cols_hot, self.vocabularies_, self.n_hash_features, sparse=True)))
+            else:
+                X = extract_categorical_cols_hot(X, self.categorical_cols_hot, self.vocabularies_, self.n_hash_features)
         if self.categorical_cols_no_hot != []:
-            X = extract_categorical_cols_no_hot(X, self.categorical_cols_no_hot)
+            X = extract_categorical_cols_no_hot(X, self.categorical_cols_no_hot, self.vocabularies_)
         if self.extract_date_features:
-            X = extract_date_features(X)
+            X = extract_date_features(X, self.date_features_cyclical, self.date_features_reference,
+                                      self.date_features_missing)
+        if self.sparse:
+            names = [name for block_names, _ in blocks for name in block_names]
+            matrix = sp.hstack([matrix for _, matrix in blocks], format='csr') if blocks else sp.csr_matrix((len(X), 0))
+            return SparseFeatures(X, matrix, names)
         return X
 
+    def _transform_parallel(self, X):
+        """
+        Extract the text and categorical features of all columns in a process pool (see extract_columns_parallel),
+        and add them to the dataframe at once. The result is the same as for transform with n_jobs=1.
+        """
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        text, hot, codes = extract_columns_parallel(X, self.text_features_cols_hot, self.categorical_cols_hot,
+                                                    self.categorical_cols_no_hot, self.vectorizers_, self.vocabularies_,
+                                                    self.n_hash_features, self.sparse, n_jobs)
+        hot_names = hot_feature_names(self.categorical_cols_hot, self.vocabularies_, self.n_hash_features)
+        codes = pd.DataFrame({col + '_code': codes[col] for col in self.categorical_cols_no_hot}, index=X.index)
+        if self.sparse:
+            X = pd.concat([X, codes], axis=1, sort=False)
+            if self.extract_date_features:
+                X = extract_date_features(X, self.date_features_cyclical, self.date_features_reference,
+                                          self.date_features_missing)
+            names = [name for names, _ in text for name in names] + hot_names
+            return SparseFeatures(X, sp.hstack([matrix for _, matrix in text] + [hot], format='csr'), names)
+        text = [pd.DataFrame(matrix.toarray(), columns=names, index=X.index) for names, matrix in text]
+        X = pd.concat([X] + text + [pd.DataFrame(hot, columns=hot_names, index=X.index), codes], axis=1, sort=False)
+        if self.extract_date_features:
+            X = extract_date_features(X, self.date_features_cyclical, self.date_features_reference,
+                                      self.date_features_missing)
+        return X
+
+
+#####################
+## Sparse features ##
+#####################
+
+class SparseFeatures():
+    """
+    Feature matrix consisting of a dataframe (with the numeric and non-encoded columns) and a sparse CSR matrix
+    (with the text and HOT encoded features). The names of the sparse columns are kept in sparse_columns.
+    """
+
+    def __init__(self, dense, sparse, sparse_columns):
+        self.dense = dense
+        self.sparse = sparse
+        self.sparse_columns = list(sparse_columns)
+
+
+    @property
+    def columns(self):
+        return list(self.dense.columns) + self.sparse_columns
+
+
+    @property
+    def feature_names(self):
+        """Names of the columns of the matrix returned by to_matrix."""
+        return list(self.dense._get_numeric_data().columns) + self.sparse_columns
+
+
+    @property
+    def shape(self):
+        return (len(self.dense), len(self.dense.columns) + len(self.sparse_columns))
+
+
+    def __len__(self):
+        return len(self.dense)
+
+
+    def __getitem__(self, col):
+        return self.dense[col]
+
+
+    def drop(self, columns):
+        """Drop columns from the dataframe part."""
+        return SparseFeatures(self.dense.drop(columns=columns), self.sparse, self.sparse_columns)
+
+
+    def take(self, positions):
+        """Select rows by position."""
+        return SparseFeatures(self.dense.iloc[positions], self.sparse[positions], self.sparse_columns)
+
+
+    def to_matrix(self, dtype='float32'):
+        """Combine the numeric columns of the dataframe and the sparse features into a single CSR matrix."""
+        numeric = sp.csr_matrix(self.dense._get_numeric_data().values.astype(dtype))
+        return sp.hstack([numeric, self.sparse.astype(dtype)], format='csr')
+
 
 ############################
 ## Features based on text ##
 ############################
 
-def extract_text_features_col(df, col):
+def fit_vectorizer(col, n_hash_features=None):
+    """Learn the vocabulary of a text column, or create a vectorizer hashing words into n_hash_features features."""
+    if n_hash_features:
+        return HashingVectorizer(n_features=n_hash_features, alternate_sign=False, norm=None)
+    return CountVectorizer().fit(col.fillna(''))
+
+def text_feature_names(col_name, vectorizer):
+    """Names of the text features of a column, prefixed with the name of the column."""
+    if isinstance(vectorizer, HashingVectorizer):
+        return [f'{col_name}#hash{i}' for i in range(vectorizer.n_features)]
+    get_feature_names = getattr(vectorizer, 'get_feature_names_out', None) or vectorizer.get_feature_names
+    return [col_name + '#' + x for x in get_feature_names()]  # Prefix each feature with name of the originating raw feature
+
+def text_features_col(col, vectorizer=None):
+    """
+    Extract text features from a single column, using a fitted vectorizer (by default, the vocabulary is learned
+    from the column itself). Return the feature names and a sparse occurrence matrix.
+    """
+    vectorizer = vectorizer or fit_vectorizer(col)
+    X = vectorizer.transform(col.fillna(''))
+    return text_feature_names(col.name, vectorizer), X.tocsr()
+
+def extract_text_features_col(df, col, vectorizer=None):
     """Extract text features from a single column in a df. Return an occurrence dataframe encoding based on these features."""
-    vectorizer = CountVectorizer()
-    X = vectorizer.fit_transform(df[col])
-    features = vectorizer.get_feature_names()
-    matrix = X.toarray()
-    features = [col + '#' + x for x in features]  # Prefix each feature with name of the originating raw feature
-    col_features = pd.DataFrame(data=matrix, columns=features)
+    features, X = text_features_col(df[col], vectorizer)
+    col_features = pd.DataFrame(data=X.toarray(), columns=features, index=df.index)
     return col_features
 
-def extract_text_features_cols_hot(df, cols):
+def extract_text_features_cols_hot(df, cols, vectorizers={}):
     """Create encoded feature columns for the dataframe, based on the defined text columns."""
     all_col_features = []
     for col in cols:
-        col_features = extract_text_features_col(df[col])
+        col_features = extract_text_features_col(df, col, vectorizers.get(col))
         all_col_features.append(col_features)
     df = pd.concat([df] + all_col_features, axis=1, sort=False)
     return df
 
-def extract_categorical_cols_hot(df, cols):
-    """Create HOT encoded feature columns for the dataframe, based on the defined categorical columns."""
-    all_col_features = []
-    for col in cols:
-        print(f"Now extracting features from column: '{col}'.")
-        col_features = pd.get_dummies(df[col], prefix=col, prefix_sep='#')
-        all_col_features.append(col_features)
-        print("Done!")
-    df = pd.concat([df] + all_col_features, axis=1, sort=False)
+def learn_vocabulary(col):
+    """Learn the vocabulary of a categorical column: its categories, or its sorted unique values (like pd.get_dummies)."""
+    if col.dtype.name == 'category':
+        return col.cat.categories
+    return pd.Index(pd.unique(col.dropna())).sort_values()
+
+def vocabulary_codes(col, vocabulary):
+    """Get the position of each value of a column in the vocabulary (-1 for missing and unknown values)."""
+    codes, uniques = pd.factorize(col)
+    return np.append(vocabulary.get_indexer(uniques), -1)[codes]
+
+def hashed_codes(col, n_hash_features):
+    """Hash each value of a column to a code below n_hash_features (-1 for missing values). Hashes are stable between runs."""
+    codes, uniques = pd.factorize(col)
+    return np.append(hash_values(uniques, n_hash_features), -1)[codes]
+
+def hash_values(values, n_hash_features):
+    """Hash values to codes below n_hash_features, using their string representation."""
+    return (pd.util.hash_array(pd.Index(values).astype(str).values) % n_hash_features).astype(np.int64)
+
+def hot_feature_names(cols, vocabularies, n_hash_features=None):
+    """Names of the HOT encoded features of the columns, in the order of their layout."""
+    if n_hash_features:
+        return [f'{col}#hash{i}' for col in cols for i in range(n_hash_features)]
+    return [f'{col}#{value}' for col in cols for value in vocabularies[col]]
+
+def hot_features(df, cols, vocabularies, n_hash_features=None, sparse=False):
+    """
+    HOT encode columns into a single block with a fixed layout: for each column one feature per value of its
+    vocabulary, or n_hash_features hashed features. Missing and unknown values get no feature. Returns a sparse
+    CSR matrix, or a pre-allocated uint8 array.
+    """
+    widths = [n_hash_features or len(vocabularies[col]) for col in cols]
+    offsets = np.cumsum([0] + widths[:-1])
+    all_rows, all_codes = [], []
+    for col, offset in zip(cols, offsets):
+        codes = hashed_codes(df[col], n_hash_features) if n_hash_features else vocabulary_codes(df[col], vocabularies[col])
+        rows = np.flatnonzero(codes >= 0)
+        all_rows.append(rows)
+        all_codes.append(offset + codes[rows])
+    rows, codes = np.concatenate(all_rows), np.concatenate(all_codes)
+    if sparse:
+        return sp.csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, codes)), shape=(len(df), sum(widths)))
+    block = np.zeros((len(df), sum(widths)), dtype=np.uint8)
+    block[rows, codes] = 1
+    return block
+
+def extract_categorical_cols_hot(df, cols, vocabularies=None, n_hash_features=None):
+    """
+    Create HOT encoded feature columns for the dataframe, based on the defined categorical columns. Uses the given
+    vocabularies (by default, the values in df) or hashing, and adds all feature columns at once.
+    """
+    print(f"Now extracting features from columns: {cols}.")
+    if vocabularies is None and not n_hash_features:
+        vocabularies = {col: learn_vocabulary(df[col]) for col in cols}
+    names = hot_feature_names(cols, vocabularies, n_hash_features)
+    features = pd.DataFrame(hot_features(df, cols, vocabularies, n_hash_features), columns=names, index=df.index)
+    df = pd.concat([df, features], axis=1, sort=False)
+    print("Done!")
     return df
 
-def extract_categorical_cols_no_hot(df, cols):
-    """Create a numerically encoded feature column in the df based on each defined categorical column."""
+def extract_categorical_cols_no_hot(df, cols, vocabularies={}):
+    """
+    Create a numerically encoded feature column in the df based on each defined categorical column. The code of a
+    value is its position in the given vocabulary of the column (by default, the values in the column).
+    """
     all_col_features = []
     for col in cols:
         print(f"Now extracting features from column: '{col}'.")
-        col_features = df.col.astype('category').cat.codes
+        codes = vocabulary_codes(df[col], vocabularies[col] if col in vocabularies else learn_vocabulary(df[col]))
+        col_features = pd.Series(pd.to_numeric(codes, downcast='integer'), index=df.index, name=col + '_code')
         all_col_features.append(col_features)
         print("Done!")
     df = pd.concat([df] + all_col_features, axis=1, sort=False)
     return df
 
 
+#########################
+## Parallel extraction ##
+#########################
+
+def extract_columns_parallel(df, text_cols, hot_cols, no_hot_cols, vectorizers, vocabularies, n_hash_features=None,
+                             sparse=False, n_jobs=4):
+    """
+    Extract the features of text and categorical columns in a process pool, one task per column. Each column is
+    factorized, and its codes are written to a memory mapped file: the workers only receive the unique values. The
+    workers write the HOT encoded features directly into a memory mapped uint8 block (or return their positions in
+    sparse mode). Returns the text features per column (names, sparse matrix), the HOT encoded block (with the
+    layout of hot_features), and the codes of the no-hot columns.
+    """
+    print(f"Now extracting features from columns {text_cols + hot_cols + no_hot_cols} using {n_jobs} processes.")
+    widths = [n_hash_features or len(vocabularies[col]) for col in hot_cols]
+    offsets = np.cumsum([0] + widths[:-1])
+    block_shape = (0 if sparse else len(df), sum(widths))
+    # All files are created in a single temporary directory, which is removed whatever happens.
+    directory = tempfile.mkdtemp(prefix='extract_features_')
+    try:
+        shared = {col: share_codes(df[col], directory) for col in set(text_cols + hot_cols + no_hot_cols)}
+        block_path = os.path.join(directory, 'block.npy')
+        np.lib.format.open_memmap(block_path, mode='w+', dtype=np.uint8, shape=block_shape).flush()
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            def submit(kind, col, encoder, offset=0):
+                codes_path, uniques = shared[col]
+                return executor.submit(extract_column_task, kind, codes_path, uniques, encoder, n_hash_features,
+                                       block_path, offset)
+            text = [submit('text', col, vectorizers[col]) for col in text_cols]
+            hot = [submit('hot', col, vocabularies.get(col), offset) for col, offset in zip(hot_cols, offsets)]
+            no_hot = {col: submit('no_hot', col, vocabularies[col]) for col in no_hot_cols}
+            text = [(text_feature_names(col, vectorizers[col]), future.result()) for col, future in zip(text_cols, text)]
+            hot = [future.result() for future in hot]
+            codes = {col: future.result() for col, future in no_hot.items()}
+        if sparse:
+            rows = np.concatenate([rows for rows, _ in hot]) if hot else np.zeros(0, dtype=np.int64)
+            cols = np.concatenate([cols for _, cols in hot]) if hot else np.zeros(0, dtype=np.int64)
+            hot = sp.csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)), shape=(len(df), sum(widths)))
+        else:
+            hot = np.load(block_path)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print("Done!")
+    return text, hot, codes
+
+def share_codes(col, directory):
+    """Factorize a column, and save its codes to a file in directory. Returns the path and the unique values."""
+    codes, uniques = pd.factorize(col)
+    path = os.path.join(directory, f'codes_{len(os.listdir(directory))}.npy')
+    np.save(path, codes)
+    return path, uniques
+
+def extract_column_task(kind, codes_path, uniques, encoder, n_hash_features, block_path, offset):
+    """
+    Extract the features of a single column in a worker process, from its memory mapped codes and its unique
+    values. Text features are computed once per unique value.
+    """
+    codes = np.load(codes_path, mmap_mode='r')
+    if kind == 'text':
+        # Missing values are vectorized as empty strings (the last row).
+        X = encoder.transform(pd.Series(list(uniques) + [''], dtype=object).fillna('')).tocsr()
+        return X[np.where(codes >= 0, codes, len(uniques))]
+    unique_codes = hash_values(uniques, n_hash_features) if kind == 'hot' and n_hash_features else \
+                   encoder.get_indexer(uniques)
+    col_codes = np.append(unique_codes, -1)[codes]
+    if kind == 'no_hot':
+        return pd.to_numeric(col_codes, downcast='integer')
+    rows = np.flatnonzero(col_codes >= 0)
+    block = np.load(block_path, mmap_mode='r+')
+    if block.shape[0] == 0:
+        return rows, offset + col_codes[rows]
+    block[rows, offset + col_codes[rows]] = 1
+    block.flush()
+
+
 #####################
 ## Other Features  ##
 #####################
 
-def extract_date_features(df):
-    """Expand datetime values into individual features."""
-    for col in df.select_dtypes(include=['datetime64[ns]']):
+# Period of each date part, for the cyclical encodings (the first value of a part gets angle 0).
+DATE_PART_PERIODS = {'month': (1, 12), 'day': (1, 31), 'weekday': (0, 7)}
+
+def extract_date_features(df, cyclical=False, reference_date=None, missing_value=np.nan):
+    """
+    Expand datetime values into individual features: the month, day and weekday. Missing dates get missing_value:
+    NaN by default (the parts are then float32), or a sentinel such as -1 (the parts are then int8). Optionally add
+    cyclical sin/cos encodings of these parts (float32, NaN for missing dates), and the number of days since a
+    reference date (float32, or int32 with a sentinel). The dtypes only depend on the parameters, so every batch
+    gets the same schema. Dates are often repeated, so the parts are computed once per unique date and then expanded.
+    """
+    reference_date = pd.Timestamp(reference_date) if reference_date is not None else None
+    part_dtype, days_dtype = (np.float32, np.float32) if pd.isnull(missing_value) else (np.int8, np.int32)
+    for col in df.select_dtypes(include=['datetime64']):
         print(f"Now extracting features from column: '{col}'.")
-        df[col + '_month'] = pd.DatetimeIndex(df[col]).month
-        df[col + '_day'] = pd.DatetimeIndex(df[col]).day
-        df[col + '_weekday'] = pd.DatetimeIndex(df[col]).weekday
+        codes, uniques = pd.factorize(df[col])
+        dates = pd.Series(uniques)
+        features = {}
+        for part, (first, period) in DATE_PART_PERIODS.items():
+            values = getattr(dates.dt, part).values
+            features[f'{col}_{part}'] = expand_unique_values(codes, values.astype(part_dtype), missing_value)
+            if cyclical:
+                angles = 2 * np.pi * (values - first) / period
+                features[f'{col}_{part}_sin'] = expand_unique_values(codes, np.sin(angles).astype(np.float32), np.nan)
+                features[f'{col}_{part}_cos'] = expand_unique_values(codes, np.cos(angles).astype(np.float32), np.nan)
+        if reference_date is not None:
+            days = (dates - reference_date).dt.days.values
+            features[f'{col}_days'] = expand_unique_values(codes, days.astype(days_dtype), missing_value)
+        for name, values in features.items():
+            df[name] = values
         df.drop(columns=[col], inplace=True)
         print("Done!")
-    return df
\ No newline at end of file
+    return df
+
+def expand_unique_values(codes, values, missing):
+    """Expand values computed per unique value to all rows, using the codes from pd.factorize (-1 gets the missing value)."""
+    return np.append(values, np.array([missing], dtype=values.dtype))[codes]
@@ -0,0 +1,17 @@
+####################################################################################################
+"""
+conftest.py
+
+Shared test setup: makes the modules in the codebase directory importable, in the same way as the
+notebooks and the dashboard do.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import sys
+import os
+
+CODEBASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+if CODEBASE_PATH not in sys.path:
+    sys.path.insert(0, CODEBASE_PATH)
@@ -0,0 +1,83 @@
+####################################################################################################
+"""
+test_address_matcher.py
+
+Tests for the AddressMatcher, which are compared with the previous implementation of
+AdresDataset.match_bwv_bag (a merge followed by two groupby filters) on synthetic data.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+from datasets.address_matcher import AddressMatcher
+
+
+def synthetic_adres_bag(n_adres=2000, n_bag=1500, seed=0):
+    """Create synthetic adres and BAG dataframes with overlapping (and some ambiguous) address keys."""
+    rng = np.random.RandomState(seed)
+    streets, letters, additions = ['dam', 'rokin', 'spui', 'kalverstraat'], ['None', 'a', 'b'], ['None', '1', '2']
+    bag = pd.DataFrame({'_openbare_ruimte_naam_nummeraanduiding': rng.choice(streets, n_bag),
+                        'huisnummer_nummeraanduiding': rng.randint(1, 100, n_bag),
+                        'huisletter_nummeraanduiding': rng.choice(letters, n_bag),
+                        'huisnummer_toevoeging_nummeraanduiding': rng.choice(additions, n_bag),
+                        'status_coordinaat_code': rng.permutation(n_bag).astype(float),  # Unique, so the preference is defined.
+                        'bag_id': np.arange(n_bag)})
+    adres = pd.DataFrame({'adres_id': np.arange(n_adres),
+                          'sttnaam': rng.choice(streets + ['singel'], n_adres),
+                          'hsnr': rng.randint(1, 110, n_adres),
+                          'hsltr': rng.choice(letters, n_adres),
+                          'toev': rng.choice(additions, n_adres)})
+    return adres, bag
+
+
+def match_bwv_bag_merge(adres, bag):
+    """Previous implementation of AdresDataset.match_bwv_bag."""
+    new_df = pd.merge(adres, bag, how='left', left_on=['sttnaam', 'hsnr'],
+                      right_on=['_openbare_ruimte_naam_nummeraanduiding', 'huisnummer_nummeraanduiding'])
+    g = new_df.groupby('adres_id')
+    df_direct = g.filter(lambda x: len(x) == 1)
+    df_multiple = g.filter(lambda x: len(x) > 1)
+    df_multiple = df_multiple[(df_multiple['hsltr'] == df_multiple['huisletter_nummeraanduiding']) &
+                              (df_multiple['toev'] == df_multiple['huisnummer_toevoeging_nummeraanduiding'])]
+    df_result = pd.concat([df_direct, df_multiple])
+    df_result = df_result.sort_values(['adres_id', 'status_coordinaat_code'])
+    df_result = df_result.drop_duplicates(subset='adres_id', keep='first')
+    final_df = pd.merge(adres, df_result, how='left', on='adres_id', suffixes=('', '_y'))
+    final_df.drop(list(final_df.filter(regex='_y$')), axis=1, inplace=True)
+    return final_df
+
+
+def test_merge_matches_previous_implementation():
+    adres, bag = synthetic_adres_bag()
+    matcher = AddressMatcher(bag)
+    result = matcher.merge(adres)
+    expected = match_bwv_bag_merge(adres, bag)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected[result.columns], check_dtype=False)
+    assert set(matcher.match_counts) == {'direct', 'multiple', 'unresolved', 'none'}
+    assert sum(matcher.match_counts.values()) == len(adres)
+    assert min(matcher.match_counts.values()) > 0  # The synthetic data covers every match type.
+
+
+def test_match_one_agrees_with_match():
+    adres, bag = synthetic_adres_bag(n_adres=300)
+    matcher = AddressMatcher(bag)
+    positions, _ = matcher.match(adres)
+    for (_, row), position in zip(adres.iterrows(), positions):
+        match = matcher.match_one(row['sttnaam'], row['hsnr'], row['hsltr'], row['toev'])
+        assert (match is None and position == -1) or match['bag_id'] == matcher.bag['bag_id'][position]
+
+
+def test_normalized_keys_ignore_case_spacing_and_accents():
+    adres, bag = synthetic_adres_bag(n_adres=300)
+    messy = adres.copy()
+    messy['sttnaam'] = ' ' + messy['sttnaam'].str.upper().str.replace('A', 'Á') + ' '
+    expected, _ = AddressMatcher(bag).match(adres)
+    positions, _ = AddressMatcher(bag, normalize=True).match(messy)
+    assert (positions == expected).all()
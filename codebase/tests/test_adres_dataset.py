@@ -0,0 +1,86 @@
+####################################################################################################
+"""
+test_adres_dataset.py
+
+Tests for the enrichment of the adres dataset with personen features (adres_dataset.py), which are
+compared with a computation per address.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+import datasets.datasets as ds
+from datasets import AdresDataset
+from datasets.adres_dataset import PERSONEN_FEATURE_DEFAULTS
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    return tmp_path
+
+
+def synthetic_personen(n=300, n_adres=40, seed=0):
+    rng = np.random.RandomState(seed)
+    dates = pd.Timestamp('1930-01-01') + pd.to_timedelta(rng.randint(0, 32000, n), unit='D')
+    return pd.DataFrame({'ads_id_wa': rng.randint(1, n_adres, n),
+                         'geboortedatum': dates,
+                         'vertrekdatum_adam': np.where(rng.rand(n) < 0.3, pd.Timestamp('2015-01-01'), pd.NaT),
+                         'overlijdensdatum': np.where(rng.rand(n) < 0.1, pd.Timestamp('2016-01-01'), pd.NaT),
+                         'geslacht': rng.choice(['M', 'V'], n),
+                         'naam': rng.choice(['jansen', 'de vries', 'bakker', 'visser'], n),
+                         'gezinsverhouding': rng.choice([1., 2., 3., 7.], n)})
+
+
+def features_per_address(inhab):
+    """Compute the personen features of a single address, from its inhabitants."""
+    leeftijd = (pd.to_datetime('today') - inhab['geboortedatum']).dt.days / 365.25
+    niet_uitgeschreven = (inhab['vertrekdatum_adam'].notnull() | inhab['overlijdensdatum'].notnull()).sum()
+    n = len(inhab)
+    features = {'aantal_personen': n,
+                'aantal_vertrokken_personen': inhab['vertrekdatum_adam'].notnull().sum(),
+                'aantal_overleden_personen': inhab['overlijdensdatum'].notnull().sum(),
+                'aantal_niet_uitgeschrevenen': niet_uitgeschreven,
+                'leegstand': not n > niet_uitgeschreven,
+                'leeftijd_jongste_persoon': leeftijd.min(),
+                'leeftijd_oudste_persoon': leeftijd.max(),
+                'aantal_kinderen': (leeftijd < 18).sum(),
+                'percentage_kinderen': (leeftijd < 18).sum() / n,
+                'aantal_mannen': (inhab['geslacht'] == 'M').sum(),
+                'percentage_mannen': (inhab['geslacht'] == 'M').sum() / n,
+                'gemiddelde_leeftijd': leeftijd.mean(),
+                'stdev_leeftijd': leeftijd.std() if n > 1 else 0.,
+                'aantal_achternamen': inhab['naam'].nunique(),
+                'percentage_achternamen': inhab['naam'].nunique() / n}
+    for key in range(1, 8):
+        count = (inhab['gezinsverhouding'] == key).sum()
+        features[f'gezinsverhouding_{key}'] = count
+        features[f'percentage_gezinsverhouding_{key}'] = count / n
+    return features
+
+
+def test_personen_features_match_computation_per_address(data_path):
+    personen = synthetic_personen()
+    adres = AdresDataset()
+    adres.data = pd.DataFrame({'adres_id': np.arange(1, 46), 'leegstand': False})  # Addresses 40-45 have no inhabitants.
+    adres.data.name = 'adres'
+    adres.version = 'download'
+    adres.enrich_with_personen_features(personen)
+    result = adres.data.set_index('adres_id')
+
+    for adres_id in range(1, 46):
+        inhab = personen[personen['ads_id_wa'] == adres_id]
+        expected = features_per_address(inhab) if len(inhab) > 0 else \
+                   dict(PERSONEN_FEATURE_DEFAULTS, **{f'{prefix}gezinsverhouding_{key}': 0 for key in range(1, 8)
+                                                          for prefix in ['', 'percentage_']})
+        for col, value in expected.items():
+            assert result.at[adres_id, col] == pytest.approx(value), (adres_id, col)
+    assert result['aantal_personen'].dtype == int and result['leegstand'].dtype == bool
@@ -0,0 +1,88 @@
+####################################################################################################
+"""
+test_bag_query.py
+
+Tests for the explicit select list of the BAG download (datasets.create_bag_query), which must give
+the same columns as a 'SELECT *' download after apply_bag_colname_fix and BagDataset.bag_fix.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import re
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+import datasets.datasets as ds
+from datasets import BagDataset
+
+# Columns shared by all BAG tables, and the columns of each table (with their types), like in the database.
+COMMON = ['id', 'landelijk_id', 'document_mutatie', 'document_nummer', 'begin_geldigheid', 'einde_geldigheid',
+          'mutatie_gebruiker', 'vervallen', 'date_modified', '_openbare_ruimte_naam', 'bron_id', 'status_id']
+OBJECT = ['_huisnummer', '_huisletter', '_huisnummer_toevoeging', 'indicatie_geconstateerd', 'indicatie_in_onderzoek',
+          'geometrie', '_gebiedsgerichtwerken_id', '_grootstedelijkgebied_id', 'buurt_id']
+TABLES = {'bag_nummeraanduiding': COMMON + ['huisnummer', 'huisletter', 'huisnummer_toevoeging', 'ligplaats_id',
+                                            'standplaats_id', 'verblijfsobject_id'],
+          'bag_ligplaats': COMMON + OBJECT,
+          'bag_standplaats': COMMON + OBJECT,
+          'bag_verblijfsobject': COMMON + OBJECT + ['oppervlakte', 'eigendomsverhouding_id']}
+
+
+def data_type(table, col):
+    # The document dates differ in type between the tables, so these must be merged as text.
+    return 'date' if col == 'begin_geldigheid' and table == 'bag_nummeraanduiding' else 'character varying'
+
+
+class SchemaCursor():
+    """Cursor which answers the information_schema query of create_bag_query."""
+
+    def execute(self, sql, params=None):
+        self.rows = [(table, col, data_type(table, col)) for table, cols in TABLES.items() for col in cols]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class SchemaConnection():
+
+    def cursor(self):
+        return SchemaCursor()
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    return tmp_path
+
+
+def test_bag_query_selects_columns_of_fixed_download(data_path):
+    query = ds.create_bag_query(SchemaConnection())
+    aliases = re.findall(r' AS "([^"]+)"', query)
+
+    # A 'SELECT *' download of the joined tables, after the column name fix and bag_fix.
+    names = [col for cols in TABLES.values() for col in cols]
+    bag = BagDataset()
+    bag.data = ds.apply_bag_colname_fix(pd.DataFrame([range(len(names))], columns=names))
+    bag.data.name = 'bag'
+    bag.version = 'download'
+    bag.bag_fix()
+    assert aliases == list(bag.columns)
+    assert not set(aliases) & set(ds.BAG_DROP_COLUMNS)
+
+
+def test_bag_query_merges_columns_in_order_of_preference():
+    query = ds.create_bag_query(SchemaConnection())
+    assert 'COALESCE(l."buurt_id", v."buurt_id", s."buurt_id") AS "buurt_id"' in query
+    # Columns of different types are merged as text.
+    assert ('COALESCE(n."begin_geldigheid"::text, v."begin_geldigheid"::text, s."begin_geldigheid"::text, '
+            'l."begin_geldigheid"::text) AS "begin_geldigheid"') in query
+    assert 'n."huisnummer" AS "huisnummer_nummeraanduiding"' in query
+    assert 'v."_huisnummer"' not in query  # Dropped by bag_fix, so not selected.
@@ -0,0 +1,198 @@
+####################################################################################################
+"""
+test_clean.py
+
+Tests for the cleaning steps in clean.py: the CleanTransformer imputation (ImputationStatistics and
+the precedence of the imputation steps), the validity rules and the date parsing.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import clean
+
+
+def make_frame():
+    df = pd.DataFrame({'id': [1, 2, 3, 4],
+                       'getal': [1., np.nan, 3., 8.],
+                       'leeg': [np.nan] * 4,
+                       'datum': pd.to_datetime(['2019-01-01', None, '2019-01-03', None]),
+                       'lege_datum': pd.to_datetime([None] * 4),
+                       'code': ['a', 'b', None, 'b'],
+                       'soort': [None, 'x', None, 'y']})
+    df.name = 'test'
+    return df
+
+
+def test_imputation_statistics_over_chunks_equal_single_pass():
+    df = make_frame()
+    single = clean.ImputationStatistics(['code'])
+    single.update(df)
+    chunked = clean.ImputationStatistics(['code'])
+    chunked.update(df.iloc[:1])
+    chunked.update(df.iloc[1:])
+    assert single.result()['modes'] == chunked.result()['modes'] == {'code': 'b'}
+    for col, value in single.result()['averages'].items():
+        assert chunked.result()['averages'][col] == value or (pd.isnull(value) and pd.isnull(chunked.result()['averages'][col]))
+    assert single.result()['averages']['getal'] == 4.
+    assert single.result()['averages']['datum'] == pd.Timestamp('2019-01-02')
+
+
+def test_impute_uses_first_applicable_step():
+    transformer = clean.CleanTransformer(id_column='id', lower_string_columns=False,
+                                         impute_missing_values_mode=['code'],
+                                         impute_missing_values_custom={'getal': -1., 'code': 'custom', 'soort': 'onbekend'},
+                                         fillna_columns={'soort': 'fillna', 'leeg': 0.})
+    result = transformer.fit_transform(make_frame())
+    assert list(result['getal']) == [1., 4., 3., 8.]  # The average comes first.
+    assert list(result['code']) == ['a', 'b', 'b', 'b']  # The mode comes before the custom value.
+    assert list(result['soort']) == ['onbekend', 'x', 'onbekend', 'y']  # The custom value comes before fillna.
+    assert list(result['datum']) == list(pd.to_datetime(['2019-01-01', '2019-01-02', '2019-01-03', '2019-01-02']))
+
+
+def test_impute_skips_averages_of_empty_columns():
+    # Columns without any values have no average (NaN/NaT), so later steps still fill them.
+    transformer = clean.CleanTransformer(id_column='id', lower_string_columns=False,
+                                         impute_missing_values_custom={'leeg': -1.},
+                                         fillna_columns={'lege_datum': pd.Timestamp('2000-01-01')})
+    result = transformer.fit_transform(make_frame())
+    assert list(result['leeg']) == [-1.] * 4
+    assert list(result['lege_datum']) == [pd.Timestamp('2000-01-01')] * 4
+
+
+def test_impute_matches_steps_performed_one_by_one():
+    transformer = clean.CleanTransformer(id_column='id', lower_string_columns=False,
+                                         impute_missing_values_mode=['code'],
+                                         impute_missing_values_custom={'soort': 'onbekend', 'leeg': -1.})
+    result = transformer.fit_transform(make_frame())
+
+    expected = make_frame()
+    averages = {col: value for col, value in clean.compute_averages(expected).items() if not pd.isnull(value)}
+    expected.fillna(value=averages, inplace=True)
+    clean.impute_missing_values_mode(expected, ['code'])
+    clean.impute_missing_values_custom(expected, {'soort': 'onbekend', 'leeg': -1.})
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_transform_uses_fitted_statistics():
+    transformer = clean.CleanTransformer(id_column='id', lower_string_columns=False).fit(make_frame())
+    other = make_frame()
+    other['getal'] = [np.nan, np.nan, 100., np.nan]
+    assert list(transformer.transform(other)['getal']) == [4., 4., 100., 4.]
+
+
+def test_timings_per_configured_step():
+    transformer = clean.CleanTransformer(id_column='id', drop_columns=['soort'], fix_date_columns=['datum'],
+                                         clean_dates=True, impute_missing_values_custom={'code': 'x'})
+    df = make_frame()
+    df['begindatum'] = pd.to_datetime(['2015-01-01', '2009-01-01', '2016-01-01', '2017-01-01'])
+    df['einddatum'] = pd.to_datetime(['2015-02-01', '2015-02-01', '2015-02-01', '2018-01-01'])
+    result = transformer.fit_transform(df)
+    assert list(result['id']) == [1, 4]
+    assert set(transformer.timings_) == {'drop_columns', 'fix_dates', 'drop_duplicates', 'clean_dates', 'remove_rows',
+                                         'lower_strings', 'impute_missing_values', 'impute_missing_values_custom'}
+
+
+def make_dates_frame(n=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    begin = pd.Timestamp('2008-01-01') + pd.to_timedelta(rng.randint(0, 6000, n), unit='D')
+    eind = pd.Timestamp('2008-01-01') + pd.to_timedelta(rng.randint(0, 6000, n), unit='D')
+    df = pd.DataFrame({'begindatum': begin, 'einddatum': eind}, index=rng.permutation(n) * 10)
+    df.loc[df.index[::7], 'einddatum'] = pd.NaT
+    df.name = 'test'
+    return df
+
+
+def clean_dates_reference(df):
+    """Previous implementation of clean_dates, which unions the index lists of the rows breaking each rule."""
+    today = pd.to_datetime('today')
+    l1 = df[df['begindatum'].dt.year <= 2010].index.tolist()
+    l2 = df[df['begindatum'] > today].index.tolist()
+    l3 = df[df['einddatum'].dt.year <= 2010].index.tolist()
+    l4 = df[df['einddatum'] > today].index.tolist()
+    l5 = df[df['begindatum'] > df['einddatum']].index.tolist()
+    return df.drop(list(set().union(l1, l2, l3, l4, l5)))
+
+
+def test_clean_dates_matches_reference():
+    df = make_dates_frame()
+    expected = clean_dates_reference(df)
+    clean.clean_dates(df)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_validity_rules_counts_and_bitmaps():
+    df = make_dates_frame()
+    rules = clean.ValidityRules(clean.DATE_RULES)
+    keep = rules.evaluate(df)
+    assert keep.index.equals(df.index)
+    assert rules.counts_['total'] == (~keep).sum()
+    for rule in clean.DATE_RULES:
+        rejected = rule.evaluate(df)
+        assert rules.counts_[rule.name] == rejected.sum()
+        assert rules.rejected(rule.name).equals(df.index[rejected])
+    assert rules.rejected().equals(df.index[~keep.values])
+    # Rows with a missing date do not break the rules on that date.
+    assert not rules.rejected('einddatum_year_at_most_2010').isin(df.index[df['einddatum'].isnull()]).any()
+
+
+def test_clean_transformer_uses_given_validity_rules():
+    df = make_dates_frame()
+    df['id'] = range(len(df))
+    rules = [clean.greater_than('begindatum', 'einddatum')]
+    expected_index = df.index[~(df['begindatum'] > df['einddatum']).values]
+    result = clean.CleanTransformer(id_column='id', validity_rules=rules, impute_missing_values=False).fit_transform(df)
+    assert result.index.equals(expected_index)
+
+
+def test_parse_dates_matches_to_datetime():
+    col = pd.Series(['2019-03-05', '2019-03-06 10:00:00', None, '2019-03-05', 'geen datum', '20190307', '05/03/2019',
+                     '31/12/2019'] * 3)
+    dates, nat_count = clean.parse_dates(col)
+    expected = pd.Series([pd.to_datetime(value, errors='coerce') for value in col])
+    pd.testing.assert_series_equal(dates, expected, check_names=False)
+    assert nat_count == 3  # Only 'geen datum' (missing values are not counted).
+
+
+@pytest.mark.parametrize('dayfirst, expected', [(False, '2019-05-03'), (True, '2019-03-05')])
+def test_parse_dates_ambiguous_dates_follow_dayfirst(dayfirst, expected):
+    # Both with the inferred format, and for values parsed without a format (the fallback).
+    col = pd.Series(['05/03/2019', '06/03/2019', '2019-01-01 12:00', '05-03-2019'])
+    dates, _ = clean.parse_dates(col, dayfirst=dayfirst)
+    assert dates[0] == pd.Timestamp(expected)
+    assert dates[3] == pd.Timestamp(expected)
+    assert dates[2] == pd.Timestamp('2019-01-01 12:00')
+
+
+def test_parse_dates_does_not_depend_on_earlier_columns():
+    # Each column is parsed on its own, so a value parses the same whatever was parsed before.
+    first, _ = clean.parse_dates(pd.Series(['05/03/2019'] + ['13/03/2019'] * 10), dayfirst=True)
+    second, _ = clean.parse_dates(pd.Series(['05/03/2019'] + ['03/13/2019'] * 10))
+    assert first[0] == pd.Timestamp('2019-03-05')
+    assert second[0] == pd.Timestamp('2019-05-03')
+
+
+def test_fix_dates_keeps_datetime_columns():
+    df = pd.DataFrame({'datum': pd.to_datetime(['2019-01-01', None]), 'tekst': ['2019-01-02', None]})
+    df.name = 'test'
+    assert clean.fix_dates(df, ['datum', 'tekst']) == {'datum': 0, 'tekst': 0}
+    assert list(df['tekst']) == [pd.Timestamp('2019-01-02'), pd.NaT]
+
+
+def test_parse_dates_caches_only_values_matching_the_format(monkeypatch):
+    monkeypatch.setattr(clean, '_parsed_dates', {})
+    col = pd.Series(['2019-03-05', '2019-03-06', '05/03/2019', None] * 3)
+    first, _ = clean.parse_dates(col)
+    assert set(clean._parsed_dates) == {('%Y-%m-%d', False)}
+    assert clean._parsed_dates[('%Y-%m-%d', False)] == {'2019-03-05': pd.Timestamp('2019-03-05'),
+                                                        '2019-03-06': pd.Timestamp('2019-03-06')}
+
+    # Another column (e.g. of another dataset) uses the cached values, with the same result.
+    second, _ = clean.parse_dates(pd.Series(['2019-03-06', '2019-03-07', '05/03/2019']))
+    assert list(second) == list(pd.to_datetime(['2019-03-06', '2019-03-07', '2019-05-03']))
+    assert len(clean._parsed_dates[('%Y-%m-%d', False)]) == 3
+    pd.testing.assert_series_equal(first, clean.parse_dates(col)[0])
@@ -0,0 +1,62 @@
+####################################################################################################
+"""
+test_compaction.py
+
+Tests for the dtype compaction which is applied to datasets when they are downloaded (compaction.py).
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+from datasets.compaction import compact_dtypes
+
+
+def make_download():
+    df = pd.DataFrame({'klein': np.array([1, 2, 3], dtype='int64'),
+                       'groot': np.array([1, 2, 10 ** 6], dtype='int64'),
+                       'oppervlakte': [55.5, np.nan, 80.25],
+                       'id': [123456789.0, 2.0, 3.0],
+                       'datum': [datetime.date(2019, 1, 1), None, datetime.date(2019, 3, 1)],
+                       'naam': ['a', 'b', None],
+                       'code': ['x', 'y', 'x'],
+                       'vlag': [True, False, True]})
+    df.name = 'test'
+    return df
+
+
+def test_compact_dtypes_downcasts_and_parses():
+    df = make_download()
+    compacted = compact_dtypes(df, verbose=False)
+    assert compacted.name == 'test'
+    assert dict(compacted.dtypes.astype(str)) == {'klein': 'int8', 'groot': 'int32', 'oppervlakte': 'float32',
+                                                  'id': 'float64', 'datum': 'datetime64[ns]', 'naam': 'object',
+                                                  'code': 'object', 'vlag': 'bool'}
+    # Values do not change (float columns are only downcast when every value survives the round trip).
+    for col in ['klein', 'groot', 'oppervlakte', 'id', 'naam', 'code', 'vlag']:
+        pd.testing.assert_series_equal(compacted[col], df[col], check_dtype=False)
+    assert list(compacted['datum']) == [pd.Timestamp('2019-01-01'), pd.NaT, pd.Timestamp('2019-03-01')]
+
+
+def test_compact_dtypes_uses_schema_hints():
+    compacted = compact_dtypes(make_download(), {'code': 'category', 'naam': 'category', 'klein': 'int64'}, verbose=False)
+    assert compacted['code'].dtype.name == 'category'
+    assert list(compacted['code'].cat.categories) == ['x', 'y']
+    assert compacted['naam'].isnull().tolist() == [False, False, True]
+    assert compacted['klein'].dtype == 'int64'
+
+
+def test_compact_dtypes_reduces_memory():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({'aantal': rng.randint(0, 100, 10000).astype('int64'),
+                       'fractie': rng.randint(0, 4, 10000) / 4})
+    compacted = compact_dtypes(df, verbose=False)
+    assert compacted.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum() / 2
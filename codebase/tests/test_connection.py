@@ -0,0 +1,92 @@
+####################################################################################################
+"""
+test_connection.py
+
+Tests for the pooled database connections (datasets.connection), using a stand-in for the psycopg2
+connection pool which, like the real one, fails when more connections are requested than it holds,
+and for the report of concurrent downloads (datasets.download_datasets).
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('config')
+import pandas as pd
+import psycopg2.pool
+import datasets.datasets as ds
+from datasets.version_store import VersionStore
+
+
+class StandInConnection():
+
+    def rollback(self):
+        pass
+
+
+class StandInPool():
+    """Stand-in for psycopg2.pool.ThreadedConnectionPool, which raises PoolError when it is exhausted."""
+
+    def __init__(self, minconn, maxconn, **params):
+        self.maxconn = maxconn
+        self.used = 0
+        self.max_used = 0
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.used == self.maxconn:
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+            self.used += 1
+            self.max_used = max(self.max_used, self.used)
+            return StandInConnection()
+
+    def putconn(self, conn, close=False):
+        with self.lock:
+            self.used -= 1
+
+
+def test_connection_waits_for_a_free_connection(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, 'ThreadedConnectionPool', StandInPool)
+    monkeypatch.setattr(ds, '_pools', {})
+
+    def query(i):
+        with ds.connection('import_wvs'):
+            time.sleep(0.01)
+        return i
+
+    # More concurrent users than connections: all of them get a connection eventually.
+    with ThreadPoolExecutor(max_workers=3 * ds.POOL_SIZE) as executor:
+        assert sorted(executor.map(query, range(5 * ds.POOL_SIZE))) == list(range(5 * ds.POOL_SIZE))
+    pool, _ = ds.get_pool('import_wvs')
+    assert pool.max_used == ds.POOL_SIZE
+    assert pool.used == 0
+
+
+def test_download_report_does_not_load_cached_versions(tmp_path, monkeypatch):
+    pytest.importorskip('tables')
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+
+    class ToyDataset(ds.MyDataset):
+        name = 'toy'
+
+    cached = ToyDataset()
+    cached.data = pd.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', 'z']})
+    cached.version = 'download'
+    cached.save()
+
+    loaded = []
+    load_object = VersionStore.load_object
+    monkeypatch.setattr(VersionStore, 'load_object', lambda store, h: loaded.append(h) or load_object(store, h))
+    report = ds.download_datasets([ToyDataset()], force=False)
+    assert list(report.columns) == ['dataset', 'seconds', 'rows', 'memory_bytes']
+    assert report['rows'].tolist() == [3]
+    assert pd.isnull(report['memory_bytes'][0])  # Nothing was downloaded or loaded.
+    assert loaded == []
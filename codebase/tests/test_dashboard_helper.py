@@ -0,0 +1,58 @@
+####################################################################################################
+"""
+test_dashboard_helper.py
+
+Tests for loading the signals shown by the dashboard (dashboard/dashboard_helper.py), which combines
+columns of the final zaken dataset with address features from the feature store.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import sys
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+pytest.importorskip('papermill')
+pytest.importorskip('sqlalchemy')
+import datasets.datasets as ds
+from datasets import ZakenDataset
+
+DASHBOARD_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir, 'dashboard'))
+if DASHBOARD_PATH not in sys.path:
+    sys.path.insert(0, DASHBOARD_PATH)
+import dashboard_helper
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    return tmp_path
+
+
+def test_load_signals_combines_zaken_and_feature_store(data_path):
+    zaken = ZakenDataset()
+    zaken.data = pd.DataFrame({'adres_id': [3, 1, 2, 1], 'sttnaam': ['dam', 'rokin', 'spui', 'rokin'],
+                               'hsnr': [1, 2, 3, 2]})
+    zaken.data.name = zaken.name
+    zaken.version = 'final'
+    zaken.save()
+    ds.get_feature_store().write('personen', pd.DataFrame({'adres_id': [1, 2, 3], 'aantal_personen': [10, 20, 30],
+                                                           'eigenaar': ['a', 'b', 'c']}))
+
+    signals = dashboard_helper.load_signals(['adres_id', 'sttnaam', 'aantal_personen', 'eigenaar', 'onbekend'])
+    assert list(signals.columns) == ['adres_id', 'sttnaam', 'aantal_personen', 'eigenaar']
+    assert list(signals['adres_id']) == [3, 1, 2, 1]
+    assert list(signals['sttnaam']) == ['dam', 'rokin', 'spui', 'rokin']
+    assert list(signals['aantal_personen']) == [30, 10, 20, 10]
+    assert list(signals['eigenaar']) == ['c', 'a', 'b', 'a']
+
+    sample = dashboard_helper.load_signals(['adres_id', 'aantal_personen'], n=2)
+    assert len(sample) == 2
+    assert list(sample['aantal_personen']) == [10 * a for a in sample['adres_id']]
@@ -0,0 +1,110 @@
+####################################################################################################
+"""
+test_extract_features.py
+
+Tests for the FeatureExtractionTransformer (extract_features.py): the date features, and the
+parallel extraction, which must give the same features as the serial extraction.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import extract_features
+
+
+def make_frame(n=500, seed=0):
+    rng = np.random.RandomState(seed)
+    words = np.array(['woning', 'kamer', 'verhuur', 'toerisme', 'onderhuur', None], dtype=object)
+    df = pd.DataFrame({'id': np.arange(n),
+                       'tekst': [' '.join(w for w in rng.choice(words, 3) if w) or None for _ in range(n)],
+                       'soort': rng.choice(['a', 'b', 'c', None], n),
+                       'code': rng.choice(['x', 'y', None], n),
+                       'datum': pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.randint(0, 1000, n), unit='D')})
+    return df
+
+
+def date_frame(dates):
+    return pd.DataFrame({'datum': pd.to_datetime(pd.Series(dates, dtype=object))})
+
+
+def test_date_features_match_datetime_parts():
+    dates = ['2019-01-31', '2019-01-31', '2020-02-29', '2017-12-03']
+    result = extract_features.extract_date_features(date_frame(dates))
+    index = pd.DatetimeIndex(dates)
+    assert list(result.columns) == ['datum_month', 'datum_day', 'datum_weekday']
+    assert list(result['datum_month']) == list(index.month)
+    assert list(result['datum_day']) == list(index.day)
+    assert list(result['datum_weekday']) == list(index.weekday)
+
+
+def test_date_features_of_missing_dates():
+    dates = ['2019-01-31', None, '2019-03-02']
+    # By default missing dates get NaN, like the previous (per row) extraction.
+    result = extract_features.extract_date_features(date_frame(dates), reference_date='2019-01-01')
+    assert result['datum_month'].tolist()[0] == 1 and np.isnan(result['datum_month'].tolist()[1])
+    assert result['datum_days'].tolist()[0] == 30 and np.isnan(result['datum_days'].tolist()[1])
+    result = extract_features.extract_date_features(date_frame(dates), reference_date='2019-01-01', missing_value=-1)
+    assert list(result['datum_month']) == [1, -1, 3]
+    assert list(result['datum_days']) == [30, -1, 60]
+
+
+@pytest.mark.parametrize('missing_value, part_dtype, days_dtype', [(np.nan, np.float32, np.float32),
+                                                                   (-1, np.int8, np.int32)])
+@pytest.mark.parametrize('dates', [['2010-01-11', '2009-12-31'], ['2010-01-11', '2110-01-01'], ['2010-01-11', None],
+                                   [None, None]])
+def test_date_feature_dtypes_only_depend_on_parameters(dates, missing_value, part_dtype, days_dtype):
+    # Training data and each batch that is scored must get the same schema, whatever dates they contain.
+    result = extract_features.extract_date_features(date_frame(dates), cyclical=True, reference_date='2010-01-01',
+                                                    missing_value=missing_value)
+    for part in ['month', 'day', 'weekday']:
+        assert result[f'datum_{part}'].dtype == part_dtype
+        assert result[f'datum_{part}_sin'].dtype == result[f'datum_{part}_cos'].dtype == np.float32
+    assert result['datum_days'].dtype == days_dtype
+    expected = (pd.to_datetime(pd.Series(dates)) - pd.Timestamp('2010-01-01')).dt.days.fillna(missing_value)
+    pd.testing.assert_series_equal(result['datum_days'], expected, check_dtype=False, check_names=False)
+
+
+def test_cyclical_date_features():
+    result = extract_features.extract_date_features(date_frame(['2019-01-01', '2019-07-01', None]), cyclical=True)
+    assert result['datum_month_sin'][0] == 0 and result['datum_month_cos'][0] == 1
+    assert np.isclose(result['datum_month_cos'][1], -1)
+    assert result[['datum_month_sin', 'datum_month_cos']].iloc[2].isnull().all()
+
+
+def make_transformer(**params):
+    return extract_features.FeatureExtractionTransformer(text_features_cols_hot=['tekst'], categorical_cols_hot=['soort'],
+                                                         categorical_cols_no_hot=['code'], extract_date_features=True,
+                                                         **params)
+
+
+@pytest.mark.parametrize('n_hash_features', [None, 8])
+def test_parallel_extraction_equals_serial(n_hash_features):
+    train, test = make_frame(), make_frame(seed=1)
+    serial = make_transformer(n_hash_features=n_hash_features).fit(train).transform(test.copy())
+    parallel = make_transformer(n_hash_features=n_hash_features, n_jobs=2).fit(train).transform(test.copy())
+    pd.testing.assert_frame_equal(parallel[serial.columns], serial)
+
+
+def test_parallel_sparse_extraction_equals_serial():
+    train, test = make_frame(), make_frame(seed=1)
+    serial = make_transformer(sparse=True).fit(train).transform(test.copy())
+    parallel = make_transformer(sparse=True, n_jobs=2).fit(train).transform(test.copy())
+    assert parallel.sparse_columns == serial.sparse_columns
+    assert (parallel.sparse != serial.sparse).nnz == 0
+    pd.testing.assert_frame_equal(parallel.dense[serial.dense.columns], serial.dense)
+
+
+def test_parallel_extraction_removes_temporary_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(extract_features.tempfile, 'tempdir', str(tmp_path))
+    make_transformer(n_jobs=2).fit(make_frame()).transform(make_frame())
+    # Also when the extraction fails halfway.
+    transformer = make_transformer(n_jobs=2).fit(make_frame())
+    with pytest.raises(KeyError):
+        transformer.transform(make_frame().drop(columns=['code']))
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,71 @@
+####################################################################################################
+"""
+test_feature_store.py
+
+Tests for the per-address feature store (feature_store.py), and for filling it from the adres
+enrichment steps.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import shutil
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+import datasets.datasets as ds
+from datasets import AdresDataset, FeatureStore
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    return tmp_path
+
+
+def test_lookup_returns_features_in_key_order(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    df = pd.DataFrame({'adres_id': [30, 10, 20],
+                       'aantal': [3, 1, 2],
+                       'datum': pd.to_datetime(['2019-03-01', '2019-01-01', None]),
+                       'soort': ['c', 'a', None]})
+    store.write('test', df)
+    result = store.lookup([20, 99, 30])
+    assert list(result.index) == [20, 99, 30]
+    assert result['aantal'].tolist()[0] == 2 and np.isnan(result['aantal'].tolist()[1]) and result['aantal'].tolist()[2] == 3
+    assert result['datum'].isnull().tolist() == [True, True, False]
+    assert result['soort'].astype(object).tolist()[2] == 'c'
+    assert store.get(10)['aantal'] == 1
+    assert store.columns() == ['aantal', 'datum', 'soort']
+
+
+def make_adres():
+    adres = AdresDataset()
+    adres.data = pd.DataFrame({'adres_id': [1, 2, 3], 'wng_id': [11, 12, 13]})
+    adres.data.name = 'adres'
+    adres.version = 'download'
+    return adres
+
+
+def test_enrichment_fills_feature_store_on_cache_hit(data_path):
+    hotline = pd.DataFrame({'id': [100, 101, 102], 'wng_id': [11, 11, 13]})
+    make_adres().add_hotline_features(hotline)
+    ds.wait_for_checkpoints()
+    expected = ds.get_feature_store().lookup([1, 2, 3])
+
+    # Remove the feature store. Running the step again on the same inputs loads its result from the version
+    # store, and must fill the feature store again.
+    shutil.rmtree(os.path.join(str(data_path), 'feature_store'))
+    os.makedirs(os.path.join(str(data_path), 'feature_store'))
+    make_adres().add_hotline_features(hotline)
+    ds.wait_for_checkpoints()
+    result = ds.get_feature_store().lookup([1, 2, 3])
+    pd.testing.assert_frame_equal(result, expected)
+    assert result['aantal_hotline_meldingen'].tolist() == [2, 0, 1]
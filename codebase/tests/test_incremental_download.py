@@ -0,0 +1,74 @@
+####################################################################################################
+"""
+test_incremental_download.py
+
+Tests for incremental downloads (MyDataset.download with incremental=True), which upsert the rows
+modified since the previous download into the cached download, using stand-ins for the server queries.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+import datasets.datasets as ds
+
+
+class ToyDataset(ds.MyDataset):
+    name = 'toy'
+    table_name = 'toy'
+    id_column = 'id'
+    modified_column = 'gewijzigd'
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """Stand-in for the server table, which the download functions query."""
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    table = {'data': pd.DataFrame({'id': [1, 2, 3], 'waarde': ['a', 'b', 'c'],
+                                   'gewijzigd': pd.to_datetime(['2019-01-01', '2019-01-02', '2019-01-03'])})}
+    queries = []
+
+    def download_dataset(dataset_name, table_name, limit=None, explicit_select=False):
+        queries.append('full')
+        return table['data'].copy()
+
+    def download_delta(table_name, modified_column, since):
+        queries.append(('delta', since))
+        return table['data'][table['data'][modified_column] >= since].copy()
+
+    def download_keys(table_name, key_columns):
+        return table['data'][key_columns].copy()
+
+    monkeypatch.setattr(ds, 'download_dataset', download_dataset)
+    monkeypatch.setattr(ds, 'download_delta', download_delta)
+    monkeypatch.setattr(ds, 'download_keys', download_keys)
+    return table, queries
+
+
+def test_incremental_download_upserts_modified_rows(server):
+    table, queries = server
+    ToyDataset().download(incremental=True)  # No previous download: a full download.
+    assert queries == ['full']
+    assert ds.get_watermark('toy') == pd.Timestamp('2019-01-03')
+
+    # Row 2 is modified, row 3 is deleted and row 4 is added on the server.
+    table['data'] = pd.DataFrame({'id': [1, 2, 4], 'waarde': ['a', 'B', 'd'],
+                                  'gewijzigd': pd.to_datetime(['2019-01-01', '2019-02-01', '2019-02-02'])})
+    dataset = ToyDataset()
+    dataset.download(incremental=True)
+    assert queries == ['full', ('delta', pd.Timestamp('2019-01-03'))]
+    result = dataset.data.sort_values('id').reset_index(drop=True)
+    assert list(result['id']) == [1, 2, 4]
+    assert list(result['waarde']) == ['a', 'B', 'd']
+    assert ds.get_watermark('toy') == pd.Timestamp('2019-02-02')
+
+    # The upserted download is cached.
+    cached = ToyDataset()
+    cached.load('download')
+    pd.testing.assert_frame_equal(cached.data.sort_values('id').reset_index(drop=True), result, check_names=False)
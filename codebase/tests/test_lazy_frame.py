@@ -0,0 +1,66 @@
+####################################################################################################
+"""
+test_lazy_frame.py
+
+Tests for the lazily loaded dataset versions (lazy_frame.py), which load columns from the version
+store on demand and only keep them while they are in use.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import gc
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+from datasets.version_store import VersionStore
+
+
+@pytest.fixture
+def counted_store(tmp_path, monkeypatch):
+    """A version store with a stored version, which counts the column objects it loads."""
+    store = VersionStore(str(tmp_path))
+    key = store.commit(pd.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', 'z']}), 'test', 'v1')
+    loaded = []
+    load_object = VersionStore.load_object
+    monkeypatch.setattr(VersionStore, 'load_object', lambda self, h: loaded.append(h) or load_object(self, h))
+    return store, key, loaded
+
+
+def test_columns_are_loaded_on_access(counted_store):
+    store, key, loaded = counted_store
+    lazy = store.load_lazy(key)
+    assert list(lazy.columns) == ['a', 'b'] and len(lazy) == 3
+    assert loaded == []
+    assert list(lazy['a']) == [1, 2, 3]
+    assert loaded == [dict(store.manifest(key)['columns'])['a']]
+
+
+def test_column_in_use_is_cached_and_reloaded_after_release(counted_store):
+    store, key, loaded = counted_store
+    lazy = store.load_lazy(key)
+    column = lazy['b']
+    assert lazy['b'] is column  # Still in use, so it is not loaded again.
+    assert len(loaded) == 1
+
+    del column
+    gc.collect()
+    assert list(lazy['b']) == ['x', 'y', 'z']  # Released, so it is loaded again (with the same content).
+    assert len(loaded) == 2
+
+
+def test_assigned_columns_and_snapshots(counted_store):
+    store, key, loaded = counted_store
+    lazy = store.load_lazy(key)
+    snapshot = lazy.snapshot()
+    lazy['c'] = [7, 8, 9]
+    lazy.drop(['a'])
+    assert list(lazy.columns) == ['b', 'c'] and list(snapshot.columns) == ['a', 'b']
+    assert 'a' not in lazy.hashes and 'c' not in lazy.hashes  # Only unchanged stored columns keep their hash.
+    assert loaded == []
+    pd.testing.assert_frame_equal(store.load(store.commit(lazy, 'test', 'v2')), lazy.to_frame(), check_names=False)
@@ -0,0 +1,119 @@
+####################################################################################################
+"""
+test_reference_cache.py
+
+Tests for the reference table cache (reference_cache.py): tables are only loaded from their source
+when they are not cached or older than their TTL, and csv files are read again when they change.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import time
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+import datasets.datasets as ds
+from datasets import ReferenceCache
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    return tmp_path
+
+
+def counting_loader(table):
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return table.copy()
+    return loader, calls
+
+
+def age(cache, name, seconds):
+    """Make the local copy of a reference table look the given number of seconds older."""
+    path = cache.refresh(name, None, ttl=float('inf'))
+    mtime = os.path.getmtime(path) - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_table_is_loaded_once_within_its_ttl(tmp_path):
+    table = pd.DataFrame({'ads_id': [1, 2, 3], 'wng_id': [10, 20, 30], 'sttnaam': ['a', 'b', 'c']})
+    loader, calls = counting_loader(table)
+    cache = ReferenceCache(str(tmp_path))
+    pd.testing.assert_frame_equal(cache.get('adressen', loader, ttl=60), table)
+    pd.testing.assert_frame_equal(cache.get('adressen', loader, ttl=60), table)
+    assert len(calls) == 1
+    # A new cache (e.g. in another run) uses the copy on local storage.
+    pd.testing.assert_frame_equal(ReferenceCache(str(tmp_path)).get('adressen', loader, ttl=60), table)
+    assert len(calls) == 1
+
+
+def test_table_is_loaded_again_after_its_ttl(tmp_path):
+    table = pd.DataFrame({'ads_id': [1, 2], 'wng_id': [10, 20]})
+    loader, calls = counting_loader(table)
+    cache = ReferenceCache(str(tmp_path))
+    cache.get('adressen', loader, ttl=60)
+    age(cache, 'adressen', 120)
+    table['wng_id'] = [11, 21]
+    assert list(cache.get('adressen', loader, ttl=60)['wng_id']) == [11, 21]
+    assert len(calls) == 2
+    cache.get('adressen', loader, ttl=60)
+    assert len(calls) == 2
+
+
+def test_column_selection(tmp_path):
+    table = pd.DataFrame({'ads_id': [1, 2], 'wng_id': [10, 20], 'sttnaam': ['a', 'b']})
+    loader, calls = counting_loader(table)
+    cache = ReferenceCache(str(tmp_path))
+    result = cache.get('adressen', loader, ttl=60, columns=['ads_id', 'wng_id'])
+    pd.testing.assert_frame_equal(result, table[['ads_id', 'wng_id']])
+    pd.testing.assert_frame_equal(cache.get('adressen', loader, ttl=60), table)
+    assert len(calls) == 1
+
+
+def test_least_recently_used_tables_are_forgotten(tmp_path):
+    cache = ReferenceCache(str(tmp_path), max_tables=2)
+    for name in ['a', 'b', 'c']:
+        cache.get(name, counting_loader(pd.DataFrame({'x': [1]}))[0], ttl=60)
+    assert [key[0] for key in cache._tables] == ['b', 'c']
+
+
+def test_invalidate_loads_table_again(tmp_path):
+    loader, calls = counting_loader(pd.DataFrame({'x': [1, 2]}))
+    cache = ReferenceCache(str(tmp_path))
+    cache.get('adressen', loader, ttl=60)
+    cache.invalidate('adressen')
+    cache.get('adressen', loader, ttl=60)
+    assert len(calls) == 2
+
+
+def test_csv_is_read_again_when_modified(tmp_path):
+    csv_path = str(tmp_path / 'categorie.csv')
+    pd.DataFrame({'beh_oms': ['a', 'b'], 'categorie': ['x', 'y']}).to_csv(csv_path, index=False)
+    cache = ReferenceCache(str(tmp_path / 'reference'))
+    first = cache.get_csv(csv_path, columns=['beh_oms', 'categorie'])
+    assert cache.get_csv(csv_path, columns=['beh_oms', 'categorie']) is first
+    pd.DataFrame({'beh_oms': ['a', 'b'], 'categorie': ['x', 'z']}).to_csv(csv_path, index=False)
+    mtime = time.time() + 10
+    os.utime(csv_path, (mtime, mtime))
+    assert list(cache.get_csv(csv_path, columns=['beh_oms', 'categorie'])['categorie']) == ['x', 'z']
+
+
+def test_get_reference_table(data_path, monkeypatch):
+    table = pd.DataFrame({'ads_id': [1, 2], 'wng_id': [10, 20], 'sttnaam': ['a', 'b']})
+    downloads = []
+    monkeypatch.setattr(ds, 'download_dataset', lambda name, table_name: downloads.append(table_name) or table.copy())
+    result = ds.get_reference_table('bwv_adres_periodes', columns=['ads_id', 'wng_id'])
+    pd.testing.assert_frame_equal(result, table[['ads_id', 'wng_id']])
+    ds.get_reference_table('bwv_adres_periodes')
+    assert downloads == ['bwv_adres_periodes']
+    assert os.path.dirname(ds.get_reference_cache().refresh('bwv_adres_periodes', None, 60)) == str(data_path / 'reference')
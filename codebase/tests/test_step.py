@@ -0,0 +1,138 @@
+####################################################################################################
+"""
+test_step.py
+
+Tests for the step decorator (datasets.step), which caches the results of processing steps in the
+version store, keyed by the content of their inputs.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+import datasets.datasets as ds
+import clean
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    return tmp_path
+
+
+def make_dataset(csv_path, calls):
+    """Create a dataset with a step that maps a column using a csv file, and counts how often it runs."""
+
+    class ToyDataset(ds.MyDataset):
+        name = 'toy'
+
+        @ds.step('_mapped', csv_files=[csv_path])
+        def add_mapping(self):
+            calls.append('add_mapping')
+            mapping = pd.read_csv(csv_path).set_index('key')['value']
+            self['mapped'] = self['code'].map(mapping)
+
+        @ds.step('_scaled')
+        def scale(self, factor):
+            calls.append('scale')
+            self['scaled'] = self['code'] * factor
+
+    dataset = ToyDataset()
+    dataset.data = pd.DataFrame({'code': [1, 2, 3]})
+    dataset.version = 'download'
+    return dataset
+
+
+def test_step_reruns_when_csv_file_changes(data_path):
+    csv_path = os.path.join(str(data_path), 'mapping.csv')
+    pd.DataFrame({'key': [1, 2, 3], 'value': ['a', 'b', 'c']}).to_csv(csv_path, index=False)
+    calls = []
+
+    make_dataset(csv_path, calls).add_mapping()
+    ds.wait_for_checkpoints()
+    dataset = make_dataset(csv_path, calls)
+    dataset.add_mapping()
+    ds.wait_for_checkpoints()
+    assert calls == ['add_mapping']  # Identical inputs: the second run is a cache hit.
+    assert list(dataset['mapped']) == ['a', 'b', 'c']
+
+    # The csv file changes (with the same size), so the cached result must not be used.
+    pd.DataFrame({'key': [1, 2, 3], 'value': ['x', 'y', 'z']}).to_csv(csv_path, index=False)
+    os.utime(csv_path, (0, 0))
+    dataset = make_dataset(csv_path, calls)
+    dataset.add_mapping()
+    ds.wait_for_checkpoints()
+    assert calls == ['add_mapping', 'add_mapping']
+    assert list(dataset['mapped']) == ['x', 'y', 'z']
+
+
+def test_repeated_step_on_same_content_is_a_cache_hit(data_path):
+    calls = []
+    first = make_dataset(None, calls)
+    first.scale(2)
+    # Run the step again right away (its checkpoint can still be written in the background), on a dataset with the
+    # same content.
+    second = make_dataset(None, calls)
+    second.scale(2)
+    assert calls == ['scale']
+    assert second._lazy is not None  # Loaded from the version store.
+    assert second.key == first.key and second.version == first.version == 'download_scaled'
+    assert list(second['scaled']) == [2, 4, 6]
+
+
+def test_step_arguments_are_part_of_the_key(data_path):
+    calls = []
+    make_dataset(None, calls).scale(2)
+    ds.wait_for_checkpoints()
+    make_dataset(None, calls).scale(2)
+    dataset = make_dataset(None, calls)
+    dataset.scale(3)
+    ds.wait_for_checkpoints()
+    assert calls == ['scale', 'scale']
+    assert list(dataset['scaled']) == [3, 6, 9]
+
+
+def test_step_rejects_arguments_without_stable_key(data_path):
+    with pytest.raises(TypeError):
+        make_dataset(None, []).scale(pd.Series([1, 2, 3]))
+
+
+def test_column_steps_keep_lazy_version(data_path):
+    csv_path = os.path.join(str(data_path), 'mapping.csv')
+    pd.DataFrame({'lcolumn': ['a', 'b'], 'ncolumn': ['Eerste', 'Tweede']}).to_csv(csv_path, index=False)
+    dataset = make_dataset(None, [])
+    dataset.data = pd.DataFrame({'code': [1, 2, 3], 'oms': ['A', 'b', None]})
+    dataset.save()
+    dataset.load(dataset.version)
+
+    # Like ZakenDataset.add_categories: lower the strings and add a mapped column, using the dataset itself.
+    clean.lower_strings(dataset)
+    ds.add_column(df=dataset, new_col='categorie', match_col='oms', csv_path=csv_path)
+    assert dataset._lazy is not None
+    assert list(dataset.columns) == ['code', 'oms', 'categorie']
+    assert list(dataset['categorie'].astype(object).fillna('-')) == ['eerste', 'tweede', '-']
+
+
+def test_steps_between_milestones_are_not_stored(data_path):
+    dataset = make_dataset(None, [])
+    dataset.checkpoint_policy = 'milestones'
+    dataset.checkpoint_milestones = []
+    dataset.scale(2)
+    ds.wait_for_checkpoints()
+    assert dataset.version == 'download_scaled'
+    assert dataset.key is None
+    assert ds.get_version_store().resolve('toy', 'download_scaled') is None
+
+    dataset.checkpoint_milestones = ['scale']
+    dataset.scale(3)
+    ds.wait_for_checkpoints()
+    assert dataset.key is not None
+    assert ds.get_version_store().resolve('toy', 'download_scaled_scaled') == dataset.key
@@ -0,0 +1,86 @@
+####################################################################################################
+"""
+test_stream_csv.py
+
+Tests for downloading csv files (datasets.stream_csv), from a local http server which supports
+conditional requests (ETag), and from a local file.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+import datasets.datasets as ds
+
+CSV = 'wijk;aantal\nA;1\nB;2\n'
+
+
+class CsvHandler(BaseHTTPRequestHandler):
+    """Serve CSV with an ETag, and answer 304 when the client already has it."""
+
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        CsvHandler.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = CSV.encode()
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    CsvHandler.requests = []
+    httpd = HTTPServer(('127.0.0.1', 0), CsvHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}/bbga.csv'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_stream_csv_uses_etag(server):
+    df, validators = ds.stream_csv(server, sep=';')
+    assert df.to_dict('list') == {'wijk': ['A', 'B'], 'aantal': [1, 2]}
+    assert validators['etag'] == CsvHandler.etag
+
+    # Not modified: the file is not downloaded again, and the validators are kept.
+    df, same_validators = ds.stream_csv(server, validators, sep=';')
+    assert df is None and same_validators == validators
+    assert CsvHandler.requests == [None, CsvHandler.etag]
+
+    # Modified: the file is downloaded again.
+    df, _ = ds.stream_csv(server, {'etag': '"v0"'}, sep=';')
+    assert len(df) == 2
+
+
+def test_stream_csv_reads_local_file(tmp_path):
+    path = os.path.join(str(tmp_path), 'bbga.csv')
+    with open(path, 'w') as f:
+        f.write(CSV)
+    df, validators = ds.stream_csv(path, sep=';')
+    assert df.to_dict('list') == {'wijk': ['A', 'B'], 'aantal': [1, 2]}
+    assert ds.stream_csv('file://' + path, validators, sep=';') == (None, validators)
+
+    os.utime(path, (validators['mtime'] + 10, validators['mtime'] + 10))
+    df, _ = ds.stream_csv(path, validators, sep=';')
+    assert len(df) == 2
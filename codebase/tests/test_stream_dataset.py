@@ -0,0 +1,150 @@
+####################################################################################################
+"""
+test_stream_dataset.py
+
+Tests for the streaming COPY download (datasets.stream_dataset). A stand-in database connection
+serves a small table, both as rows (for download_dataset) and as Postgres COPY csv output (for
+stream_dataset), so the streamed cache can be compared with a regular download.
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+from contextlib import contextmanager
+import datetime
+import csv
+import io
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+import datasets.datasets as ds
+from datasets.compaction import compact_dtypes
+from datasets import PersonenDataset
+
+
+# Columns of the stand-in table: (name, Postgres type oid).
+COLUMNS = [('id', 23), ('naam', 25), ('huisnummer', 23), ('oppervlakte', 701),
+           ('geboortedatum', 1082), ('wzs_update_datumtijd', 1114), ('ingeschreven', 16), ('overleden', 16)]
+
+# Rows of the stand-in table. With a chunksize of 2, the longest string (in bytes) is in a later chunk.
+ROWS = [(1, 'abcdef', 12, 55.5, datetime.date(1980, 1, 31), datetime.datetime(2019, 3, 5, 12, 0, 0), True, False),
+        (2, 'jansen', None, 80.25, None, datetime.datetime(2019, 3, 6, 8, 30, 0), False, None),
+        (3, 'Müller', 3, None, datetime.date(1975, 12, 1), None, True, True),
+        (4, 'Straße, 1"a"', 7, 120.0, datetime.date(2001, 6, 15), datetime.datetime(2019, 4, 1, 0, 0, 0), True, False),
+        (5, None, 9, 33.0, datetime.date(1990, 2, 28), datetime.datetime(2019, 5, 1, 23, 59, 59), False, False)]
+
+
+class StandInCursor():
+    """Cursor of StandInConnection, supporting the calls made by pandas and stream_dataset."""
+
+    def __init__(self):
+        self.description = None
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        self.description = [(name, oid, None, None, None, None, None) for name, oid in COLUMNS]
+        self.rows = [] if 'LIMIT 0' in sql else list(ROWS)
+
+    def fetchall(self):
+        return self.rows
+
+    def copy_expert(self, sql, f):
+        """Write the rows like COPY ... TO STDOUT WITH (FORMAT csv, NULL '\\N') does."""
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator='\n')
+        for row in ROWS:
+            writer.writerow(['\\N' if value is None else {True: 't', False: 'f'}.get(value, str(value))
+                             if isinstance(value, bool) else str(value) for value in row])
+        f.write(text.getvalue().encode('utf-8'))
+
+    def close(self):
+        pass
+
+
+class StandInConnection():
+    """Stand-in for a psycopg2 connection to a database with a single table."""
+
+    def cursor(self):
+        return StandInCursor()
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def downloaded(monkeypatch):
+    """The stand-in table, downloaded with download_dataset."""
+    @contextmanager
+    def connection(table_name):
+        yield StandInConnection()
+    monkeypatch.setattr(ds, 'connection', connection)
+    return ds.download_dataset('personen', 'bwv_personen')
+
+
+@pytest.mark.parametrize('storage', ['hdf', 'parquet'])
+def test_stream_dataset_matches_download(data_path, downloaded, storage):
+    if storage == 'parquet':
+        pytest.importorskip('pyarrow')
+    path, bool_cols = ds.stream_dataset('personen', 'bwv_personen', 'download', chunksize=2, storage=storage,
+                                        conn=StandInConnection())
+    streamed = ds.restore_bool_columns(ds.load_dataset('personen', 'download'), bool_cols)
+
+    assert len(streamed) == len(ROWS)
+    assert list(streamed.columns) == [name for name, _ in COLUMNS]
+    # The staging file is removed, and only the cache file of the requested backend is written.
+    assert sorted(p.name for p in data_path.iterdir()) == [f"personen_download.{ds.get_storage(storage).extension}"]
+    assert path == str(data_path / f"personen_download.{ds.get_storage(storage).extension}")
+    assert bool_cols == ['overleden']
+
+    # The streamed columns get the same types as with a regular download (dates are only parsed by compaction in
+    # a regular download), before and after compaction.
+    other_cols = [name for name, oid in COLUMNS if oid not in [1082, 1114]]
+    pd.testing.assert_frame_equal(streamed.reset_index(drop=True)[other_cols], downloaded[other_cols])
+    result = compact_dtypes(streamed.reset_index(drop=True), verbose=False)
+    pd.testing.assert_frame_equal(result, compact_dtypes(downloaded, verbose=False))
+
+
+def test_stream_dataset_removes_staging_file_on_failure(data_path):
+    class FailingCursor(StandInCursor):
+        def copy_expert(self, sql, f):
+            f.write(b'1,abc\n')
+            raise IOError('connection lost')
+
+    class FailingConnection(StandInConnection):
+        def cursor(self):
+            return FailingCursor()
+
+    with pytest.raises(IOError):
+        ds.stream_dataset('personen', 'bwv_personen', 'download', storage='hdf', conn=FailingConnection())
+    assert list(data_path.iterdir()) == []
+
+
+def test_streamed_download_is_only_kept_in_version_store(data_path, downloaded):
+    personen = PersonenDataset()
+    personen.download(force=True)
+    assert personen.key is not None
+    assert sorted(p.name for p in data_path.iterdir()) == ['version_store']
+    pd.testing.assert_frame_equal(personen.data.reset_index(drop=True), compact_dtypes(downloaded, verbose=False),
+                                  check_names=False)
+
+
+def test_stream_dataset_sizes_strings_in_bytes(data_path):
+    # Non-ASCII strings take more bytes than characters, which the HDF5 string columns must fit.
+    ds.stream_dataset('personen', 'bwv_personen', 'download', chunksize=2, storage='hdf', conn=StandInConnection())
+    streamed = ds.load_dataset('personen', 'download')
+    assert list(streamed['naam'][:4]) == [row[1] for row in ROWS[:4]]
+    assert streamed['naam'].isnull().tolist() == [False, False, False, False, True]
@@ -0,0 +1,39 @@
+####################################################################################################
+"""
+test_version_store.py
+
+Tests for the content-addressed version store (version_store.py).
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+from datasets.version_store import VersionStore
+
+
+@pytest.mark.parametrize('mixed, strings', [([True, 'a'], ['True', 'a']), ([1.0, 'a'], ['1.0', 'a']),
+                                            ([1, 'a'], ['1', 'a'])])
+def test_mixed_columns_keep_their_value_types(tmp_path, mixed, strings):
+    # Both columns have the same string representation, so they must not be deduplicated into one object.
+    store = VersionStore(str(tmp_path))
+    df = pd.DataFrame({'gemengd': pd.Series(mixed, dtype=object), 'tekst': pd.Series(strings, dtype=object)})
+    key = store.commit(df, 'test', 'v1')
+    hashes = dict(store.manifest(key)['columns'])
+    assert hashes['gemengd'] != hashes['tekst']
+    result = store.load(key)
+    assert [type(value) for value in result['gemengd']] == [type(value) for value in mixed]
+    assert list(result['tekst']) == strings
+
+
+def test_identical_columns_share_an_object(tmp_path):
+    store = VersionStore(str(tmp_path))
+    key = store.commit(pd.DataFrame({'a': [1, 'b'], 'c': [1, 'b']}), 'test', 'v1')
+    hashes = dict(store.manifest(key)['columns'])
+    assert hashes['a'] == hashes['c']
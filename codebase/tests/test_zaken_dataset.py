@@ -0,0 +1,62 @@
+####################################################################################################
+"""
+test_zaken_dataset.py
+
+Tests for the processing steps of the zaken dataset (zaken_dataset.py).
+
+The datasets package needs the (local) config module with the database settings.
+
+Written by Swaan Dekkers & Thomas Jongstra
+"""
+####################################################################################################
+
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('config')
+pytest.importorskip('tables')
+import datasets.datasets as ds
+import datasets.zaken_dataset as zd
+from datasets import ZakenDataset
+from datasets.version_store import VersionStore
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds, 'DATA_PATH', str(tmp_path))
+    return tmp_path
+
+
+def test_add_categories_only_loads_the_matched_column(data_path, monkeypatch):
+    csv_path = os.path.join(str(data_path), 'aanvulling_beh_oms.csv')
+    pd.DataFrame({'lcolumn': ['Huisbezoek', 'controle'], 'ncolumn': ['Onderhuur', 'woningkwaliteit']}).to_csv(csv_path, index=False)
+    monkeypatch.setattr(zd, 'CATEGORIES_CSV_PATH', csv_path)
+
+    zaken = ZakenDataset()
+    zaken.data = pd.DataFrame({'beh_oms': ['HUISBEZOEK', 'controle', None], 'afs_oms': ['A', 'B', 'C'], 'hsnr': [1, 2, 3]})
+    zaken.data.name = zaken.name
+    zaken.version = 'download'
+    zaken.save()
+    zaken.load('download')
+
+    hashes = dict(zaken._lazy.hashes)
+    loaded = []
+    load_object = VersionStore.load_object
+    monkeypatch.setattr(VersionStore, 'load_object', lambda store, h: loaded.append(h) or load_object(store, h))
+    # Run the body of the step itself (the mapping csv of the step is fixed when the class is defined).
+    ZakenDataset.add_categories.__wrapped__(zaken)
+    assert set(loaded) == {hashes['beh_oms']}
+    assert list(zaken['categorie'][:2]) == ['onderhuur', 'woningkwaliteit'] and pd.isnull(zaken['categorie'][2])
+
+
+def test_filter_categories_removes_unused_categories(data_path):
+    zaken = ZakenDataset()
+    zaken.data = pd.DataFrame({'zaak_id': [1, 2, 3],
+                               'categorie': pd.Categorical(['onderhuur', 'woningkwaliteit', 'vakantieverhuur'])})
+    zaken.data.name = zaken.name
+    zaken.version = 'categories'
+    zaken.filter_categories()
+    assert list(zaken['zaak_id']) == [1, 3]
+    assert list(zaken['categorie'].cat.categories) == ['onderhuur', 'vakantieverhuur']
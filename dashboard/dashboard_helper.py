@@ -6,6 +6,7 @@
 #                                                                                                  #
 # - Creating a selection of the most recent ICTU signals.                                          #
 # - Loading a pre-trained prediction model.                                                        #
+# - Looking up the enriched features of a list of addresses in the feature store.                  #
 # - Performing inference on a list of ICTU signals, using a loaded pre-trained model.              #
 #                                                                                                  #
 # Written by Swaan Dekkers & Thomas Jongstra                                                       #
@@ -17,6 +18,7 @@
 
 from sqlalchemy import create_engine
 import papermill as pm
+import pandas as pd
 import datetime
 import pickle
 import copy
@@ -50,6 +52,37 @@ def load_data():
     return zakenDataset
 
 
+def load_address_features(adres_ids, columns=None):
+    """
+    Look up the enriched features (BAG, personen and hotline) of a list of addresses in the feature store.
+    This only reads the requested addresses, instead of loading the full enriched zaken dataset.
+    """
+    return get_feature_store().lookup(adres_ids, columns)
+
+
+# Columns of the signals which are shown by the dashboard (see mockup_dataset.csv).
+SIGNAL_COLUMNS = ['adres_id', 'wzs_lat', 'wzs_lon', 'sdl_naam', 'categorie', 'sttnaam', 'hsnr', 'toev', 'hsltr',
+                  'aantal_personen', 'aantal_achternamen', 'eigenaar']
+
+
+def load_signals(columns, n=None):
+    """
+    Load the given columns for the cases in the final zaken dataset, or for a random sample of n cases. Address
+    features are looked up in the feature store (see load_address_features), and only the other columns are
+    loaded from the zaken dataset. This way, the full enriched zaken dataset is never loaded.
+    """
+    store_columns = set(get_feature_store().columns())
+    zakenDataset = ZakenDataset()
+    zakenDataset.load('final', columns=list(dict.fromkeys(['adres_id'] + [col for col in columns if col not in store_columns])))
+    signals = zakenDataset.data
+    if n is not None:
+        signals = signals.sample(n)
+    features = load_address_features(signals['adres_id'].values, [col for col in columns if col in store_columns])
+    features.index = signals.index
+    signals = pd.concat([signals, features], axis=1)
+    return signals[[col for col in dict.fromkeys(columns) if col in signals.columns]]
+
+
 def load_pre_trained_model():
     """
     Load a pre-trained machine learning model, which can calculate the statistical
@@ -60,10 +93,9 @@ def load_pre_trained_model():
     return model
 
 
-def get_recent_signals(zakenDataset, n=100):
-    """Create a list the n most recent ICTU signals from our data."""
-    signals = zakenDataset.data.sample(100)  # INSTEAD OF PICKING THE MOST RECENT SIGNALS, WE TEMPORARILY RANDOMLY SAMPLE THEM FOR OUR MOCK UP!
-    signals.drop(columns=['woonfraude'], inplace=True)  # For the final list of signals, this step should not be necessary either.
+def get_recent_signals(columns, n=100):
+    """Create a list the n most recent ICTU signals from our data, with the given columns."""
+    signals = load_signals(columns, n=n)  # INSTEAD OF PICKING THE MOST RECENT SIGNALS, WE TEMPORARILY RANDOMLY SAMPLE THEM FOR OUR MOCK UP!
     return signals
 
 
@@ -92,11 +124,10 @@ def create_signals_predictions(model, signals):
 
 def process_recent_signals():
     """Create a list of recent signals and their computed fraud predictions."""
-    zakenDataset = load_data()
-    model = load_pre_trained_model()
-    recent_signals = get_recent_signals(zakenDataset)
-    recent_signals_for_predictions = copy.deepcopy(recent_signals)
     model = load_pre_trained_model()
+    recent_signals = get_recent_signals(SIGNAL_COLUMNS + list(model.feature_names))
+    recent_signals_for_predictions = recent_signals[model.feature_names].copy()
+    recent_signals = recent_signals[[col for col in SIGNAL_COLUMNS if col in recent_signals.columns]]
     predictions = create_signals_predictions(model, recent_signals_for_predictions)
     recent_signals['woonfraude'] = predictions
     recent_signals['fraude_kans'] = recent_signals['woonfraude'].astype(int)  # Temporarily create a fraude_kans column to be compatible with the dashboard.
@@ -134,22 +165,19 @@ def process_for_tableau():
     # _ = pm.execute_notebook(os.path.abspath(os.path.join('NOTEBOOK_PATH', 'master_prepare_tableau.ipynb'),
     #                         f'{output_folder_run}/master_prepare - output.ipynb')
 
-    # Load data & model.
-    zakenDataset = load_data()
+    # Load model, and the columns expected by the model (plus the case ids) for all cases.
     model = load_pre_trained_model()
-
-    # Get list of columns expected by model. Remove any columns in the data that do not match this list.
-    data = copy.deepcopy(zakenDataset.data)
-    data = data[model.feature_names]
+    signals = load_signals(['adres_id', 'zaak_id'] + list(model.feature_names))
+    data = signals[model.feature_names].copy()
 
     # Create predictions.
     predictions = create_signals_predictions(model, data)
-    zakenDataset.data['woonfraude'] = predictions
+    signals['woonfraude'] = predictions
 
     # Convert predictions to a model fitting the database.
-    zakenDataset.data['wvs_nr'] = zakenDataset.zaak_id.apply(lambda x: x.split('_')[1])
-    zakenDataset.data.rename({'woonfraude': 'fraud_prediction'})
-    predictions_tableau =  zakenDataset.data[['adres_id', 'wvs_nr', 'fraud_prediction']]
+    signals['wvs_nr'] = signals.zaak_id.apply(lambda x: x.split('_')[1])
+    signals = signals.rename(columns={'woonfraude': 'fraud_prediction'})
+    predictions_tableau = signals[['adres_id', 'wvs_nr', 'fraud_prediction']]
 
     # Create a database engine.
     engine = create_engine(f'postgresql+psycopg2://{config.USER_2}:{config.PASSWORD_2}@{config.HOST_2}:{config.PORT_2}/{config.DB_2}')